@@ -1,12 +1,9 @@
 from database import SessionLocal
 from models import Usuario, Rol
 from sqlalchemy.exc import IntegrityError
-from passlib.context import CryptContext
+from hashing import hashear
 from typing import Optional, Dict, Any, Tuple
 
-# Configuración para hashear contraseñas
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 class UserManager:
     def __init__(self):
         self.db = SessionLocal()
@@ -35,7 +32,7 @@ class UserManager:
                 return False, "⚠️ El usuario ya existe en la base de datos."
             
             # Hashear la contraseña
-            password_hash = pwd_context.hash(password)
+            password_hash = hashear(password)
             
             # Determinar el rol_id
             if rol_id is None and rol_nombre:
@@ -0,0 +1,205 @@
+"""
+Particiones mensuales y archivo de la tabla auditoria.
+
+Uso:
+    python archivo_auditoria.py --listar             particiones en la base y meses archivados
+    python archivo_auditoria.py --archivar           pasa a archivos .csv.gz los meses anteriores a
+                                                     AUDITORIA_MESES_ACTIVOS y los saca de la base
+    python archivo_auditoria.py --restaurar 2023-05  vuelve a cargar en la base un mes archivado
+
+auditoria está particionada por rango de fecha, una partición por mes
+(auditoria_pAAAA_MM) más auditoria_default para lo que no tenga partición.
+migrar.py crea las particiones de los próximos meses en cada deploy; si
+alguna fila cayó en la default, pasa a su partición cuando esta se crea.
+"""
+import gzip
+import os
+import re
+import sys
+from datetime import date
+
+from sqlalchemy import text
+
+from config import settings
+from database import engine
+
+# Meses hacia adelante que se dejan creados
+MESES_ADELANTE = 3
+
+COLUMNAS = "id, usuario_id, accion, tabla_afectada, registro_id, fecha, detalles, pago_id, cobranza_id, cuota_id"
+
+def _sumar_meses(mes: date, cantidad: int) -> date:
+    total = mes.year * 12 + mes.month - 1 + cantidad
+    return date(total // 12, total % 12 + 1, 1)
+
+def nombre_particion(mes: date) -> str:
+    return f"auditoria_p{mes:%Y_%m}"
+
+def crear_particion(conn, mes: date) -> bool:
+    """Crea la partición del mes, pasando a ella lo que haya caído en la default"""
+    nombre = nombre_particion(mes)
+    if conn.execute(text("SELECT to_regclass(:nombre)"), {"nombre": nombre}).scalar():
+        return False
+    desde, hasta = mes, _sumar_meses(mes, 1)
+    conn.execute(text(f"CREATE TABLE {nombre} (LIKE auditoria INCLUDING DEFAULTS)"))
+    conn.execute(text(f"""
+        WITH movidas AS (
+            DELETE FROM auditoria_default WHERE fecha >= :desde AND fecha < :hasta RETURNING *
+        )
+        INSERT INTO {nombre} SELECT * FROM movidas
+    """), {"desde": desde, "hasta": hasta})
+    conn.execute(text(
+        f"ALTER TABLE auditoria ATTACH PARTITION {nombre} FOR VALUES FROM ('{desde}') TO ('{hasta}')"
+    ))
+    return True
+
+def asegurar_particiones(conn, hoy: date = None):
+    """Particiones del mes actual y de los MESES_ADELANTE siguientes"""
+    hoy = hoy or date.today()
+    mes = date(hoy.year, hoy.month, 1)
+    for i in range(MESES_ADELANTE + 1):
+        crear_particion(conn, _sumar_meses(mes, i))
+
+def particionar(conn):
+    """
+    Migración: convierte auditoria en tabla particionada. Copia las filas de
+    la tabla anterior a las particiones de sus meses y la elimina.
+    """
+    tipo = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('auditoria')")).scalar()
+    anterior = tipo != "p"
+    if anterior:
+        conn.execute(text("ALTER TABLE auditoria RENAME TO auditoria_sin_particionar"))
+        conn.execute(text("ALTER TABLE auditoria_sin_particionar RENAME CONSTRAINT auditoria_pkey TO auditoria_sin_particionar_pkey"))
+        conn.execute(text("ALTER INDEX IF EXISTS ix_auditoria_id RENAME TO ix_auditoria_sin_particionar_id"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_auditoria_ultimo_actor"))
+        conn.execute(text("ALTER SEQUENCE auditoria_id_seq RENAME TO auditoria_sin_particionar_id_seq"))
+        # La tabla como quedó en esta migración; columnas e índices
+        # posteriores llegan por sus propias migraciones
+        conn.execute(text("""
+            CREATE TABLE auditoria (
+                id SERIAL NOT NULL,
+                usuario_id INTEGER REFERENCES usuarios (id) ON DELETE SET NULL,
+                accion TEXT NOT NULL,
+                tabla_afectada TEXT NOT NULL,
+                registro_id INTEGER NOT NULL,
+                fecha TIMESTAMP NOT NULL,
+                detalles TEXT,
+                pago_id INTEGER REFERENCES pagos (id),
+                cobranza_id INTEGER REFERENCES cobranzas (id),
+                cuota_id INTEGER REFERENCES cuota (id),
+                PRIMARY KEY (id, fecha)
+            ) PARTITION BY RANGE (fecha)
+        """))
+        conn.execute(text("CREATE INDEX ix_auditoria_id ON auditoria (id)"))
+        conn.execute(text("""
+            CREATE INDEX ix_auditoria_ultimo_actor
+            ON auditoria (tabla_afectada, registro_id, fecha DESC) INCLUDE (usuario_id)
+        """))
+
+    conn.execute(text("CREATE TABLE IF NOT EXISTS auditoria_default PARTITION OF auditoria DEFAULT"))
+
+    if anterior:
+        # Una partición por cada mes que tenga filas
+        meses = conn.execute(text(
+            "SELECT DISTINCT date_trunc('month', fecha)::date FROM auditoria_sin_particionar WHERE fecha IS NOT NULL"
+        )).scalars()
+        for mes in meses:
+            crear_particion(conn, mes)
+        asegurar_particiones(conn)
+        conn.execute(text(f"""
+            INSERT INTO auditoria ({COLUMNAS})
+            SELECT {COLUMNAS.replace("fecha", "COALESCE(fecha, CURRENT_TIMESTAMP)")}
+            FROM auditoria_sin_particionar
+        """))
+        conn.execute(text("SELECT setval('auditoria_id_seq', (SELECT COALESCE(MAX(id), 0) + 1 FROM auditoria), false)"))
+        conn.execute(text("DROP TABLE auditoria_sin_particionar"))
+    else:
+        asegurar_particiones(conn)
+
+def _particiones(cur):
+    """(nombre, mes) de las particiones mensuales, de la más vieja a la más nueva"""
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'auditoria'::regclass ORDER BY c.relname
+    """)
+    particiones = []
+    for (nombre,) in cur.fetchall():
+        encontrado = re.fullmatch(r"auditoria_p(\d{4})_(\d{2})", nombre)
+        if encontrado:
+            particiones.append((nombre, date(int(encontrado.group(1)), int(encontrado.group(2)), 1)))
+    return particiones
+
+def _ruta_archivo(mes: date) -> str:
+    return os.path.join(settings.AUDITORIA_DIRECTORIO_ARCHIVO, f"{nombre_particion(mes)}.csv.gz")
+
+def archivar(hoy: date = None):
+    """Pasa a archivo cada mes anterior a los activos y lo saca de la base"""
+    corte = settings.inicio_meses_activos(hoy)
+    os.makedirs(settings.AUDITORIA_DIRECTORIO_ARCHIVO, exist_ok=True)
+    conexion = engine.raw_connection()
+    try:
+        cur = conexion.cursor()
+        for nombre, mes in _particiones(cur):
+            if mes >= corte:
+                continue
+            ruta = _ruta_archivo(mes)
+            # Nadie escribe en la partición mientras se copia
+            cur.execute(f"LOCK TABLE {nombre} IN SHARE MODE")
+            cur.execute(f"SELECT EXISTS (SELECT 1 FROM {nombre})")
+            con_filas = cur.fetchone()[0]
+            if con_filas:
+                with open(ruta + ".tmp", "wb") as crudo:
+                    with gzip.GzipFile(fileobj=crudo, mode="wb") as archivo:
+                        cur.copy_expert(f"COPY {nombre} ({COLUMNAS}) TO STDOUT WITH (FORMAT csv, HEADER)", archivo)
+                    crudo.flush()
+                    os.fsync(crudo.fileno())
+                os.replace(ruta + ".tmp", ruta)
+            # Solo se borra de la base una vez que el archivo quedó escrito
+            cur.execute(f"ALTER TABLE auditoria DETACH PARTITION {nombre}")
+            cur.execute(f"DROP TABLE {nombre}")
+            conexion.commit()
+            print(f"Archivado {mes:%Y-%m} en {ruta}" if con_filas else f"Eliminada la partición vacía de {mes:%Y-%m}")
+    finally:
+        conexion.close()
+
+def restaurar(mes: date):
+    """Vuelve a cargar un mes archivado en su partición"""
+    ruta = _ruta_archivo(mes)
+    if not os.path.exists(ruta):
+        raise FileNotFoundError(f"No hay archivo para {mes:%Y-%m} ({ruta})")
+    # Partición y COPY en la misma transacción: si la carga falla no queda
+    # una partición vacía que haga creer que el mes ya está restaurado
+    with engine.begin() as conn:
+        if not crear_particion(conn, mes):
+            raise RuntimeError(f"El mes {mes:%Y-%m} ya está en la base")
+        cur = conn.connection.cursor()
+        with gzip.open(ruta, "rb") as archivo:
+            cur.copy_expert(f"COPY auditoria ({COLUMNAS}) FROM STDIN WITH (FORMAT csv, HEADER)", archivo)
+    print(f"Restaurado {mes:%Y-%m} desde {ruta}")
+
+def listar():
+    conexion = engine.raw_connection()
+    try:
+        cur = conexion.cursor()
+        corte = settings.inicio_meses_activos()
+        for nombre, mes in _particiones(cur):
+            cur.execute(f"SELECT COUNT(*) FROM {nombre}")
+            marca = "activa" if mes >= corte else "a archivar"
+            print(f"{mes:%Y-%m}  {cur.fetchone()[0]:>8} filas  ({marca})")
+        cur.execute("SELECT COUNT(*) FROM auditoria_default")
+        print(f"default  {cur.fetchone()[0]:>8} filas")
+    finally:
+        conexion.close()
+    if os.path.isdir(settings.AUDITORIA_DIRECTORIO_ARCHIVO):
+        for nombre in sorted(os.listdir(settings.AUDITORIA_DIRECTORIO_ARCHIVO)):
+            if nombre.endswith(".csv.gz"):
+                print(f"archivado: {nombre}")
+
+if __name__ == "__main__":
+    if "--archivar" in sys.argv:
+        archivar()
+    elif "--restaurar" in sys.argv:
+        anio, mes = sys.argv[sys.argv.index("--restaurar") + 1].split("-")
+        restaurar(date(int(anio), int(mes), 1))
+    else:
+        listar()
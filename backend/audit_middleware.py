@@ -1,65 +1,355 @@
 from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
 import models
 from datetime import datetime
+from decimal import Decimal
+import glob
 import inspect
+import json
+import os
+import queue
+import threading
+import uuid
+
+# Modelo al que corresponde cada nombre de tabla usado en @audit_trail
+MODELOS_AUDITADOS = {
+    "pagos": models.Pago,
+    "cobranza": models.Cobranza,
+    "cuota": models.Cuota,
+    "partidas": models.Partida,
+}
+
+def _a_json(valor):
+    # Los montos vienen como Decimal de la base y como float de los schemas
+    return float(valor) if isinstance(valor, Decimal) else str(valor)
+
+def _valores(obj):
+    """Columnas con valor de un registro (sin el id)"""
+    valores = {}
+    for columna in obj.__mapper__.column_attrs:
+        valor = getattr(obj, columna.key)
+        if columna.key != "id" and valor is not None:
+            valores[columna.key] = valor
+    return valores
+
+def _diferencias(obj):
+    """{columna: [antes, después]} de las columnas que cambian en este flush"""
+    cambios = {}
+    for columna in obj.__mapper__.column_attrs:
+        historia = get_history(obj, columna.key)
+        if historia.added or historia.deleted:
+            antes = historia.deleted[0] if historia.deleted else None
+            despues = historia.added[0] if historia.added else None
+            if antes != despues:
+                cambios[columna.key] = [antes, despues]
+    return cambios
+
+class _AuditoriaPendiente:
+    """Lo que la función decorada en curso va a dejar en la auditoría"""
+    def __init__(self, tabla_afectada, modelo, usuario_id):
+        self.tabla_afectada = tabla_afectada
+        self.modelo = modelo
+        self.usuario_id = usuario_id
+        # registro_id -> [accion, detalle]; se acumula entre flushes
+        self.cambios = {}
+
+    def anotar(self, registro_id, accion, detalle):
+        previo = self.cambios.get(registro_id)
+        if previo is None:
+            self.cambios[registro_id] = [accion, detalle]
+        elif accion == "eliminar":
+            self.cambios[registro_id] = [accion, detalle]
+        elif previo[0] == "crear":
+            # Cambios sobre un registro creado en la misma operación: valores finales
+            previo[1].update({columna: despues for columna, (_, despues) in detalle.items()})
+        else:
+            for columna, (antes, despues) in detalle.items():
+                previo[1][columna] = [previo[1].get(columna, [antes])[0], despues]
+
+    def filas(self):
+        return [
+            dict(
+                usuario_id=self.usuario_id,  # Puede ser None si no se proporciona
+                accion=accion,
+                tabla_afectada=self.tabla_afectada,
+                registro_id=registro_id,
+                fecha=datetime.now(),
+                detalles=json.dumps(detalle, default=_a_json, ensure_ascii=False, separators=(",", ":"))
+            )
+            for registro_id, (accion, detalle) in self.cambios.items()
+        ]
+
+class EscritorAuditoria:
+    """
+    Escribe la auditoría en lotes desde un hilo aparte. Las filas llegan a
+    una cola acotada después de cada commit y se insertan con un único
+    INSERT de varias filas por lote. Lo que no se puede escribir (base caída,
+    cola llena, apagado) va a un archivo JSONL propio del proceso que se
+    carga al iniciar.
+
+    Cada fila lleva una clave única (auditoria.clave): volver a cargar un
+    archivo que ya se había cargado en parte no duplica filas.
+    """
+    def __init__(self, crear_sesion, maximo: int, tamano_lote: int, archivo_respaldo: str):
+        self.crear_sesion = crear_sesion
+        self.cola = queue.Queue(maxsize=maximo)
+        self.tamano_lote = tamano_lote
+        # Un archivo por proceso: con varios workers de uvicorn no se pisan
+        self._raiz, self._extension = os.path.splitext(archivo_respaldo)
+        self._archivo_legado = archivo_respaldo
+        self.archivo_respaldo = f"{self._raiz}.{os.getpid()}{self._extension}"
+        self._bloqueo_archivo = threading.Lock()
+        self._bloqueo_contadores = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+        self.escritas = 0
+        self.lotes = 0
+        self.respaldadas = 0
+
+    def iniciar(self):
+        self._recuperar_respaldos()
+        self._hilo = threading.Thread(target=self._trabajar, name="escritor-auditoria", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout=10)
+        restantes = []
+        while True:
+            try:
+                restantes.append(self.cola.get_nowait())
+            except queue.Empty:
+                break
+        if restantes:
+            self._escribir(restantes)
+
+    def encolar(self, filas):
+        # Corre en el hilo del request (after_commit): nunca espera lugar en
+        # la cola; lo que no entra va de una vez al archivo de respaldo
+        for i, fila in enumerate(filas):
+            fila.setdefault("clave", uuid.uuid4().hex)
+            try:
+                self.cola.put_nowait(fila)
+            except queue.Full:
+                restantes = filas[i:]
+                for resto in restantes:
+                    resto.setdefault("clave", uuid.uuid4().hex)
+                self._respaldar(restantes)
+                return
+
+    def metricas(self):
+        with self._bloqueo_contadores:
+            escritas, lotes, respaldadas = self.escritas, self.lotes, self.respaldadas
+        return {
+            "activa": self._hilo is not None and self._hilo.is_alive(),
+            "en_cola": self.cola.qsize(),
+            "capacidad": self.cola.maxsize,
+            "escritas": escritas,
+            "lotes": lotes,
+            "respaldadas": respaldadas,
+        }
+
+    def _trabajar(self):
+        while not self._detener.is_set():
+            try:
+                lote = [self.cola.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(lote) < self.tamano_lote:
+                try:
+                    lote.append(self.cola.get_nowait())
+                except queue.Empty:
+                    break
+            self._escribir(lote)
+
+    def _escribir(self, filas):
+        db = self.crear_sesion()
+        try:
+            # Las filas que ya están (misma clave) se saltean
+            db.execute(pg_insert(models.Auditoria).on_conflict_do_nothing(), filas)
+            db.commit()
+            with self._bloqueo_contadores:
+                self.escritas += len(filas)
+                self.lotes += 1
+            return True
+        except Exception as e:
+            print(f"Error al escribir auditoría: {str(e)}")
+            db.rollback()
+            self._respaldar(filas)
+            return False
+        finally:
+            db.close()
+
+    def _respaldar(self, filas):
+        with self._bloqueo_archivo:
+            with open(self.archivo_respaldo, "a", encoding="utf-8") as archivo:
+                for fila in filas:
+                    archivo.write(json.dumps({**fila, "fecha": fila["fecha"].isoformat()}) + "\n")
+                archivo.flush()
+                os.fsync(archivo.fileno())
+        with self._bloqueo_contadores:
+            self.respaldadas += len(filas)
+
+    def _de_proceso_vivo(self, ruta):
+        """True si el archivo es de otro proceso que sigue corriendo"""
+        nombre = os.path.basename(ruta)[len(os.path.basename(self._raiz)) + 1:]
+        pid = nombre.split(".", 1)[0]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _recuperar_respaldos(self):
+        """
+        Carga en la base lo que quedó en los archivos de respaldo de procesos
+        que ya no corren (y el de este mismo pid, si lo reusó un proceso nuevo)
+        """
+        patron = glob.escape(self._raiz) + ".*" + glob.escape(self._extension)
+        for ruta in glob.glob(patron) + [self._archivo_legado]:
+            if not os.path.exists(ruta) or self._de_proceso_vivo(ruta):
+                continue
+            try:
+                with self._bloqueo_archivo:
+                    os.replace(ruta, ruta + ".cargando")
+            except FileNotFoundError:
+                continue  # lo tomó otro worker que arrancó a la vez
+        # Los .cargando de un arranque anterior que se cortó a mitad de carga
+        # se vuelven a cargar enteros: las claves evitan duplicados
+        for en_proceso in glob.glob(patron + ".cargando") + glob.glob(glob.escape(self._archivo_legado) + ".cargando"):
+            if self._de_proceso_vivo(en_proceso[:-len(".cargando")]):
+                continue
+            self._cargar(en_proceso)
+
+    def _cargar(self, en_proceso):
+        try:
+            with open(en_proceso, encoding="utf-8") as archivo:
+                filas = [json.loads(linea) for linea in archivo if linea.strip()]
+        except FileNotFoundError:
+            return
+        for fila in filas:
+            fila["fecha"] = datetime.fromisoformat(fila["fecha"])
+            fila.setdefault("clave", None)  # archivos anteriores a las claves
+        # Si vuelve a fallar, _escribir las devuelve al archivo de respaldo
+        for i in range(0, len(filas), self.tamano_lote):
+            self._escribir(filas[i:i + self.tamano_lote])
+        try:
+            os.remove(en_proceso)
+        except FileNotFoundError:
+            pass
+
+# Escritor en segundo plano; None mientras la auditoría sea sincrónica
+escritor = None
+
+def iniciar_escritor(crear_sesion, maximo: int, tamano_lote: int, archivo_respaldo: str):
+    global escritor
+    escritor = EscritorAuditoria(crear_sesion, maximo, tamano_lote, archivo_respaldo)
+    escritor.iniciar()
+    return escritor
+
+def detener_escritor():
+    global escritor
+    if escritor is not None:
+        escritor.detener()
+        escritor = None
+
+def registrar_auditoria(session: Session, filas):
+    """
+    Agrega filas de auditoría al commit en curso de la sesión o, con el
+    escritor activo, las encola cuando ese commit termina bien.
+    """
+    if not filas:
+        return
+    if escritor is None:
+        session.add_all([models.Auditoria(**fila) for fila in filas])
+    else:
+        session.info.setdefault("auditoria_confirmar", []).extend(filas)
+
+@event.listens_for(Session, "after_commit")
+def _encolar_auditoria(session):
+    filas = session.info.pop("auditoria_confirmar", None)
+    if filas and escritor is not None:
+        escritor.encolar(filas)
+
+@event.listens_for(Session, "after_rollback")
+def _descartar_auditoria(session):
+    # El cambio no se confirmó: su auditoría tampoco
+    session.info.pop("auditoria_confirmar", None)
+
+@event.listens_for(Session, "after_flush")
+def _anotar_registros(session, flush_context):
+    # new, dirty y deleted todavía muestran lo que se acaba de escribir,
+    # ya con id y con el historial de cada atributo
+    pendiente = session.info.get("auditoria")
+    if pendiente is None or pendiente.modelo is None:
+        return
+    for obj in session.new:
+        if isinstance(obj, pendiente.modelo):
+            pendiente.anotar(obj.id, "crear", _valores(obj))
+    for obj in session.dirty:
+        if isinstance(obj, pendiente.modelo):
+            diferencias = _diferencias(obj)
+            if diferencias:
+                pendiente.anotar(obj.id, "actualizar", diferencias)
+    for obj in session.deleted:
+        if isinstance(obj, pendiente.modelo):
+            pendiente.anotar(obj.id, "eliminar", _valores(obj))
+
+@event.listens_for(Session, "before_commit")
+def _agregar_auditoria(session):
+    # Las filas de auditoría entran en el mismo commit que el cambio auditado
+    pendiente = session.info.get("auditoria")
+    if pendiente is None:
+        return
+    session.flush()  # para que los cambios todavía sin escribir tengan id
+    session.info.pop("auditoria")
+    registrar_auditoria(session, pendiente.filas())
 
 def audit_trail(tabla_afectada):
+    modelo = MODELOS_AUDITADOS.get(tabla_afectada)
+
     def decorator(func):
+        # La firma se resuelve una sola vez, al decorar
+        parametros = list(inspect.signature(func).parameters)
+        posicion_usuario = (
+            parametros.index('current_user_id') - 1  # sin contar db
+            if 'current_user_id' in parametros else None
+        )
+
         @wraps(func)
         def wrapper(db: Session, *args, **kwargs):
-            # Intentar extraer current_user_id
             current_user_id = None
-            
-            # Verificar si la función espera current_user_id
-            sig = inspect.signature(func)
-            if 'current_user_id' in sig.parameters:
-                # Si current_user_id ya está en kwargs, extraerlo
+            if posicion_usuario is not None:
                 if 'current_user_id' in kwargs:
-                    current_user_id = kwargs.pop('current_user_id')
-                # Si no está en kwargs, intentar extraerlo de args si es posible
-                elif len(args) > len(list(sig.parameters.keys())) - 1:
-                    current_user_id = args[-1]
-            
-            # Ejecutar la función original
+                    current_user_id = kwargs['current_user_id']
+                elif len(args) > posicion_usuario:
+                    current_user_id = args[posicion_usuario]
+
+            # Una función auditada llamada desde otra queda cubierta por la de afuera
+            if "auditoria" in db.info:
+                return func(db, *args, **kwargs)
+
+            pendiente = _AuditoriaPendiente(tabla_afectada, modelo, current_user_id)
+            db.info["auditoria"] = pendiente
             try:
-                # Si la función requiere current_user_id, pasarlo
-                if 'current_user_id' in sig.parameters:
-                    if current_user_id is None:
-                        kwargs['current_user_id'] = None
-                    else:
-                        kwargs['current_user_id'] = current_user_id
-                    resultado = func(db, *args, **kwargs)
-                else:
-                    resultado = func(db, *args, **kwargs)
-            except TypeError:
-                # Si falla, intentar ejecutar sin current_user_id
                 resultado = func(db, *args, **kwargs)
-            
-            try:
-                # Determinar el ID del registro creado
-                if hasattr(resultado, 'id'):
-                    registro_id = resultado.id
-                else:
-                    return resultado
-                
-                # Crear registro de auditoría
-                auditoria = models.Auditoria(
-                    usuario_id=current_user_id,  # Puede ser None si no se proporciona
-                    accion="crear",
-                    tabla_afectada=tabla_afectada,
-                    registro_id=registro_id,
-                    fecha=datetime.now(),
-                    detalles=f"Creación de registro en {tabla_afectada}"
-                )
-                
-                db.add(auditoria)
-                db.commit()
-            
-            except Exception as e:
-                print(f"Error en auditoría: {str(e)}")
-                db.rollback()
-            
+            finally:
+                sin_confirmar = db.info.pop("auditoria", None)
+
+            # La función no hizo commit: lo que haya escrito queda auditado en la
+            # sesión y se confirma junto con lo que el llamador confirme después.
+            # Si solo leyó, no hay nada que registrar.
+            if sin_confirmar is not None:
+                registrar_auditoria(db, sin_confirmar.filas())
+
             return resultado
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
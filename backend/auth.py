@@ -1,23 +1,105 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
+import threading
+import time
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from database import get_db
 from models import Usuario
 from schemas import TokenData
 from config import settings
+import hashing
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
+# Usuarios autenticados hace poco, por id (el "sub" del token), con el rol ya
+# cargado: id -> (vence, usuario). Los objetos están fuera de toda sesión y
+# se usan solo para leer. Cada proceso tiene la suya; un cambio hecho desde
+# otro proceso se ve cuando vence la entrada (AUTH_CACHE_TTL_SEGUNDOS).
+_principales = OrderedDict()
+_bloqueo_principales = threading.Lock()
+_estadisticas_principales = {"aciertos": 0, "fallos": 0}
+
+# Usuarios borrados o modificados desde este proceso: id -> cuándo
+# (time.time()). Para los tokens emitidos antes no se cree en el rol del
+# token y se verifica contra la base. Un cambio en los roles afecta a todos
+# y queda en _revocacion_general. Las entradas duran lo que un token.
+_revocados = {}
+_revocacion_general = 0.0
+
+def _principal_en_cache(usuario_id: int):
+    with _bloqueo_principales:
+        entrada = _principales.get(usuario_id)
+        if entrada is None or entrada[0] < time.monotonic():
+            _principales.pop(usuario_id, None)
+            _estadisticas_principales["fallos"] += 1
+            return None
+        _principales.move_to_end(usuario_id)
+        _estadisticas_principales["aciertos"] += 1
+        return entrada[1]
+
+def _guardar_principal(usuario: Usuario):
+    with _bloqueo_principales:
+        _principales[usuario.id] = (time.monotonic() + settings.AUTH_CACHE_TTL_SEGUNDOS, usuario)
+        _principales.move_to_end(usuario.id)
+        while len(_principales) > settings.AUTH_CACHE_MAXIMO:
+            _principales.popitem(last=False)
+
+def invalidar_principal(usuario_id: Optional[int] = None):
+    """
+    Saca un usuario de la cache, o a todos si no se indica cuál, y deja de
+    confiar en el rol de los tokens que ya tienen
+    """
+    global _revocacion_general
+    ahora = time.time()
+    with _bloqueo_principales:
+        if usuario_id is None:
+            _principales.clear()
+            _revocacion_general = ahora
+        else:
+            _principales.pop(usuario_id, None)
+            _revocados[usuario_id] = ahora
+        vencidos = ahora - settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+        for id_revocado in [i for i, momento in _revocados.items() if momento < vencidos]:
+            del _revocados[id_revocado]
+
+def _rol_revocado(token_data: TokenData) -> bool:
+    """El usuario cambió después de emitirse el token"""
+    with _bloqueo_principales:
+        revocado = max(_revocados.get(token_data.id, 0.0), _revocacion_general)
+    return revocado > 0 and (token_data.emitido or 0) <= revocado
+
+def metricas_principales():
+    with _bloqueo_principales:
+        return {
+            "en_cache": len(_principales),
+            "capacidad": settings.AUTH_CACHE_MAXIMO,
+            "ttl_segundos": settings.AUTH_CACHE_TTL_SEGUNDOS,
+            "revocados": len(_revocados),
+            **_estadisticas_principales,
+        }
+
+def _hash_no_disponible():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Demasiados inicios de sesión en curso, intente nuevamente en unos segundos",
+        headers={"Retry-After": "2"},
+    )
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    try:
+        return hashing.verificar(plain_password, hashed_password)[0]
+    except hashing.HashNoDisponible:
+        raise _hash_no_disponible()
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    try:
+        return hashing.hashear(password)
+    except hashing.HashNoDisponible:
+        raise _hash_no_disponible()
 
 def authenticate_user(db: Session, email: str, password: str):
     user = db.query(Usuario).filter(Usuario.email == email).first()
@@ -26,13 +108,25 @@ def authenticate_user(db: Session, email: str, password: str):
         print("Usuario no encontrado")
         return False
     
+    if not user.password_hash:
+        return False
     
-    
-    password_check = verify_password(password, user.password_hash)
-    
+    try:
+        password_check, nuevo_hash = hashing.verificar(password, user.password_hash)
+    except hashing.HashNoDisponible:
+        raise _hash_no_disponible()
+    except ValueError:
+        # Hash con un formato que passlib no reconoce
+        return False
     
     if not password_check:
         return False
+    
+    if nuevo_hash:
+        # Hash de un costo o esquema anterior: se reemplaza por uno con el configurado
+        user.password_hash = nuevo_hash
+        db.commit()
+        invalidar_principal(user.id)
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -41,50 +135,75 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def _credenciales_invalidas():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="No se pudieron validar las credenciales",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+async def get_token_data(token: str = Depends(oauth2_scheme)) -> TokenData:
+    """Id y rol del usuario según el token, sin consultar la base"""
     try:
         payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
         user_id: int = payload.get("sub")
         if user_id is None:
-            raise credentials_exception
-        token_data = TokenData(id=user_id)
+            raise _credenciales_invalidas()
+        return TokenData(id=user_id, rol=payload.get("rol"), emitido=payload.get("iat"))
     except JWTError:
-        raise credentials_exception
-    user = db.query(Usuario).filter(Usuario.id == token_data.id).first()
+        raise _credenciales_invalidas()
+
+def _cargar_usuario(db: Session, usuario_id: int) -> Usuario:
+    if settings.AUTH_CACHE_TTL_SEGUNDOS > 0:
+        user = _principal_en_cache(usuario_id)
+        if user is not None:
+            return user
+    user = db.query(Usuario).options(joinedload(Usuario.rol)).filter(Usuario.id == usuario_id).first()
     if user is None:
-        raise credentials_exception
+        raise _credenciales_invalidas()
+    if settings.AUTH_CACHE_TTL_SEGUNDOS > 0:
+        # Fuera de la sesión, para que el commit del endpoint no lo expire
+        db.expunge(user)
+        db.expunge(user.rol)
+        _guardar_principal(user)
     return user
 
+async def get_current_user(token_data: TokenData = Depends(get_token_data), db: Session = Depends(get_db)):
+    return _cargar_usuario(db, token_data.id)
+
 async def get_current_active_user(current_user: Usuario = Depends(get_current_user)):
     # Aquí podrías agregar verificaciones adicionales como si el usuario está activo, suspendido, etc.
     return current_user
 
-# Verificar si el usuario es admin
-def is_admin(user: Usuario = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    # Obtener el rol del usuario
-    if user.rol.nombre != "admin":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="No tienes permisos para realizar esta acción"
-        )
-    return user
+def _verificar_rol(token_data: TokenData, db: Session, roles_permitidos):
+    """
+    Autoriza con el rol que viene en el token, salvo que el usuario o los
+    roles hayan cambiado después de emitirlo: entonces se carga el usuario
+    (401 si fue borrado) y se usa su rol actual.
 
-# Verificar si el usuario es tesorero o admin
-def is_tesorero(user: Usuario = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    # Obtener el rol del usuario
-    if user.rol.nombre not in ["admin", "tesorero"]:
+    Los cambios se registran en el proceso que los hace. Los demás procesos
+    de la API siguen aceptando el rol del token hasta que vence, a más
+    tardar en ACCESS_TOKEN_EXPIRE_MINUTES.
+    """
+    rol = token_data.rol
+    if rol is None or _rol_revocado(token_data):
+        # Token sin rol (emitido antes de que lo llevara) o anterior al cambio
+        rol = _cargar_usuario(db, token_data.id).rol.nombre
+    if rol not in roles_permitidos:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tienes permisos para realizar esta acción"
         )
-    return user
+    return token_data
 
+# Verificar si el usuario es admin
+def is_admin(token_data: TokenData = Depends(get_token_data), db: Session = Depends(get_db)):
+    return _verificar_rol(token_data, db, ["admin"])
+
+# Verificar si el usuario es tesorero o admin
+def is_tesorero(token_data: TokenData = Depends(get_token_data), db: Session = Depends(get_db)):
+    return _verificar_rol(token_data, db, ["admin", "tesorero"])
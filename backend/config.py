@@ -1,4 +1,6 @@
 import os
+from datetime import date
+
 from pydantic import BaseSettings
 from dotenv import load_dotenv
 
@@ -13,6 +15,19 @@ class Settings(BaseSettings):
     JWT_SECRET_KEY: str = os.getenv("JWT_SECRET_KEY", "reemplazar_con_clave_secreta")
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+    # Vida de una sesión renovable con /auth/refresh, contada desde el login
+    REFRESH_TOKEN_EXPIRE_HOURS: int = int(os.getenv("REFRESH_TOKEN_EXPIRE_HOURS", "24"))
+    # Contraseñas: costo de bcrypt (los hashes con otro costo se rehacen al
+    # iniciar sesión), procesos del pool de hash y pedidos que pueden estar
+    # en curso o esperando antes de responder 503
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "12"))
+    HASH_PROCESOS: int = int(os.getenv("HASH_PROCESOS", "2"))
+    HASH_MAXIMO_EN_CURSO: int = int(os.getenv("HASH_MAXIMO_EN_CURSO", "16"))
+    HASH_TIMEOUT_SEGUNDOS: int = int(os.getenv("HASH_TIMEOUT_SEGUNDOS", "10"))
+    # Cache de usuarios autenticados: segundos que vale cada entrada (0 la
+    # desactiva) y cantidad máxima de usuarios guardados
+    AUTH_CACHE_TTL_SEGUNDOS: int = int(os.getenv("AUTH_CACHE_TTL_SEGUNDOS", "60"))
+    AUTH_CACHE_MAXIMO: int = int(os.getenv("AUTH_CACHE_MAXIMO", "1000"))
     
     # Database Settings
     POSTGRES_USER: str = os.getenv("POSTGRES_USER", "usuario_bd")
@@ -21,11 +36,48 @@ class Settings(BaseSettings):
     POSTGRES_PORT: str = os.getenv("POSTGRES_PORT", "5432")
     POSTGRES_DB: str = os.getenv("POSTGRES_DB", "nombre_bd")
     
+    # Auditoría: con AUDITORIA_ASINCRONA las filas se escriben en lotes desde
+    # un hilo aparte en vez de ir en la misma transacción que el cambio
+    AUDITORIA_ASINCRONA: bool = os.getenv("AUDITORIA_ASINCRONA", "false").lower() == "true"
+    AUDITORIA_COLA_MAXIMA: int = int(os.getenv("AUDITORIA_COLA_MAXIMA", "10000"))
+    AUDITORIA_TAMANO_LOTE: int = int(os.getenv("AUDITORIA_TAMANO_LOTE", "500"))
+    # Cada proceso usa su propio archivo: auditoria_pendiente.<pid>.jsonl
+    AUDITORIA_ARCHIVO_RESPALDO: str = os.getenv("AUDITORIA_ARCHIVO_RESPALDO", "auditoria_pendiente.jsonl")
+    # Meses de auditoría que quedan en la base; las particiones más viejas se
+    # archivan en AUDITORIA_DIRECTORIO_ARCHIVO con `python archivo_auditoria.py --archivar`
+    AUDITORIA_MESES_ACTIVOS: int = int(os.getenv("AUDITORIA_MESES_ACTIVOS", "24"))
+    AUDITORIA_DIRECTORIO_ARCHIVO: str = os.getenv("AUDITORIA_DIRECTORIO_ARCHIVO", "archivo_auditoria")
+    
+    # Envío de emails y PDFs: hilos que pueden estar enviando a la vez y
+    # segundos de espera máxima al servidor de correo / API de Brevo
+    EMAIL_TRABAJADORES: int = int(os.getenv("EMAIL_TRABAJADORES", "4"))
+    EMAIL_TIMEOUT_SEGUNDOS: int = int(os.getenv("EMAIL_TIMEOUT_SEGUNDOS", "30"))
+    
+    # Hilos para los endpoints sincrónicos de FastAPI (por defecto 40)
+    API_HILOS: int = int(os.getenv("API_HILOS", "40"))
+    # Pool de conexiones por proceso: DB_POOL_SIZE abiertas y hasta
+    # DB_MAX_OVERFLOW más en los picos. Con varios procesos el total tiene que
+    # entrar en max_connections del Postgres del hosting; los hilos que no
+    # consiguen conexión esperan hasta DB_POOL_TIMEOUT (ver /metricas).
+    # DB_POOL_RECYCLE y DB_POOL_PRE_PING evitan usar conexiones que el
+    # Postgres del hosting ya cerró por inactividad.
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_TIMEOUT: int = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    
     # CORS Settings
     CORS_ORIGINS: list = ["*"]
     CORS_METHODS: list = ["*"]
     CORS_HEADERS: list = ["*"]
 
+    def inicio_meses_activos(self, hoy: date = None) -> date:
+        """Primer día del mes de auditoría más viejo que sigue en la base"""
+        hoy = hoy or date.today()
+        meses = hoy.year * 12 + hoy.month - 1 - (self.AUDITORIA_MESES_ACTIVOS - 1)
+        return date(meses // 12, meses % 12 + 1, 1)
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
@@ -1,18 +1,28 @@
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import desc
-from sqlalchemy import func, extract
+from sqlalchemy import func, extract, case, tuple_, literal, update, select, cast, Integer, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from datetime import datetime
 from typing import Optional
 from fastapi import HTTPException
 from typing import List, Optional, Dict, Any
 from decimal import Decimal
+import time
+import base64
+import csv
+import hashlib
+import io
+import json
+import re
+import secrets
 
 
-from datetime import date, datetime, timezone, timedelta
+from datetime import date, datetime, timedelta
 import models
 import schemas
 from audit_middleware import audit_trail
-from auth import get_password_hash
+from auth import get_password_hash, invalidar_principal
+from config import settings
 import models
 # Funciones CRUD para Usuarios
 def create_usuario(db: Session, usuario: schemas.UsuarioCreate):
@@ -24,6 +34,7 @@ def create_usuario(db: Session, usuario: schemas.UsuarioCreate):
         rol_id=usuario.rol_id
     )
     db.add(db_usuario)
+    incrementar_version(db, "usuarios")
     db.commit()
     db.refresh(db_usuario)
     return db_usuario
@@ -46,11 +57,15 @@ def update_usuario(db: Session, usuario_id: int, usuario_update: schemas.Usuario
     
     if "password" in update_data and update_data["password"]:
         update_data["password_hash"] = get_password_hash(update_data.pop("password"))
+        # Con la contraseña nueva hay que volver a iniciar sesión
+        revocar_refresh_tokens(db, usuario_id)
     
     for key, value in update_data.items():
         setattr(db_usuario, key, value)
     
+    incrementar_version(db, "usuarios")
     db.commit()
+    invalidar_principal(usuario_id)
     db.refresh(db_usuario)
     return db_usuario
 
@@ -60,9 +75,79 @@ def delete_usuario(db: Session, usuario_id: int):
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
     db.delete(db_usuario)
+    incrementar_version(db, "usuarios")
     db.commit()
+    invalidar_principal(usuario_id)
     return {"message": "Usuario eliminado exitosamente"}
 
+# Refresh tokens
+def _hash_refresh_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def crear_refresh_token(db: Session, usuario_id: int, familia: str = None, vence: datetime = None) -> str:
+    """
+    Emite un refresh token y devuelve su valor, que no se guarda. Sin
+    familia empieza una sesión nueva, que vence a las
+    REFRESH_TOKEN_EXPIRE_HOURS; las renovaciones heredan familia y vencimiento.
+    """
+    if familia is None:
+        familia = secrets.token_hex(16)
+        vence = datetime.utcnow() + timedelta(hours=settings.REFRESH_TOKEN_EXPIRE_HOURS)
+        # Aprovechar el login para limpiar lo vencido del usuario
+        db.query(models.RefreshToken).filter(
+            models.RefreshToken.usuario_id == usuario_id,
+            models.RefreshToken.vence < datetime.utcnow()
+        ).delete(synchronize_session=False)
+    token = secrets.token_urlsafe(32)
+    db.add(models.RefreshToken(
+        usuario_id=usuario_id,
+        token_hash=_hash_refresh_token(token),
+        familia=familia,
+        vence=vence
+    ))
+    return token
+
+def rotar_refresh_token(db: Session, token: str):
+    """
+    Revoca el refresh token recibido y emite otro de la misma familia.
+    Devuelve (usuario_id, token nuevo). Si el token ya estaba revocado
+    alguien lo está reusando: se revoca la familia entera.
+    """
+    db_token = db.query(models.RefreshToken)\
+        .filter(models.RefreshToken.token_hash == _hash_refresh_token(token))\
+        .with_for_update()\
+        .first()
+    if db_token is None or db_token.vence < datetime.utcnow():
+        raise HTTPException(status_code=401, detail="Sesión vencida, inicie sesión nuevamente")
+    if db_token.revocado:
+        db.query(models.RefreshToken)\
+            .filter(models.RefreshToken.familia == db_token.familia)\
+            .update({models.RefreshToken.revocado: True}, synchronize_session=False)
+        db.commit()
+        raise HTTPException(status_code=401, detail="Sesión revocada, inicie sesión nuevamente")
+    
+    db_token.revocado = True
+    nuevo = crear_refresh_token(db, db_token.usuario_id, familia=db_token.familia, vence=db_token.vence)
+    db.commit()
+    return db_token.usuario_id, nuevo
+
+def revocar_refresh_token(db: Session, token: str):
+    """Cierra la sesión (la familia) a la que pertenece el token"""
+    familia = db.query(models.RefreshToken.familia)\
+        .filter(models.RefreshToken.token_hash == _hash_refresh_token(token))\
+        .scalar()
+    if familia is not None:
+        db.query(models.RefreshToken)\
+            .filter(models.RefreshToken.familia == familia)\
+            .update({models.RefreshToken.revocado: True}, synchronize_session=False)
+        db.commit()
+
+def revocar_refresh_tokens(db: Session, usuario_id: int):
+    """Revoca todas las sesiones del usuario; se confirma con el commit del llamador"""
+    db.query(models.RefreshToken)\
+        .filter(models.RefreshToken.usuario_id == usuario_id, models.RefreshToken.revocado == False)\
+        .update({models.RefreshToken.revocado: True}, synchronize_session=False)
+
 # Funciones CRUD para Roles
 def create_rol(db: Session, rol: schemas.RolCreate):
     db_rol = models.Rol(**rol.dict())
@@ -88,6 +173,8 @@ def update_rol(db: Session, rol_id: int, rol_update: schemas.RolUpdate):
         setattr(db_rol, key, value)
     
     db.commit()
+    # Los usuarios en cache tienen el rol anterior
+    invalidar_principal()
     db.refresh(db_rol)
     return db_rol
 
@@ -106,6 +193,7 @@ def delete_rol(db: Session, rol_id: int):
     
     db.delete(db_rol)
     db.commit()
+    invalidar_principal()
     return {"message": "Rol eliminado exitosamente"}
 
 
@@ -179,50 +267,544 @@ def delete_retencion(db: Session, retencion_id: int):
     db.commit()
     return {"message": "Retención eliminada exitosamente"}
 
+# Versiones por tabla
+def incrementar_version(db: Session, tabla: str):
+    """Marca la tabla como modificada; se confirma junto con la transacción del llamador"""
+    insercion = pg_insert(models.Version).values(tabla=tabla, version=1)
+    db.execute(insercion.on_conflict_do_update(
+        index_elements=["tabla"],
+        set_={"version": models.Version.version + 1}
+    ))
+
+def get_version(db: Session, tabla: str) -> int:
+    version = db.query(models.Version.version).filter(models.Version.tabla == tabla).scalar()
+    return version or 0
+
+def get_etag(db: Session, tablas) -> str:
+    """ETag de un listado: fecha del día más la versión de cada tabla que lo compone"""
+    versiones = dict(
+        db.query(models.Version.tabla, models.Version.version)
+        .filter(models.Version.tabla.in_(tablas))
+        .all()
+    )
+    # La fecha entra porque algunos listados (meses de atraso) dependen del día
+    partes = [date.today().isoformat()] + [f"{t}.{versiones.get(t, 0)}" for t in tablas]
+    return f'W/"{"-".join(partes)}"'
+
+# Numeración de comprobantes
+# Cada serie tiene una fila en secuencias. El número se toma con un UPDATE ...
+# RETURNING dentro de la misma transacción que el documento: la fila queda
+# bloqueada hasta el commit y, si la transacción falla, el número vuelve a
+# quedar libre, así que la numeración no repite ni saltea números.
+SERIE_ORDEN_PAGO = "O.P"
+SERIE_RECIBO = "REC"
+SERIE_CUOTA = "C.S."
+
+def _ultimo_numero_emitido(db: Session, serie: str) -> int:
+    """Último número ya usado antes de que existiera la secuencia"""
+    if serie == SERIE_CUOTA:
+        # Las cuotas arrancaban en 43
+        return db.query(func.max(models.Cuota.nro_comprobante)).scalar() or 42
+    numero = cast(func.substring(models.Partida.recibo_factura, f"^{re.escape(serie)}-([0-9]+)$"), Integer)
+    return db.query(func.max(numero)).filter(
+        models.Partida.recibo_factura.like(f"{serie}-%")
+    ).scalar() or 0
+
+def siguiente_numero(db: Session, serie: str) -> int:
+    """Toma el próximo número de la serie; se confirma con el commit del llamador"""
+    tomar = (
+        update(models.Secuencia)
+        .where(models.Secuencia.serie == serie)
+        .values(ultimo=models.Secuencia.ultimo + 1)
+        .returning(models.Secuencia.ultimo)
+    )
+    numero = db.execute(tomar).scalar()
+    if numero is None:
+        # Primera vez que se usa la serie: arrancar desde el último comprobante existente
+        db.execute(
+            pg_insert(models.Secuencia)
+            .values(serie=serie, ultimo=_ultimo_numero_emitido(db, serie))
+            .on_conflict_do_nothing(index_elements=["serie"])
+        )
+        numero = db.execute(tomar).scalar()
+    return numero
+
+# Solo los recibos de cuota se emiten en lote (create_cuotas_lote); pagos y
+# cobranzas toman su número uno a uno al crearse
+SERIES_RESERVABLES = (SERIE_CUOTA,)
+# Números por reserva: alcanza para una cuota mensual por socio
+MAXIMO_RESERVA = 1000
+
+def _tomar_bloque(db: Session, serie: str, cantidad: int):
+    """Toma `cantidad` números consecutivos de la serie y devuelve (desde, hasta)"""
+    siguiente_numero(db, serie)  # asegura que la serie exista y bloquea su fila
+    hasta = db.execute(
+        update(models.Secuencia)
+        .where(models.Secuencia.serie == serie)
+        .values(ultimo=models.Secuencia.ultimo + cantidad - 1)
+        .returning(models.Secuencia.ultimo)
+    ).scalar()
+    return hasta - cantidad + 1, hasta
+
+def reservar_comprobantes(db: Session, serie: str, cantidad: int, current_user_id: int = None):
+    """Reserva un bloque contiguo de números para emitir documentos en lote"""
+    if serie not in SERIES_RESERVABLES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Solo se pueden reservar números de la serie {', '.join(SERIES_RESERVABLES)}"
+        )
+    if cantidad < 1 or cantidad > MAXIMO_RESERVA:
+        raise HTTPException(status_code=400, detail=f"La cantidad debe estar entre 1 y {MAXIMO_RESERVA}")
+
+    desde, hasta = _tomar_bloque(db, serie, cantidad)
+    reserva = models.ReservaComprobantes(
+        serie=serie,
+        desde=desde,
+        hasta=hasta,
+        siguiente=desde,
+        usuario_id=current_user_id
+    )
+    db.add(reserva)
+    db.commit()
+    db.refresh(reserva)
+    return reserva
+
+def _usar_reserva(db: Session, reserva_id: int, serie: str, cantidad: int) -> List[int]:
+    """Toma los próximos números libres de una reserva abierta"""
+    reserva = db.query(models.ReservaComprobantes).filter(
+        models.ReservaComprobantes.id == reserva_id
+    ).with_for_update().first()
+    if not reserva:
+        raise HTTPException(status_code=404, detail="Reserva no encontrada")
+    if reserva.serie != serie:
+        raise HTTPException(status_code=400, detail=f"La reserva es de la serie {reserva.serie}")
+    if reserva.cerrada:
+        raise HTTPException(status_code=400, detail="La reserva ya fue cerrada")
+    if reserva.hasta - reserva.siguiente + 1 < cantidad:
+        raise HTTPException(status_code=400, detail="La reserva no tiene suficientes números libres")
+
+    numeros = list(range(reserva.siguiente, reserva.siguiente + cantidad))
+    reserva.siguiente += cantidad
+    return numeros
+
+def liberar_reserva(db: Session, reserva_id: int):
+    """
+    Cierra una reserva. Los números sin usar vuelven a la serie si nadie tomó
+    otros después; si no, quedan registrados como anulados.
+    """
+    reserva = db.query(models.ReservaComprobantes).filter(
+        models.ReservaComprobantes.id == reserva_id
+    ).with_for_update().first()
+    if not reserva:
+        raise HTTPException(status_code=404, detail="Reserva no encontrada")
+    if reserva.cerrada:
+        raise HTTPException(status_code=400, detail="La reserva ya fue cerrada")
+
+    # Números sin usar, como rango [desde, hasta]
+    sin_usar = None
+    if reserva.siguiente <= reserva.hasta:
+        sin_usar = {"desde": reserva.siguiente, "hasta": reserva.hasta}
+    devueltos = anulados = None
+    if sin_usar:
+        secuencia = db.query(models.Secuencia).filter(
+            models.Secuencia.serie == reserva.serie
+        ).with_for_update().one()
+        if secuencia.ultimo == reserva.hasta:
+            # El bloque es lo último emitido: la serie retrocede y no quedan huecos
+            secuencia.ultimo = reserva.siguiente - 1
+            devueltos = sin_usar
+        else:
+            reserva.anulado_desde = reserva.siguiente
+            reserva.anulado_hasta = reserva.hasta
+            anulados = sin_usar
+
+    reserva.cerrada = True
+    db.commit()
+    return {"reserva_id": reserva.id, "serie": reserva.serie, "devueltos": devueltos, "anulados": anulados}
+
+# Último usuario que tocó cada registro
+# Los listados muestran quién hizo el último cambio de cada fila. DISTINCT ON
+# devuelve una sola fila de auditoría por registro, leída del índice
+# (tabla_afectada, registro_id, fecha desc) que ya incluye usuario_id.
+# Solo se miran los meses activos, así el planner descarta las particiones viejas.
+
+def get_ultimos_actores(db: Session, tabla_afectada: str, registro_ids) -> Dict[int, str]:
+    """Nombre del último usuario de auditoría para cada registro_id"""
+    registro_ids = list(registro_ids)
+    if not registro_ids:
+        return {}
+    ultimos = db.query(models.Auditoria.registro_id, models.Auditoria.usuario_id)\
+        .filter(
+            models.Auditoria.tabla_afectada == tabla_afectada,
+            models.Auditoria.registro_id.in_(registro_ids),
+            models.Auditoria.fecha >= settings.inicio_meses_activos()
+        )\
+        .distinct(models.Auditoria.registro_id)\
+        .order_by(models.Auditoria.registro_id, models.Auditoria.fecha.desc())\
+        .subquery()
+    filas = db.query(ultimos.c.registro_id, models.Usuario.nombre)\
+        .outerjoin(models.Usuario, models.Usuario.id == ultimos.c.usuario_id)
+    return {registro_id: nombre or 'Sin usuario' for registro_id, nombre in filas}
+
+def agregar_usuario_auditoria(db: Session, tabla_afectada: str, registros):
+    """Completa usuario_auditoria en objetos o diccionarios con id"""
+    es_dict = bool(registros) and isinstance(registros[0], dict)
+    ids = [r["id"] if es_dict else r.id for r in registros]
+    actores = get_ultimos_actores(db, tabla_afectada, ids)
+    for registro, registro_id in zip(registros, ids):
+        nombre = actores.get(registro_id, 'Sin registro')
+        if es_dict:
+            registro["usuario_auditoria"] = nombre
+        else:
+            registro.usuario_auditoria = nombre
+    return registros
+
+# Paginación por cursor
+# Los listados se ordenan por (fecha desc, id desc). El cursor codifica la
+# última fila devuelta y la página siguiente arranca justo después de ella
+# usando el índice (fecha, id), sin recorrer las filas anteriores como offset.
+def codificar_cursor(fecha, registro_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{fecha.isoformat()},{registro_id}".encode()).decode()
+
+def decodificar_cursor(cursor: str):
+    try:
+        fecha, registro_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+        # Auditoría ordena por fecha y hora; el resto de los listados, por fecha
+        fecha = datetime.fromisoformat(fecha) if "T" in fecha else date.fromisoformat(fecha)
+        return fecha, int(registro_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def paginar(query, modelo, skip: int = 0, limit: int = 100, after: Optional[str] = None):
+    """Aplica el orden (fecha desc, id desc) y la página: por cursor si hay after, si no por skip"""
+    query = query.order_by(modelo.fecha.desc(), modelo.id.desc())
+    if after:
+        fecha, registro_id = decodificar_cursor(after)
+        query = query.filter(tuple_(modelo.fecha, modelo.id) < tuple_(literal(fecha), literal(registro_id)))
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
+
+def siguiente_cursor(items, limit: int) -> Optional[str]:
+    """Cursor de la página siguiente, o None si esta fue la última"""
+    if not items or len(items) < limit:
+        return None
+    ultimo = items[-1]
+    if isinstance(ultimo, dict):
+        return codificar_cursor(ultimo["fecha"], ultimo["id"])
+    return codificar_cursor(ultimo.fecha, ultimo.id)
+
+# Libro diario: cabecera de saldos
+# Cada cuenta tiene una fila en saldos_cuenta con su saldo vigente, y la fila
+# CUENTA_LIBRO lleva el saldo del libro diario completo (el que se guarda en
+# Partida.saldo). Toda partida nueva bloquea esas filas antes de calcular su
+# saldo, así dos cajeros que registran a la vez quedan serializados.
+CUENTA_LIBRO = "LIBRO_DIARIO"
+
+def efecto_partida(tipo: str, monto) -> Decimal:
+    """Devuelve cuánto mueve una partida el saldo según su tipo"""
+    if tipo == "ingreso":
+        return Decimal(str(monto))
+    if tipo == "egreso":
+        return -Decimal(str(monto))
+    return Decimal("0")
+
+def _bloquear_saldo_cuenta(db: Session, cuenta: str) -> models.SaldoCuenta:
+    cabecera = db.query(models.SaldoCuenta).filter(
+        models.SaldoCuenta.cuenta == cuenta
+    ).with_for_update().first()
+    if cabecera:
+        return cabecera
+
+    # Primera vez que se usa la cuenta: inicializar con la suma de sus partidas
+    efecto = case(
+        (models.Partida.tipo == "ingreso", models.Partida.monto),
+        (models.Partida.tipo == "egreso", -models.Partida.monto),
+        else_=0
+    )
+    query = db.query(func.coalesce(func.sum(efecto), 0))
+    if cuenta != CUENTA_LIBRO:
+        query = query.filter(models.Partida.cuenta == cuenta)
+    saldo_inicial = query.scalar()
+
+    creada = db.execute(
+        pg_insert(models.SaldoCuenta)
+        .values(cuenta=cuenta, saldo=saldo_inicial)
+        .on_conflict_do_nothing(index_elements=["cuenta"])
+    ).rowcount
+    if creada:
+        # Los puntos de control mensuales y el saldo por cuenta nacen junto con la cabecera
+        _reconstruir_saldos_mensuales(db, cuenta)
+        if cuenta == CUENTA_LIBRO:
+            # Primer uso del libro: dar de alta las cuentas que ya tienen partidas
+            for (otra,) in db.query(models.Partida.cuenta).distinct().order_by(models.Partida.cuenta).all():
+                if otra != CUENTA_LIBRO:
+                    _bloquear_saldo_cuenta(db, otra)
+        else:
+            _reconstruir_saldos_en_cuenta(db, cuenta)
+    return db.query(models.SaldoCuenta).filter(
+        models.SaldoCuenta.cuenta == cuenta
+    ).with_for_update().one()
+
+def _reconstruir_saldos_en_cuenta(db: Session, cuenta: str):
+    """Recalcula Partida.saldo_cuenta para las partidas de una sola cuenta"""
+    efecto = case(
+        (models.Partida.tipo == "ingreso", models.Partida.monto),
+        (models.Partida.tipo == "egreso", -models.Partida.monto),
+        else_=0
+    )
+    acumulado = db.query(
+        models.Partida.id.label("id"),
+        func.sum(efecto).over(order_by=(models.Partida.fecha, models.Partida.id)).label("saldo_cuenta")
+    ).filter(models.Partida.cuenta == cuenta).subquery()
+    db.execute(
+        update(models.Partida)
+        .where(
+            models.Partida.id == acumulado.c.id,
+            models.Partida.saldo_cuenta.is_distinct_from(acumulado.c.saldo_cuenta)
+        )
+        .values(saldo_cuenta=acumulado.c.saldo_cuenta)
+        .execution_options(synchronize_session=False)
+    )
+
+def _reconstruir_saldos_mensuales(db: Session, cuenta: str):
+    anio = cast(extract('year', models.Partida.fecha), Integer)
+    mes = cast(extract('month', models.Partida.fecha), Integer)
+    por_mes = db.query(
+        anio.label("anio"),
+        mes.label("mes"),
+        func.coalesce(func.sum(case((models.Partida.tipo == "ingreso", models.Partida.monto), else_=0)), 0).label("ingresos"),
+        func.coalesce(func.sum(case((models.Partida.tipo == "egreso", models.Partida.monto), else_=0)), 0).label("egresos")
+    )
+    if cuenta != CUENTA_LIBRO:
+        por_mes = por_mes.filter(models.Partida.cuenta == cuenta)
+    por_mes = por_mes.group_by(anio, mes).subquery()
+
+    acumulado = func.sum(por_mes.c.ingresos - por_mes.c.egresos).over(
+        order_by=(por_mes.c.anio, por_mes.c.mes)
+    )
+    filas = select(
+        literal(cuenta),
+        por_mes.c.anio,
+        por_mes.c.mes,
+        acumulado - por_mes.c.ingresos + por_mes.c.egresos,
+        por_mes.c.ingresos,
+        por_mes.c.egresos,
+        acumulado
+    )
+
+    db.query(models.SaldoMensual).filter(models.SaldoMensual.cuenta == cuenta).delete(synchronize_session=False)
+    db.execute(
+        pg_insert(models.SaldoMensual).from_select(
+            ["cuenta", "anio", "mes", "saldo_inicial", "ingresos", "egresos", "saldo_final"], filas
+        )
+    )
+
+def _acumular_mes(db: Session, cuenta: str, fecha, efecto: Decimal, signo: int):
+    if not efecto:
+        return
+    ingresos = (efecto if efecto > 0 else Decimal("0")) * signo
+    egresos = (-efecto if efecto < 0 else Decimal("0")) * signo
+    periodo = tuple_(models.SaldoMensual.anio, models.SaldoMensual.mes)
+    mes_actual = tuple_(literal(fecha.year), literal(fecha.month))
+
+    # Si el mes no tiene punto de control, arranca con el cierre del mes anterior
+    saldo_inicial = func.coalesce(
+        db.query(models.SaldoMensual.saldo_final).filter(
+            models.SaldoMensual.cuenta == cuenta,
+            periodo < mes_actual
+        ).order_by(models.SaldoMensual.anio.desc(), models.SaldoMensual.mes.desc()).limit(1).scalar_subquery(),
+        0
+    )
+    insercion = pg_insert(models.SaldoMensual).values(
+        cuenta=cuenta,
+        anio=fecha.year,
+        mes=fecha.month,
+        saldo_inicial=saldo_inicial,
+        ingresos=ingresos,
+        egresos=egresos,
+        saldo_final=saldo_inicial + ingresos - egresos
+    )
+    db.execute(insercion.on_conflict_do_update(
+        index_elements=["cuenta", "anio", "mes"],
+        set_={
+            "ingresos": models.SaldoMensual.ingresos + insercion.excluded.ingresos,
+            "egresos": models.SaldoMensual.egresos + insercion.excluded.egresos,
+            "saldo_final": models.SaldoMensual.saldo_final + insercion.excluded.ingresos - insercion.excluded.egresos
+        }
+    ))
+
+    # Los meses siguientes arrastran la diferencia
+    db.query(models.SaldoMensual).filter(
+        models.SaldoMensual.cuenta == cuenta,
+        periodo > mes_actual
+    ).update({
+        models.SaldoMensual.saldo_inicial: models.SaldoMensual.saldo_inicial + efecto * signo,
+        models.SaldoMensual.saldo_final: models.SaldoMensual.saldo_final + efecto * signo
+    }, synchronize_session=False)
+
+def _acumular_en_meses(db: Session, cuenta: str, fecha, efecto: Decimal, signo: int = 1):
+    """Suma (signo=1) o resta (signo=-1) una partida de los puntos de control de su cuenta y del libro"""
+    _acumular_mes(db, CUENTA_LIBRO, fecha, efecto, signo)
+    if cuenta != CUENTA_LIBRO:
+        _acumular_mes(db, cuenta, fecha, efecto, signo)
+
+def registrar_partida(db: Session, partida: models.Partida) -> models.Partida:
+    """
+    Calcula el saldo de una partida nueva y la agrega a la sesión.
+    Las cabeceras quedan bloqueadas hasta que el llamador haga commit.
+    """
+    efecto = efecto_partida(partida.tipo, partida.monto)
+
+    # Siempre en el mismo orden (libro y luego cuenta) para evitar deadlocks
+    libro = _bloquear_saldo_cuenta(db, CUENTA_LIBRO)
+    libro.saldo = libro.saldo + efecto
+    cabecera = libro
+    if partida.cuenta != CUENTA_LIBRO:
+        cabecera = _bloquear_saldo_cuenta(db, partida.cuenta)
+        cabecera.saldo = cabecera.saldo + efecto
+
+    incrementar_version(db, "partidas")
+    partida.saldo = libro.saldo
+    partida.saldo_cuenta = cabecera.saldo
+
+    # Partida con fecha atrasada: las de fechas posteriores arrastran su efecto
+    # y el saldo propio sale de la partida inmediatamente anterior
+    posteriores = db.query(models.Partida).filter(models.Partida.fecha > partida.fecha)
+    if efecto:
+        hay_posteriores = posteriores.update({
+            models.Partida.saldo: models.Partida.saldo + efecto,
+            models.Partida.saldo_cuenta: models.Partida.saldo_cuenta
+            + case((models.Partida.cuenta == partida.cuenta, efecto), else_=0)
+        }, synchronize_session=False)
+    else:
+        hay_posteriores = db.query(posteriores.exists()).scalar()
+    if hay_posteriores:
+        anterior = db.query(models.Partida.saldo).filter(
+            models.Partida.fecha <= partida.fecha
+        ).order_by(models.Partida.fecha.desc(), models.Partida.id.desc())
+        saldo_previo = anterior.limit(1).scalar()
+        saldo_previo_cuenta = anterior.with_entities(models.Partida.saldo_cuenta).filter(
+            models.Partida.cuenta == partida.cuenta
+        ).limit(1).scalar()
+        partida.saldo = (saldo_previo or Decimal("0")) + efecto
+        partida.saldo_cuenta = (saldo_previo_cuenta or Decimal("0")) + efecto
+
+    _acumular_en_meses(db, partida.cuenta, partida.fecha, efecto)
+    db.add(partida)
+    return partida
+
+def _bloquear_cabeceras(db: Session, cuentas) -> Dict[str, models.SaldoCuenta]:
+    cabeceras = {CUENTA_LIBRO: _bloquear_saldo_cuenta(db, CUENTA_LIBRO)}
+    for cuenta in sorted(set(cuentas) - {CUENTA_LIBRO}):
+        cabeceras[cuenta] = _bloquear_saldo_cuenta(db, cuenta)
+    return cabeceras
+
+def reubicar_partida(db: Session, partida: models.Partida, fecha_anterior, efecto_anterior: Decimal, cuenta_anterior: str):
+    """
+    Ajusta los saldos después de modificar una partida ya registrada.
+    Recibe la fecha, el efecto y la cuenta que tenía antes del cambio; las
+    partidas posteriores se corrigen con un único UPDATE sobre el rango afectado.
+    """
+    incrementar_version(db, "partidas")
+    efecto_nuevo = efecto_partida(partida.tipo, partida.monto)
+    pos_anterior = (fecha_anterior, partida.id)
+    pos_nueva = (partida.fecha, partida.id)
+
+    if efecto_nuevo == efecto_anterior and pos_anterior == pos_nueva and cuenta_anterior == partida.cuenta:
+        return partida
+
+    cabeceras = _bloquear_cabeceras(db, [cuenta_anterior, partida.cuenta])
+    cabeceras[CUENTA_LIBRO].saldo += efecto_nuevo - efecto_anterior
+    if cuenta_anterior != CUENTA_LIBRO:
+        cabeceras[cuenta_anterior].saldo -= efecto_anterior
+    if partida.cuenta != CUENTA_LIBRO:
+        cabeceras[partida.cuenta].saldo += efecto_nuevo
+    _acumular_en_meses(db, cuenta_anterior, fecha_anterior, efecto_anterior, -1)
+    _acumular_en_meses(db, partida.cuenta, partida.fecha, efecto_nuevo)
+
+    posicion = tuple_(models.Partida.fecha, models.Partida.id)
+    if pos_anterior == pos_nueva and cuenta_anterior == partida.cuenta:
+        delta = efecto_nuevo - efecto_anterior
+        db.query(models.Partida).filter(
+            posicion > tuple_(literal(partida.fecha), literal(partida.id))
+        ).update({
+            models.Partida.saldo: models.Partida.saldo + delta,
+            models.Partida.saldo_cuenta: models.Partida.saldo_cuenta
+            + case((models.Partida.cuenta == partida.cuenta, delta), else_=0)
+        }, synchronize_session=False)
+        partida.saldo = partida.saldo + delta
+        if partida.saldo_cuenta is not None:
+            partida.saldo_cuenta = partida.saldo_cuenta + delta
+        return partida
+
+    # La partida cambió de fecha o de cuenta: se quita su efecto anterior y se
+    # aplica el nuevo, cada uno desde su posición, en una sola pasada
+    desde = min(pos_anterior, pos_nueva)
+    despues_anterior = posicion > tuple_(literal(pos_anterior[0]), literal(pos_anterior[1]))
+    despues_nueva = posicion > tuple_(literal(pos_nueva[0]), literal(pos_nueva[1]))
+    db.query(models.Partida).filter(
+        posicion > tuple_(literal(desde[0]), literal(desde[1])),
+        models.Partida.id != partida.id
+    ).update({
+        models.Partida.saldo: models.Partida.saldo
+        - case((despues_anterior, efecto_anterior), else_=0)
+        + case((despues_nueva, efecto_nuevo), else_=0),
+        models.Partida.saldo_cuenta: models.Partida.saldo_cuenta
+        - case((and_(models.Partida.cuenta == cuenta_anterior, despues_anterior), efecto_anterior), else_=0)
+        + case((and_(models.Partida.cuenta == partida.cuenta, despues_nueva), efecto_nuevo), else_=0)
+    }, synchronize_session=False)
+
+    # La fila propia sigue en la base con la fecha anterior (sin autoflush)
+    anterior = db.query(models.Partida.saldo).filter(
+        posicion < tuple_(literal(partida.fecha), literal(partida.id)),
+        models.Partida.id != partida.id
+    ).order_by(models.Partida.fecha.desc(), models.Partida.id.desc())
+    saldo_previo = anterior.limit(1).scalar()
+    saldo_previo_cuenta = anterior.with_entities(models.Partida.saldo_cuenta).filter(
+        models.Partida.cuenta == partida.cuenta
+    ).limit(1).scalar()
+    partida.saldo = (saldo_previo or Decimal("0")) + efecto_nuevo
+    partida.saldo_cuenta = (saldo_previo_cuenta or Decimal("0")) + efecto_nuevo
+    return partida
+
+def quitar_partida(db: Session, partida: models.Partida):
+    """Elimina una partida y descuenta su efecto de las posteriores con un único UPDATE"""
+    incrementar_version(db, "partidas")
+    efecto = efecto_partida(partida.tipo, partida.monto)
+    if efecto:
+        cabeceras = _bloquear_cabeceras(db, [partida.cuenta])
+        cabeceras[CUENTA_LIBRO].saldo -= efecto
+        if partida.cuenta != CUENTA_LIBRO:
+            cabeceras[partida.cuenta].saldo -= efecto
+        _acumular_en_meses(db, partida.cuenta, partida.fecha, efecto, -1)
+
+        db.query(models.Partida).filter(
+            tuple_(models.Partida.fecha, models.Partida.id) > tuple_(literal(partida.fecha), literal(partida.id))
+        ).update({
+            models.Partida.saldo: models.Partida.saldo - efecto,
+            models.Partida.saldo_cuenta: models.Partida.saldo_cuenta
+            - case((models.Partida.cuenta == partida.cuenta, efecto), else_=0)
+        }, synchronize_session=False)
+
+    db.delete(partida)
+
 # Funciones CRUD para Pagos
 @audit_trail("pagos")
 def create_pago(db: Session, pago: schemas.PagoCreate, current_user_id: int):
     # Imprimir para depuración
     print(f"Tipo de documento recibido: {pago.tipo_documento}")
     
-    # Crear el pago
+    # Crear el pago (el commit se hace junto con la partida)
     db_pago = models.Pago(**pago.dict())
     db.add(db_pago)
-    db.commit()
-    db.refresh(db_pago)
-    
+    db.flush()
+
     # Obtener información del usuario para el detalle
     usuario = db.query(models.Usuario).filter(models.Usuario.id == db_pago.usuario_id).first()
     nombre_usuario = usuario.nombre if usuario else "Usuario desconocido"
-    
-    # Obtener la última partida para calcular el saldo
-    ultima_partida = db.query(models.Partida).order_by(models.Partida.id.desc()).first()
-    saldo_anterior = ultima_partida.saldo if ultima_partida else 0
-    nuevo_saldo = saldo_anterior - db_pago.monto
-    
-    # NUEVA LÓGICA: Generar número de recibo/factura según tipo de documento
-    if db_pago.tipo_documento == "factura":
-        # Para facturas, usar el formato FAC-
-        recibo_factura = f"FAC/REC.A-{db_pago.numero_factura}"
-    else:
-        # Para órdenes de pago, buscar la última y generar el siguiente número
-        ultima_orden_pago = db.query(models.Partida).filter(
-            models.Partida.recibo_factura.like("O.P-%")
-        ).order_by(models.Partida.id.desc()).first()
-        
-        if ultima_orden_pago and ultima_orden_pago.recibo_factura:
-            # Extraer el número de la última orden de pago
-            try:
-                ultimo_num = int(ultima_orden_pago.recibo_factura.split('-')[1])
-                nuevo_num = ultimo_num + 1
-            except (ValueError, IndexError):
-                nuevo_num = 1
-        else:
-            nuevo_num = 1
-        
-        recibo_factura = f"O.P-{nuevo_num}"
-    
-    # Crear partida asociada al pago (egreso)
+
+    # Crear partida asociada al pago (egreso); el saldo se calcula bajo el bloqueo del libro
     partida = models.Partida(
         fecha=db_pago.fecha,
         detalle=f"Pago {nombre_usuario}",
@@ -231,13 +813,23 @@ def create_pago(db: Session, pago: schemas.PagoCreate, current_user_id: int):
         cuenta="CAJA",
         usuario_id=current_user_id,  # Usuario que realiza la acción
         pago_id=db_pago.id,
-        saldo=nuevo_saldo,
         ingreso=0,
-        egreso=db_pago.monto,
-        recibo_factura=recibo_factura  # IMPORTANTE: Asignar el número de comprobante generado
+        egreso=db_pago.monto
     )
-    db.add(partida)
+    registrar_partida(db, partida)
+
+    # NUEVA LÓGICA: Generar número de recibo/factura según tipo de documento
+    if db_pago.tipo_documento == "factura":
+        # Para facturas, usar el formato FAC-
+        recibo_factura = f"FAC/REC.A-{db_pago.numero_factura}"
+    else:
+        # Para órdenes de pago, tomar el siguiente número de la serie
+        recibo_factura = f"{SERIE_ORDEN_PAGO}-{siguiente_numero(db, SERIE_ORDEN_PAGO)}"
+
+    partida.recibo_factura = recibo_factura  # IMPORTANTE: Asignar el número de comprobante generado
+    incrementar_version(db, "pagos")
     db.commit()
+    db.refresh(db_pago)
     
     # Comprobar si es una orden de pago (no una factura)
     enviar_email = (db_pago.tipo_documento == "orden_pago")
@@ -274,6 +866,7 @@ def create_pago(db: Session, pago: schemas.PagoCreate, current_user_id: int):
                         db_pago.email_enviado = True
                         db_pago.fecha_envio_email = datetime.now()
                         db_pago.email_destinatario = usuario.email
+                        incrementar_version(db, "pagos")
                         db.commit()
                         db.refresh(db_pago)
                         print(f"Orden de pago enviada por email a {usuario.email}")
@@ -328,20 +921,19 @@ def reenviar_orden_pago(db: Session, pago_id: int, email: str = None, current_us
         db_pago.email_enviado = True
         db_pago.fecha_envio_email = datetime.now()
         db_pago.email_destinatario = recipient_email
+        incrementar_version(db, "pagos")
         db.commit()
         db.refresh(db_pago)
         return {"success": True, "message": "Orden de pago enviada exitosamente"}
     else:
         return {"success": False, "message": message}
 
-@audit_trail("pagos")
-def get_pagos(db: Session, skip: int = 0, limit: int = 100,):
+def get_pagos(db: Session, skip: int = 0, limit: int = 100, after: Optional[str] = None):
     
-    pagos = db.query(models.Pago).order_by(desc(models.Pago.fecha)).offset(skip).limit(limit).all()
+    pagos = paginar(db.query(models.Pago), models.Pago, skip=skip, limit=limit, after=after)
     
     return pagos
 
-@audit_trail("pagos")
 def get_pago(db: Session, pago_id: int, current_user_id: int = None):
     pago = db.query(models.Pago).filter(models.Pago.id == pago_id).first()
     return pago
@@ -353,20 +945,19 @@ def update_pago(db: Session, pago_id: int, pago_update: schemas.PagoUpdate, curr
     if not db_pago:
         raise HTTPException(status_code=404, detail="Pago no encontrado")
     
-    # Guardar monto anterior para comparar
-    monto_anterior = db_pago.monto
-    
     update_data = pago_update.dict(exclude_unset=True)
     
     for key, value in update_data.items():
         setattr(db_pago, key, value)
     
-    db.commit()
-    db.refresh(db_pago)
-    
     # Actualizar partida asociada
     partida = db.query(models.Partida).filter(models.Partida.pago_id == pago_id).first()
     if partida:
+        # Guardar la posición y el efecto anteriores para ajustar los saldos
+        fecha_anterior = partida.fecha
+        efecto_anterior = efecto_partida(partida.tipo, partida.monto)
+        cuenta_anterior = partida.cuenta
+
         partida.fecha = db_pago.fecha
         
         # Obtener nombre de usuario
@@ -377,29 +968,13 @@ def update_pago(db: Session, pago_id: int, pago_update: schemas.PagoUpdate, curr
         partida.monto = db_pago.monto
         partida.egreso = db_pago.monto
         partida.usuario_id = db_pago.usuario_id
-        db.commit()
-        
-        # Si el monto cambió, recalcular los saldos de todas las partidas posteriores
-        if abs(monto_anterior - db_pago.monto) > 0.01:
-            partidas_posteriores = db.query(models.Partida).filter(
-                models.Partida.fecha >= partida.fecha,
-                models.Partida.id != partida.id
-            ).order_by(models.Partida.fecha, models.Partida.id).all()
-            
-            # Obtener saldo actualizado para esta partida
-            saldo_actual = partida.saldo
-            
-            # Actualizar saldos para todas las partidas posteriores
-            for p in partidas_posteriores:
-                if p.tipo == "ingreso":
-                    saldo_actual += p.monto
-                else:  # egreso
-                    saldo_actual -= p.monto
-                
-                p.saldo = saldo_actual
-            
-            db.commit()
+
+        # Si cambió el monto o la fecha, corregir los saldos posteriores
+        reubicar_partida(db, partida, fecha_anterior, efecto_anterior, cuenta_anterior)
     
+    incrementar_version(db, "pagos")
+    db.commit()
+    db.refresh(db_pago)
     return db_pago
 @audit_trail("pagos")
 def delete_pago(db: Session, pago_id: int, current_user_id: int = None):
@@ -407,47 +982,18 @@ def delete_pago(db: Session, pago_id: int, current_user_id: int = None):
     if not db_pago:
         raise HTTPException(status_code=404, detail="Pago no encontrado")
     
-    # Guardar fecha y monto del pago para recalcular saldos después
-    fecha_pago = db_pago.fecha
-    monto_pago = db_pago.monto
-    
     # Encontrar la partida asociada
     partida = db.query(models.Partida).filter(models.Partida.pago_id == pago_id).first()
     
-    # Eliminar partida asociada
+    # Eliminar partida asociada y descontarla de los saldos posteriores
     if partida:
-        db.delete(partida)
+        quitar_partida(db, partida)
     
     # Eliminar el pago
     db.delete(db_pago)
+    incrementar_version(db, "pagos")
     db.commit()
     
-    # Recalcular saldos de todas las partidas posteriores a la fecha del pago eliminado
-    partidas_posteriores = db.query(models.Partida).filter(
-        models.Partida.fecha >= fecha_pago
-    ).order_by(models.Partida.fecha, models.Partida.id).all()
-    
-    # Si hay partidas posteriores, recalcular saldos
-    if partidas_posteriores:
-        # Obtener el saldo anterior a la partida eliminada
-        partida_anterior = db.query(models.Partida).filter(
-            models.Partida.fecha < fecha_pago
-        ).order_by(models.Partida.fecha.desc(), models.Partida.id.desc()).first()
-        
-        saldo_inicial = partida_anterior.saldo if partida_anterior else 0
-        
-        # Recalcular saldos para todas las partidas posteriores
-        saldo_actual = saldo_inicial
-        for p in partidas_posteriores:
-            if p.tipo == "ingreso":
-                saldo_actual += p.monto
-            else:  # egreso
-                saldo_actual -= p.monto
-            
-            p.saldo = saldo_actual
-        
-        db.commit()
-    
     return {"message": "Pago eliminado exitosamente"}
 
 # Añadir función para reenviar recibos
@@ -494,6 +1040,7 @@ def reenviar_recibo(db: Session, cobranza_id: int, email: str = None , current_u
         db_cobranza.email_enviado = True
         db_cobranza.fecha_envio_email = datetime.now()
         db_cobranza.email_destinatario = recipient_email
+        incrementar_version(db, "cobranzas")
         db.commit()
         db.refresh(db_cobranza)
         return {"success": True, "message": "Recibo enviado exitosamente"}
@@ -511,38 +1058,12 @@ def create_cobranza(db: Session, cobranza: schemas.CobranzaCreate, current_user_
     # Imprimir para depuración
     print(f"Tipo de documento recibido: {cobranza.tipo_documento}")
     
+    # Crear la cobranza (el commit se hace junto con la partida)
     db_cobranza = models.Cobranza(**cobranza.dict())
     db.add(db_cobranza)
-    db.commit()
-    db.refresh(db_cobranza)
-    
-    # Obtener la última partida para calcular el saldo
-    ultima_partida = db.query(models.Partida).order_by(models.Partida.id.desc()).first()
-    saldo_anterior = ultima_partida.saldo if ultima_partida else 0
-    nuevo_saldo = saldo_anterior + db_cobranza.monto
-    
-    # NUEVA LÓGICA: Generar número de recibo/factura según tipo de documento
-    if db_cobranza.tipo_documento == "factura":
-        # Para facturas, usar el formato FAC-X
-        recibo_factura = f"FAC/REC.A-{db_cobranza.numero_factura}"
-    else:
-        # Para recibos de cobranza, buscar el último y generar el siguiente número
-        ultimo_recibo = db.query(models.Partida).filter(
-            models.Partida.recibo_factura.like("REC-%")
-        ).order_by(models.Partida.id.desc()).first()
-        
-        if ultimo_recibo and ultimo_recibo.recibo_factura:
-            # Extraer el número del último recibo
-            try:
-                ultimo_num = int(ultimo_recibo.recibo_factura.split('-')[1])
-                nuevo_num = ultimo_num + 1
-            except (ValueError, IndexError):
-                nuevo_num = 1
-        else:
-            nuevo_num = 1
-        
-        recibo_factura = f"REC-{nuevo_num}"
-    
+    db.flush()
+
+    # Crear partida asociada (ingreso); el saldo se calcula bajo el bloqueo del libro
     partida = models.Partida(
         fecha=db_cobranza.fecha,
         detalle=f"Cobranza - {db.query(models.Usuario).filter(models.Usuario.id == db_cobranza.usuario_id).first().nombre}",
@@ -551,13 +1072,23 @@ def create_cobranza(db: Session, cobranza: schemas.CobranzaCreate, current_user_
         cuenta="CAJA",
         usuario_id=current_user_id,  # Usuario que REALIZA la acción
         cobranza_id=db_cobranza.id,
-        saldo=nuevo_saldo,
         ingreso=db_cobranza.monto,
-        egreso=0,
-        recibo_factura=recibo_factura  # IMPORTANTE: Asignar el número de comprobante generado
+        egreso=0
     )
-    db.add(partida)
+    registrar_partida(db, partida)
+
+    # NUEVA LÓGICA: Generar número de recibo/factura según tipo de documento
+    if db_cobranza.tipo_documento == "factura":
+        # Para facturas, usar el formato FAC-X
+        recibo_factura = f"FAC/REC.A-{db_cobranza.numero_factura}"
+    else:
+        # Para recibos de cobranza, tomar el siguiente número de la serie
+        recibo_factura = f"{SERIE_RECIBO}-{siguiente_numero(db, SERIE_RECIBO)}"
+
+    partida.recibo_factura = recibo_factura  # IMPORTANTE: Asignar el número de comprobante generado
+    incrementar_version(db, "cobranzas")
     db.commit()
+    db.refresh(db_cobranza)
     
     # Comprobar si es un recibo (no una factura)
     enviar_email = (db_cobranza.tipo_documento == "recibo")
@@ -597,6 +1128,7 @@ def create_cobranza(db: Session, cobranza: schemas.CobranzaCreate, current_user_
                         db_cobranza.email_enviado = True
                         db_cobranza.fecha_envio_email = datetime.now()
                         db_cobranza.email_destinatario = usuario.email
+                        incrementar_version(db, "cobranzas")
                         db.commit()
                         db.refresh(db_cobranza)
                         print(f"Recibo enviado por email a {usuario.email}")
@@ -613,20 +1145,19 @@ def update_cobranza(db: Session, cobranza_id: int, cobranza_update: schemas.Cobr
     if not db_cobranza:
         raise HTTPException(status_code=404, detail="Cobranza no encontrada")
     
-    # Guardar monto anterior para comparar
-    monto_anterior = db_cobranza.monto
-    
     update_data = cobranza_update.dict(exclude_unset=True)
     
     for key, value in update_data.items():
         setattr(db_cobranza, key, value)
     
-    db.commit()
-    db.refresh(db_cobranza)
-    
     # Actualizar partida asociada
     partida = db.query(models.Partida).filter(models.Partida.cobranza_id == cobranza_id).first()
     if partida:
+        # Guardar la posición y el efecto anteriores para ajustar los saldos
+        fecha_anterior = partida.fecha
+        efecto_anterior = efecto_partida(partida.tipo, partida.monto)
+        cuenta_anterior = partida.cuenta
+
         partida.fecha = db_cobranza.fecha
         
         # Obtener nombre de usuario
@@ -637,35 +1168,19 @@ def update_cobranza(db: Session, cobranza_id: int, cobranza_update: schemas.Cobr
         partida.monto = db_cobranza.monto
         partida.ingreso = db_cobranza.monto
         partida.usuario_id = db_cobranza.usuario_id
-        db.commit()
-        
-        # Si el monto cambió, recalcular los saldos de todas las partidas posteriores
-        if abs(monto_anterior - db_cobranza.monto) > 0.01:
-            partidas_posteriores = db.query(models.Partida).filter(
-                models.Partida.fecha >= partida.fecha,
-                models.Partida.id != partida.id
-            ).order_by(models.Partida.fecha, models.Partida.id).all()
-            
-            # Obtener saldo actualizado para esta partida
-            saldo_actual = partida.saldo
-            
-            # Actualizar saldos para todas las partidas posteriores
-            for p in partidas_posteriores:
-                if p.tipo == "ingreso":
-                    saldo_actual += p.monto
-                else:  # egreso
-                    saldo_actual -= p.monto
-                
-                p.saldo = saldo_actual
-            
-            db.commit()
+
+        # Si cambió el monto o la fecha, corregir los saldos posteriores
+        reubicar_partida(db, partida, fecha_anterior, efecto_anterior, cuenta_anterior)
     
+    incrementar_version(db, "cobranzas")
+    db.commit()
+    db.refresh(db_cobranza)
     return db_cobranza
 def get_cobranza(db: Session, cobranza_id: int):
     return db.query(models.Cobranza).filter(models.Cobranza.id == cobranza_id).first()
 
-def get_cobranzas(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Cobranza).order_by(desc(models.Cobranza.fecha)).offset(skip).limit(limit).all()
+def get_cobranzas(db: Session, skip: int = 0, limit: int = 100, after: Optional[str] = None):
+    return paginar(db.query(models.Cobranza), models.Cobranza, skip=skip, limit=limit, after=after)
 
 
 @audit_trail("cobranza")
@@ -686,28 +1201,27 @@ def delete_cobranza(db: Session, cobranza_id: int, current_user_id: int = None):
     # Encontrar la partida asociada
     partida = db.query(models.Partida).filter(models.Partida.cobranza_id == cobranza_id).first()
     
-    # Eliminar partida asociada
+    # Eliminar partida asociada y descontarla de los saldos posteriores
     if partida:
-        db.delete(partida)
+        quitar_partida(db, partida)
 
-    recalcular_saldos_partidas(db)    
     # Eliminar la cobranza
     db.delete(db_cobranza)
+    incrementar_version(db, "cobranzas")
     db.commit()
     
     # Crear partida/movimiento que registre la eliminación
     partida_eliminacion = models.Partida(
-        fecha=func.now(),
+        fecha=datetime.now().date(),
         detalle=f"ELIMINACIÓN Cobranza - {nombre_usuario} (ID: {cobranza_id})",
         monto=monto_cobranza,
         tipo="anulacion",  # Nuevo tipo para identificar eliminaciones
         cuenta="CAJA",
         usuario_id=current_user_id,  # Usuario que realizó la eliminación
         ingreso=0,
-        egreso=0,  # No afecta el balance nuevamente
-        saldo=0  # Se calculará después
+        egreso=0  # No afecta el balance nuevamente
     )
-    db.add(partida_eliminacion)
+    registrar_partida(db, partida_eliminacion)
     db.commit()
     db.refresh(partida_eliminacion)
     
@@ -716,11 +1230,23 @@ def delete_cobranza(db: Session, cobranza_id: int, current_user_id: int = None):
     return {"message": "Cobranza eliminada exitosamente"}
 # Funciones CRUD para Cuotas
 
+def _partida_de_cuota(db_cuota: models.Cuota, nombre_usuario: str, current_user_id: int) -> models.Partida:
+    return models.Partida(
+        fecha=db_cuota.fecha,
+        detalle=f"Cuota {nombre_usuario}",
+        monto=db_cuota.monto,
+        tipo="ingreso",
+        cuenta="CUOTAS",
+        usuario_id=current_user_id,
+        recibo_factura=f"{SERIE_CUOTA}-{db_cuota.nro_comprobante}",  # ✅ usar número real
+        ingreso=db_cuota.monto,
+        egreso=0
+    )
+
 @audit_trail("cuota")
 def create_cuota(db: Session, cuota: schemas.CuotaCreate, current_user_id: int, no_generar_movimiento: bool = False):
-    # Obtener el último número de comprobante
-    ultimo = db.query(func.max(models.Cuota.nro_comprobante)).scalar() or 42
-    nro_comprobante = ultimo + 1
+    # Tomar el siguiente número de comprobante
+    nro_comprobante = siguiente_numero(db, SERIE_CUOTA)
 
     # Crear la cuota con información del usuario que la creó
     cuota_data = cuota.dict()
@@ -729,8 +1255,7 @@ def create_cuota(db: Session, cuota: schemas.CuotaCreate, current_user_id: int,
 
     db_cuota = models.Cuota(**cuota_data)
     db.add(db_cuota)
-    db.commit()
-    db.refresh(db_cuota)
+    db.flush()
 
     # Solo crear partida si no_generar_movimiento es False
     if not no_generar_movimiento:
@@ -738,28 +1263,57 @@ def create_cuota(db: Session, cuota: schemas.CuotaCreate, current_user_id: int,
         usuario = db.query(models.Usuario).filter(models.Usuario.id == db_cuota.usuario_id).first()
         nombre_usuario = usuario.nombre if usuario else "Usuario desconocido"
 
-        # Obtener la última partida para calcular el saldo correcto
-        ultima_partida = db.query(models.Partida).order_by(models.Partida.id.desc()).first()
-        saldo_anterior = ultima_partida.saldo if ultima_partida else 0
-        nuevo_saldo = saldo_anterior + db_cuota.monto
+        registrar_partida(db, _partida_de_cuota(db_cuota, nombre_usuario, current_user_id))
 
-        partida = models.Partida(
-            fecha=db_cuota.fecha,
-            detalle=f"Cuota {nombre_usuario}",
-            monto=db_cuota.monto,
-            tipo="ingreso",
-            cuenta="CUOTAS",
-            usuario_id=current_user_id,
-            recibo_factura=f"C.S.-{db_cuota.nro_comprobante}",  # ✅ usar número real
-            saldo=nuevo_saldo,
-            ingreso=db_cuota.monto,
-            egreso=0
-        )
-        db.add(partida)
-        db.commit()
+    incrementar_version(db, "cuotas")
+    db.commit()
+    db.refresh(db_cuota)
 
     return db_cuota
 
+@audit_trail("cuota")
+def create_cuotas_lote(db: Session, cuotas: List[schemas.CuotaCreate], current_user_id: int,
+                       no_generar_movimiento: bool = False, reserva_id: Optional[int] = None):
+    """
+    Crea varias cuotas en una sola transacción. Los números de comprobante
+    salen de un único bloque de la serie, o de una reserva ya hecha.
+    """
+    if not cuotas:
+        return []
+
+    if reserva_id:
+        numeros = _usar_reserva(db, reserva_id, SERIE_CUOTA, len(cuotas))
+    else:
+        desde, hasta = _tomar_bloque(db, SERIE_CUOTA, len(cuotas))
+        numeros = list(range(desde, hasta + 1))
+
+    db_cuotas = []
+    for cuota, nro_comprobante in zip(cuotas, numeros):
+        cuota_data = cuota.dict()
+        cuota_data['creado_por_usuario_id'] = current_user_id
+        cuota_data['nro_comprobante'] = nro_comprobante
+        db_cuotas.append(models.Cuota(**cuota_data))
+    db.add_all(db_cuotas)
+    db.flush()
+
+    if not no_generar_movimiento:
+        ids_usuarios = {c.usuario_id for c in db_cuotas if c.usuario_id}
+        nombres = dict(
+            db.query(models.Usuario.id, models.Usuario.nombre).filter(models.Usuario.id.in_(ids_usuarios)).all()
+        )
+        for db_cuota in db_cuotas:
+            nombre_usuario = nombres.get(db_cuota.usuario_id, "Usuario desconocido")
+            registrar_partida(db, _partida_de_cuota(db_cuota, nombre_usuario, current_user_id))
+            # La próxima partida calcula su saldo a partir de esta
+            db.flush()
+
+    incrementar_version(db, "cuotas")
+    db.commit()
+    for db_cuota in db_cuotas:
+        db.refresh(db_cuota)
+
+    return db_cuotas
+
 
 @audit_trail("cuota")
 def pagar_cuota(
@@ -791,27 +1345,23 @@ def pagar_cuota(
 
     # Movimiento contable
     if generar_movimiento:
-        ultima_partida = db.query(models.Partida).order_by(models.Partida.id.desc()).first()
-        saldo_anterior = ultima_partida.saldo if ultima_partida else Decimal("0.00")
-        nuevo_saldo = saldo_anterior + Decimal(monto_pagado)
-
         nueva_partida = models.Partida(
             fecha=datetime.now().date(),
             cuenta="INGRESOS",
             detalle=f"Pago de cuota de {cuota.usuario.nombre}" if cuota.usuario else "Pago de cuota",
             ingreso=Decimal(monto_pagado),
             egreso=0,
-            saldo=nuevo_saldo,
             usuario_id=current_user_id,
             monto=Decimal(monto_pagado),
             tipo="ingreso",
             recibo_factura=f"C.S.-{cuota.nro_comprobante}",  # ✅ usar nro_comprobante
         )
-        db.add(nueva_partida)
+        registrar_partida(db, nueva_partida)
 
         if actualizar_saldo:
-            cuota.saldo_actual = nuevo_saldo
+            cuota.saldo_actual = nueva_partida.saldo
 
+    incrementar_version(db, "cuotas")
     db.commit()
     db.refresh(cuota)
 
@@ -822,13 +1372,13 @@ def pagar_cuota(
 def get_cuota(db: Session, cuota_id: int):
     return db.query(models.Cuota).filter(models.Cuota.id == cuota_id).first()
 
-def get_cuotas(db: Session, skip: int = 0, limit: int = 100, pagado: Optional[bool] = None):
+def get_cuotas(db: Session, skip: int = 0, limit: int = 100, pagado: Optional[bool] = None, after: Optional[str] = None):
     query = db.query(models.Cuota).options(joinedload(models.Cuota.usuario))
 
     if pagado is not None:
         query = query.filter(models.Cuota.pagado == pagado)
 
-    cuotas = query.order_by(desc(models.Cuota.fecha)).offset(skip).limit(limit).all()
+    cuotas = paginar(query, models.Cuota, skip=skip, limit=limit, after=after)
 
     cuotas_procesadas = []
     usuarios_cuotas = {}
@@ -919,6 +1469,7 @@ def update_cuota(db: Session, cuota_id: int, cuota_update: schemas.CuotaUpdate):
     for key, value in update_data.items():
         setattr(db_cuota, key, value)
     
+    incrementar_version(db, "cuotas")
     db.commit()
     db.refresh(db_cuota)
     return db_cuota
@@ -969,6 +1520,7 @@ def reenviar_recibo_cuota(db: Session, cuota_id: int, email: str = None , curren
         db_cuota.email_enviado = True
         db_cuota.fecha_envio_email = datetime.now()
         db_cuota.email_destinatario = recipient_email
+        incrementar_version(db, "cuotas")
         db.commit()
         db.refresh(db_cuota)
         return {"success": True, "message": "Recibo de cuota enviado exitosamente"}
@@ -984,30 +1536,20 @@ def delete_cuota(db: Session, cuota_id: int):
         raise HTTPException(status_code=400, detail="No se puede eliminar una cuota que ya ha sido pagada")
     
     db.delete(db_cuota)
+    incrementar_version(db, "cuotas")
     db.commit()
     return {"message": "Cuota eliminada exitosamente"}
 # Funciones CRUD para Partidas
 @audit_trail("partidas")
 def create_partida(db: Session, partida: schemas.PartidaCreate, current_user_id: int = None):
-    # Obtener la última partida para calcular el saldo
-    ultima_partida = db.query(models.Partida).order_by(models.Partida.id.desc()).first()
-    
-    # Calcular nuevo saldo
-    saldo_anterior = ultima_partida.saldo if ultima_partida else 0
-    
-    if partida.tipo == 'ingreso':
-        nuevo_saldo = saldo_anterior + partida.monto
-    else:  # egreso
-        nuevo_saldo = saldo_anterior - partida.monto
-    
-    # Crear partida con el saldo calculado
-    db_partida = models.Partida(**partida.dict(exclude={'saldo'}), saldo=nuevo_saldo)
+    # El saldo lo calcula el libro diario, se ignora el enviado por el cliente
+    db_partida = models.Partida(**partida.dict(exclude={'saldo'}))
     
     # Si se proporciona current_user_id, establecerlo como usuario
     if current_user_id:
         db_partida.usuario_id = current_user_id
     
-    db.add(db_partida)
+    registrar_partida(db, db_partida)
     db.commit()
     db.refresh(db_partida)
     return db_partida
@@ -1020,11 +1562,18 @@ def update_partida(db: Session, partida_id: int, partida_update: schemas.Partida
     if not db_partida:
         raise HTTPException(status_code=404, detail="Partida no encontrada")
     
-    update_data = partida_update.dict(exclude_unset=True)
+    # Guardar la posición y el efecto anteriores para ajustar los saldos
+    fecha_anterior = db_partida.fecha
+    efecto_anterior = efecto_partida(db_partida.tipo, db_partida.monto)
+    cuenta_anterior = db_partida.cuenta
+
+    # El saldo lo mantiene el libro diario
+    update_data = partida_update.dict(exclude_unset=True, exclude={'saldo'})
     
     for key, value in update_data.items():
         setattr(db_partida, key, value)
     
+    reubicar_partida(db, db_partida, fecha_anterior, efecto_anterior, cuenta_anterior)
     db.commit()
     db.refresh(db_partida)
     return db_partida
@@ -1035,7 +1584,7 @@ def delete_partida(db: Session, partida_id: int, current_user_id: int = None):
     if not db_partida:
         raise HTTPException(status_code=404, detail="Partida no encontrada")
     
-    db.delete(db_partida)
+    quitar_partida(db, db_partida)
     db.commit()
     return {"message": "Partida eliminada exitosamente"}
 
@@ -1355,54 +1904,168 @@ import schemas
 #         "transacciones_actualizadas": partidas_actualizadas
 #     }
 
+def _totales_partidas(db: Session, desde: Optional[date], hasta: Optional[date], cuenta: Optional[str] = None):
+    # Una sola pasada: SUM(monto) FILTER (WHERE tipo = ...)
+    query = db.query(
+        func.coalesce(func.sum(models.Partida.monto).filter(models.Partida.tipo == "ingreso"), 0),
+        func.coalesce(func.sum(models.Partida.monto).filter(models.Partida.tipo == "egreso"), 0)
+    )
+    if desde:
+        query = query.filter(models.Partida.fecha >= desde)
+    if hasta:
+        query = query.filter(models.Partida.fecha <= hasta)
+    if cuenta:
+        query = query.filter(models.Partida.cuenta == cuenta)
+    return query.one()
+
+def _fin_de_mes(fecha: date) -> date:
+    siguiente = date(fecha.year + fecha.month // 12, fecha.month % 12 + 1, 1)
+    return siguiente - timedelta(days=1)
+
+def _totales_periodo(db: Session, desde: Optional[date], hasta: Optional[date], cuenta: str = CUENTA_LIBRO):
+    """
+    Ingresos y egresos entre dos fechas: los meses completos salen de
+    saldos_mensuales y solo los meses parciales de los extremos se leen de partidas.
+    """
+    cabecera = db.query(models.SaldoCuenta.cuenta).filter(models.SaldoCuenta.cuenta == cuenta).first()
+    if not cabecera:
+        # Cuenta sin puntos de control todavía
+        return _totales_partidas(db, desde, hasta, None if cuenta == CUENTA_LIBRO else cuenta)
+
+    # Meses completos dentro del rango
+    primer_mes = desde if not desde or desde.day == 1 else _fin_de_mes(desde) + timedelta(days=1)
+    ultimo_mes = hasta if not hasta or hasta == _fin_de_mes(hasta) else hasta.replace(day=1) - timedelta(days=1)
+    if primer_mes and ultimo_mes and primer_mes > ultimo_mes:
+        return _totales_partidas(db, desde, hasta, None if cuenta == CUENTA_LIBRO else cuenta)
+
+    periodo = tuple_(models.SaldoMensual.anio, models.SaldoMensual.mes)
+    query = db.query(
+        func.coalesce(func.sum(models.SaldoMensual.ingresos), 0),
+        func.coalesce(func.sum(models.SaldoMensual.egresos), 0)
+    ).filter(models.SaldoMensual.cuenta == cuenta)
+    if primer_mes:
+        query = query.filter(periodo >= tuple_(literal(primer_mes.year), literal(primer_mes.month)))
+    if ultimo_mes:
+        query = query.filter(periodo <= tuple_(literal(ultimo_mes.year), literal(ultimo_mes.month)))
+    ingresos, egresos = query.one()
+
+    # Meses parciales de los extremos
+    filtro_cuenta = None if cuenta == CUENTA_LIBRO else cuenta
+    if desde and desde != primer_mes:
+        parcial = _totales_partidas(db, desde, primer_mes - timedelta(days=1), filtro_cuenta)
+        ingresos, egresos = ingresos + parcial[0], egresos + parcial[1]
+    if hasta and hasta != ultimo_mes:
+        parcial = _totales_partidas(db, ultimo_mes + timedelta(days=1), hasta, filtro_cuenta)
+        ingresos, egresos = ingresos + parcial[0], egresos + parcial[1]
+
+    return ingresos, egresos
+
+def get_saldo_inicial_mes(db: Session, anio: int, mes: int, cuenta: str = CUENTA_LIBRO) -> Decimal:
+    """Saldo de apertura de un mes según el último punto de control"""
+    cabecera = db.query(models.SaldoCuenta.cuenta).filter(models.SaldoCuenta.cuenta == cuenta).first()
+    if not cabecera:
+        ingresos, egresos = _totales_partidas(db, None, date(anio, mes, 1) - timedelta(days=1),
+                                              None if cuenta == CUENTA_LIBRO else cuenta)
+        return ingresos - egresos
+
+    punto = db.query(models.SaldoMensual).filter(
+        models.SaldoMensual.cuenta == cuenta,
+        tuple_(models.SaldoMensual.anio, models.SaldoMensual.mes) <= tuple_(literal(anio), literal(mes))
+    ).order_by(models.SaldoMensual.anio.desc(), models.SaldoMensual.mes.desc()).first()
+    if not punto:
+        return Decimal("0")
+    if (punto.anio, punto.mes) == (anio, mes):
+        return punto.saldo_inicial
+    return punto.saldo_final
+
+# Resultados de /reportes/balance por (desde, hasta, versión de partidas).
+# Cualquier escritura en partidas incrementa la versión, así que las claves
+# viejas simplemente dejan de usarse.
+_cache_balance: Dict[tuple, dict] = {}
+_CACHE_BALANCE_MAX = 256
+
 def get_balance(db: Session, fecha_desde: Optional[str] = None, fecha_hasta: Optional[str] = None):
-    query = db.query(models.Partida)
-    
-    if fecha_desde:
-        query = query.filter(models.Partida.fecha >= fecha_desde)
-    if fecha_hasta:
-        query = query.filter(models.Partida.fecha <= fecha_hasta)
-    
-    ingresos = query.filter(models.Partida.tipo == "ingreso").with_entities(func.sum(models.Partida.monto)).scalar() or 0
-    egresos = query.filter(models.Partida.tipo == "egreso").with_entities(func.sum(models.Partida.monto)).scalar() or 0
+    desde = date.fromisoformat(fecha_desde) if fecha_desde else None
+    hasta = date.fromisoformat(fecha_hasta) if fecha_hasta else None
+
+    clave = (desde, hasta, get_version(db, "partidas"))
+    if clave in _cache_balance:
+        return _cache_balance[clave]
+
+    ingresos, egresos = _totales_periodo(db, desde, hasta)
     
     saldo = ingresos - egresos
     
-    return {
+    resultado = {
         "ingresos": ingresos,
         "egresos": egresos,
         "saldo": saldo,
         "fecha_desde": fecha_desde,
         "fecha_hasta": fecha_hasta
     }
-def get_ingresos_egresos_mensuales(db: Session, anio: Optional[int] = None):
+    if len(_cache_balance) >= _CACHE_BALANCE_MAX:
+        _cache_balance.clear()
+    _cache_balance[clave] = resultado
+    return resultado
+
+def get_ingresos_egresos_mensuales(db: Session, anio: Optional[int] = None, anio_desde: Optional[int] = None,
+                                   anio_hasta: Optional[int] = None, cuenta: Optional[str] = None):
+    """
+    Ingresos y egresos por mes, leídos de saldos_mensuales en una sola consulta.
+    Acepta un año (anio) o un rango de años (anio_desde/anio_hasta).
+    """
     current_year = datetime.now().year
     year_to_query = anio if anio else current_year
-    
+    desde = anio_desde or anio_hasta or year_to_query
+    hasta = anio_hasta or (current_year if anio_desde else year_to_query)
+    if desde > hasta:
+        raise HTTPException(status_code=400, detail="anio_desde no puede ser mayor que anio_hasta")
+    cuenta = cuenta or CUENTA_LIBRO
+
+    cabecera = db.query(models.SaldoCuenta.cuenta).filter(models.SaldoCuenta.cuenta == cuenta).first()
+    if cabecera:
+        filas = db.query(
+            models.SaldoMensual.anio,
+            models.SaldoMensual.mes,
+            models.SaldoMensual.ingresos,
+            models.SaldoMensual.egresos
+        ).filter(
+            models.SaldoMensual.cuenta == cuenta,
+            models.SaldoMensual.anio.between(desde, hasta)
+        ).all()
+    else:
+        # Cuenta sin puntos de control todavía: agrupar las partidas del rango
+        anio_partida = cast(extract('year', models.Partida.fecha), Integer)
+        mes_partida = cast(extract('month', models.Partida.fecha), Integer)
+        query = db.query(
+            anio_partida,
+            mes_partida,
+            func.coalesce(func.sum(case((models.Partida.tipo == "ingreso", models.Partida.monto), else_=0)), 0),
+            func.coalesce(func.sum(case((models.Partida.tipo == "egreso", models.Partida.monto), else_=0)), 0)
+        ).filter(
+            models.Partida.fecha >= date(desde, 1, 1),
+            models.Partida.fecha < date(hasta + 1, 1, 1)
+        )
+        if cuenta != CUENTA_LIBRO:
+            query = query.filter(models.Partida.cuenta == cuenta)
+        filas = query.group_by(anio_partida, mes_partida).all()
+
+    por_mes = {(fila[0], fila[1]): (fila[2], fila[3]) for fila in filas}
+
     result = []
-    
-    for month in range(1, 13):
-        ingresos = db.query(func.sum(models.Partida.monto)).filter(
-            models.Partida.tipo == "ingreso",
-            extract('year', models.Partida.fecha) == year_to_query,
-            extract('month', models.Partida.fecha) == month
-        ).scalar() or 0
-        
-        egresos = db.query(func.sum(models.Partida.monto)).filter(
-            models.Partida.tipo == "egreso",
-            extract('year', models.Partida.fecha) == year_to_query,
-            extract('month', models.Partida.fecha) == month
-        ).scalar() or 0
-        
-        result.append({
-            "mes": month,
-            "nombre_mes": get_nombre_mes(month),
-            "ingresos": float(ingresos),
-            "egresos": float(egresos),
-            "balance": float(ingresos) - float(egresos),
-        })
-    
-    return {"anio": year_to_query, "datos": result}
+    for year in range(desde, hasta + 1):
+        for month in range(1, 13):
+            ingresos, egresos = por_mes.get((year, month), (0, 0))
+            result.append({
+                "anio": year,
+                "mes": month,
+                "nombre_mes": get_nombre_mes(month),
+                "ingresos": float(ingresos),
+                "egresos": float(egresos),
+                "balance": float(ingresos) - float(egresos),
+            })
+
+    return {"anio": hasta, "anio_desde": desde, "anio_hasta": hasta, "datos": result}
 
 
 def get_nombre_mes(month_number: int) -> str:
@@ -1413,19 +2076,87 @@ def get_nombre_mes(month_number: int) -> str:
     }
     return nombres.get(month_number, "")
 
-def get_partidas_por_mes(db: Session, mes: int, anio: int):
-    """Devuelve todas las partidas de un mes/año específico ordenadas por fecha."""
-    return (
-        db.query(models.Partida)
-        .filter(
-            extract('month', models.Partida.fecha) == mes,
-            extract('year', models.Partida.fecha) == anio,
+def get_partidas_por_mes(db: Session, mes: int, anio: int, cuenta: Optional[str] = None):
+    """Devuelve todas las partidas de un mes/año específico ordenadas por fecha, opcionalmente de una sola cuenta."""
+    query = db.query(models.Partida).filter(
+        extract('month', models.Partida.fecha) == mes,
+        extract('year', models.Partida.fecha) == anio,
+    )
+    if cuenta:
+        query = query.filter(models.Partida.cuenta == cuenta)
+    return query.order_by(models.Partida.fecha, models.Partida.id).all()
+
+def get_saldos_cuentas(db: Session):
+    """Saldo vigente de cada cuenta y el total del libro, leídos de saldos_cuenta"""
+    cabeceras = db.query(models.SaldoCuenta).order_by(models.SaldoCuenta.cuenta).all()
+    saldos = {c.cuenta: c.saldo for c in cabeceras}
+
+    if CUENTA_LIBRO not in saldos:
+        # Todavía no se registró ninguna partida desde que existen las cabeceras
+        efecto = case(
+            (models.Partida.tipo == "ingreso", models.Partida.monto),
+            (models.Partida.tipo == "egreso", -models.Partida.monto),
+            else_=0
         )
-        .order_by(models.Partida.fecha, models.Partida.id)
-        .all()
+        saldos = dict(
+            db.query(models.Partida.cuenta, func.sum(efecto))
+            .group_by(models.Partida.cuenta)
+            .order_by(models.Partida.cuenta)
+            .all()
+        )
+        total = sum(saldos.values(), Decimal("0"))
+    else:
+        total = saldos.pop(CUENTA_LIBRO)
+
+    return {
+        "cuentas": [{"cuenta": cuenta, "saldo": saldo} for cuenta, saldo in saldos.items()],
+        "total": total
+    }
+# Libro diario: lectura
+def _consulta_libro_diario(db: Session):
+    """
+    Partidas con el último usuario de auditoría y la descripción del pago o la
+    cobranza de origen, en una sola consulta. El usuario de cada partida viene
+    en el mismo SELECT (joinedload) para no cargarlo fila por fila.
+    """
+    actor = db.query(func.coalesce(models.Usuario.nombre, 'Sin usuario'))\
+        .select_from(models.Auditoria)\
+        .outerjoin(models.Usuario, models.Usuario.id == models.Auditoria.usuario_id)\
+        .filter(
+            models.Auditoria.tabla_afectada == 'partidas',
+            models.Auditoria.registro_id == models.Partida.id,
+            models.Auditoria.fecha >= settings.inicio_meses_activos()
+        )\
+        .order_by(models.Auditoria.fecha.desc())\
+        .limit(1)\
+        .correlate(models.Partida)\
+        .scalar_subquery()
+    # La descripción propia de la partida tiene prioridad sobre la del origen
+    descripcion = func.coalesce(
+        func.nullif(models.Partida.descripcion, ''),
+        func.nullif(models.Pago.descripcion, ''),
+        func.nullif(models.Cobranza.descripcion, ''),
+        ''
     )
-# Funciones para Auditoría
-@audit_trail("partidas")
+    return db.query(
+        models.Partida,
+        func.coalesce(actor, 'Sin registro').label('usuario_auditoria'),
+        descripcion.label('descripcion')
+    )\
+        .outerjoin(models.Pago, models.Pago.id == models.Partida.pago_id)\
+        .outerjoin(models.Cobranza, models.Cobranza.id == models.Partida.cobranza_id)\
+        .options(joinedload(models.Partida.usuario))
+
+def _partidas_enriquecidas(filas):
+    # Se arma la salida aparte: asignar descripcion en la partida la dejaría
+    # modificada en la sesión y el próximo commit la guardaría
+    return [
+        schemas.PartidaDetalle.from_orm(partida).copy(
+            update={"usuario_auditoria": usuario_auditoria, "descripcion": descripcion}
+        )
+        for partida, usuario_auditoria, descripcion in filas
+    ]
+
 def get_partida(
     db: Session, 
     partida_id: int = None, 
@@ -1435,12 +2166,13 @@ def get_partida(
     fecha_hasta: Optional[str] = None,
     tipo: Optional[str] = None,
     cuenta: Optional[str] = None,
-    current_user_id: int = None
+    after: Optional[str] = None
 ):
+    query = _consulta_libro_diario(db)
+
     if partida_id:
-        return db.query(models.Partida).filter(models.Partida.id == partida_id).first()
-    
-    query = db.query(models.Partida)
+        partidas = _partidas_enriquecidas(query.filter(models.Partida.id == partida_id).all())
+        return partidas[0] if partidas else None
     
     if fecha_desde:
         query = query.filter(models.Partida.fecha >= fecha_desde)
@@ -1452,31 +2184,7 @@ def get_partida(
         query = query.filter(models.Partida.cuenta == cuenta)
     
     # Traer los más recientes primero
-    partidas = query.order_by(
-        models.Partida.fecha.desc(), 
-        models.Partida.id.desc()
-    ).offset(skip).limit(limit).all()
-
-    # Auditoría
-    for partida in partidas:
-        auditoria = db.query(models.Auditoria)\
-            .filter(
-                models.Auditoria.tabla_afectada == 'partidas', 
-                models.Auditoria.registro_id == partida.id
-            )\
-            .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-            .order_by(models.Auditoria.fecha.desc())\
-            .first()
-        partida.usuario_auditoria = auditoria.usuario.nombre if auditoria and auditoria.usuario else 'Sin registro'
-        # Fix timezone: convertir a hora Argentina (UTC-3) antes de tomar la fecha
-        if partida.fecha and hasattr(partida.fecha, 'tzinfo'):
-            tz_arg = timezone(timedelta(hours=-3))
-            fecha_local = partida.fecha.astimezone(tz_arg) if partida.fecha.tzinfo else partida.fecha.replace(tzinfo=timezone.utc).astimezone(tz_arg)
-            partida.fecha = fecha_local.date()
-        elif partida.fecha and hasattr(partida.fecha, 'date'):
-            partida.fecha = partida.fecha.date()
-    
-    return partidas
+    return _partidas_enriquecidas(paginar(query, models.Partida, skip=skip, limit=limit, after=after))
 
 @audit_trail("cuota")
 def update_cuota(db: Session, cuota_id: int, cuota_update: schemas.CuotaUpdate, current_user_id: int = None):
@@ -1487,6 +2195,7 @@ def update_cuota(db: Session, cuota_id: int, cuota_update: schemas.CuotaUpdate,
     for key, value in cuota_update.dict(exclude_unset=True).items():
         setattr(db_cuota, key, value)
     
+    incrementar_version(db, "cuotas")
     db.commit()
     db.refresh(db_cuota)
     return db_cuota
@@ -1608,44 +2317,137 @@ def get_nombre_mes(month_number):
     
     return nombres_meses.get(month_number, "")
 def recalcular_saldos_partidas(db: Session):
-    """Recalcula los saldos de todas las partidas en orden cronológico"""
-    partidas = db.query(models.Partida).order_by(
-        models.Partida.fecha,
-        models.Partida.id
-    ).all()
-    
-    if not partidas:
-        return {"message": "No hay partidas para recalcular", "partidas_actualizadas": 0}
-    
-    saldo_actual = 0
-    for partida in partidas:
-        if partida.tipo == "ingreso":
-            saldo_actual += float(partida.ingreso or 0)
-        elif partida.tipo == "egreso":
-            saldo_actual -= float(partida.egreso or 0)
-        partida.saldo = saldo_actual
-    
+    """
+    Recalcula los saldos de todas las partidas en orden cronológico.
+    El saldo acumulado se calcula dentro de Postgres con una función de ventana
+    sobre (fecha, id) y solo se reescriben las filas cuyo saldo cambió.
+    """
+    inicio = time.perf_counter()
+
+    # Bloquear el libro para que no se registren partidas durante el recálculo
+    _bloquear_saldo_cuenta(db, CUENTA_LIBRO)
+    incrementar_version(db, "partidas")
+
+    efecto = case(
+        (models.Partida.tipo == "ingreso", models.Partida.monto),
+        (models.Partida.tipo == "egreso", -models.Partida.monto),
+        else_=0
+    )
+    # El saldo del libro y el de cada cuenta salen de la misma lectura
+    acumulado = db.query(
+        models.Partida.id.label("id"),
+        func.sum(efecto).over(order_by=(models.Partida.fecha, models.Partida.id)).label("saldo"),
+        func.sum(efecto).over(
+            partition_by=models.Partida.cuenta,
+            order_by=(models.Partida.fecha, models.Partida.id)
+        ).label("saldo_cuenta")
+    ).subquery()
+
+    resultado = db.execute(
+        update(models.Partida)
+        .where(
+            models.Partida.id == acumulado.c.id,
+            models.Partida.saldo.is_distinct_from(acumulado.c.saldo)
+            | models.Partida.saldo_cuenta.is_distinct_from(acumulado.c.saldo_cuenta)
+        )
+        .values(saldo=acumulado.c.saldo, saldo_cuenta=acumulado.c.saldo_cuenta)
+        .execution_options(synchronize_session=False)
+    )
+    partidas_actualizadas = resultado.rowcount
+
+    # Resincronizar las cabeceras con el total de cada cuenta
+    total_cuenta = db.query(func.coalesce(func.sum(efecto), 0)).filter(
+        models.Partida.cuenta == models.SaldoCuenta.cuenta
+    ).scalar_subquery()
+    db.query(models.SaldoCuenta).filter(models.SaldoCuenta.cuenta != CUENTA_LIBRO).update(
+        {models.SaldoCuenta.saldo: total_cuenta}, synchronize_session=False
+    )
+    db.query(models.SaldoCuenta).filter(models.SaldoCuenta.cuenta == CUENTA_LIBRO).update(
+        {models.SaldoCuenta.saldo: db.query(func.coalesce(func.sum(efecto), 0)).scalar_subquery()},
+        synchronize_session=False
+    )
+
+    # Y reconstruir sus puntos de control mensuales
+    for (cuenta,) in db.query(models.SaldoCuenta.cuenta).all():
+        _reconstruir_saldos_mensuales(db, cuenta)
+
     db.commit()
-    return {"message": "Saldos recalculados correctamente", "partidas_actualizadas": len(partidas)}
+    return {
+        "message": "Saldos recalculados correctamente",
+        "partidas_actualizadas": partidas_actualizadas,
+        "segundos": round(time.perf_counter() - inicio, 3)
+    }
+
+# Filas por lote al exportar auditoría
+LOTE_EXPORTACION = 1000
+
+# Columnas que devuelven el listado y la exportación de auditoría
+COLUMNAS_AUDITORIA = ("id", "fecha", "usuario_id", "usuario_nombre", "accion",
+                      "tabla_afectada", "registro_id", "detalles")
+
+def _consulta_auditoria(db: Session, tabla_afectada: Optional[str] = None, usuario_id: Optional[int] = None,
+                        registro_id: Optional[int] = None, fecha_desde: Optional[date] = None,
+                        fecha_hasta: Optional[date] = None):
+    """
+    Auditoría con el nombre del usuario. Cada filtro tiene su índice:
+    (tabla_afectada, registro_id, fecha), (usuario_id, fecha) y (fecha, id);
+    el rango de fechas además deja afuera las particiones de otros meses.
+    """
+    query = db.query(
+        models.Auditoria.id,
+        models.Auditoria.fecha,
+        models.Auditoria.usuario_id,
+        models.Usuario.nombre.label("usuario_nombre"),
+        models.Auditoria.accion,
+        models.Auditoria.tabla_afectada,
+        models.Auditoria.registro_id,
+        models.Auditoria.detalles
+    ).outerjoin(models.Usuario, models.Usuario.id == models.Auditoria.usuario_id)
 
-def get_auditoria(db: Session, skip: int = 0, limit: int = 100, 
-                tabla_afectada: Optional[str] = None, usuario_id: Optional[int] = None,
-                fecha_desde: Optional[str] = None, fecha_hasta: Optional[str] = None,
-                create_usuario: int = None):
-    query = db.query(models.Auditoria)
-    
-    # Aplicar filtros
     if tabla_afectada:
         query = query.filter(models.Auditoria.tabla_afectada == tabla_afectada)
-    
+    if registro_id is not None:
+        query = query.filter(models.Auditoria.registro_id == registro_id)
     if usuario_id:
         query = query.filter(models.Auditoria.usuario_id == usuario_id)
-    
     if fecha_desde:
         query = query.filter(models.Auditoria.fecha >= fecha_desde)
-    
     if fecha_hasta:
-        query = query.filter(models.Auditoria.fecha <= fecha_hasta)
-    
-    # Ordenar y paginar
-    return query.order_by(desc(models.Auditoria.fecha)).offset(skip).limit(limit).all()
\ No newline at end of file
+        # Hasta el final del día indicado
+        query = query.filter(models.Auditoria.fecha < fecha_hasta + timedelta(days=1))
+    return query
+
+def get_auditoria(db: Session, skip: int = 0, limit: int = 100, after: Optional[str] = None, **filtros):
+    """Página de auditoría, de la más reciente a la más vieja"""
+    return paginar(_consulta_auditoria(db, **filtros), models.Auditoria, skip=skip, limit=limit, after=after)
+
+def exportar_auditoria(db: Session, formato: str = "csv", **filtros):
+    """
+    Genera la auditoría filtrada en CSV o NDJSON, en orden cronológico. Las
+    filas se leen con un cursor del lado del servidor de a LOTE_EXPORTACION,
+    así la memoria no crece con la cantidad exportada.
+    """
+    query = _consulta_auditoria(db, **filtros)\
+        .order_by(models.Auditoria.fecha, models.Auditoria.id)\
+        .yield_per(LOTE_EXPORTACION)
+
+    if formato == "csv":
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(COLUMNAS_AUDITORIA)
+        for i, fila in enumerate(query, 1):
+            escritor.writerow(fila)
+            if i % LOTE_EXPORTACION == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        lineas = []
+        for fila in query:
+            lineas.append(json.dumps(dict(zip(COLUMNAS_AUDITORIA, fila)), default=str, ensure_ascii=False))
+            if len(lineas) == LOTE_EXPORTACION:
+                yield "\n".join(lineas) + "\n"
+                lineas = []
+        if lineas:
+            yield "\n".join(lineas) + "\n"
\ No newline at end of file
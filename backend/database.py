@@ -1,16 +1,63 @@
-from sqlalchemy import create_engine
+import threading
+import time
+from sqlalchemy import create_engine, exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from config import settings
 
 # Modificar la URL para usar psycopg en lugar de psycopg2
 SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOST}:{settings.POSTGRES_PORT}/{settings.POSTGRES_DB}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+_bloqueo = threading.Lock()
+_estadisticas = {"pedidos": 0, "espera_total": 0.0, "espera_maxima": 0.0, "agotados": 0}
+
+class PoolMedido(QueuePool):
+    """QueuePool que mide cuánto espera cada pedido de conexión"""
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with _bloqueo:
+                _estadisticas["agotados"] += 1
+            raise
+        finally:
+            espera = time.perf_counter() - inicio
+            with _bloqueo:
+                _estadisticas["pedidos"] += 1
+                _estadisticas["espera_total"] += espera
+                _estadisticas["espera_maxima"] = max(_estadisticas["espera_maxima"], espera)
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    poolclass=PoolMedido,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+def metricas_pool():
+    pool = engine.pool
+    with _bloqueo:
+        pedidos = _estadisticas["pedidos"]
+        return {
+            "tamano": pool.size(),
+            "maximo": pool.size() + settings.DB_MAX_OVERFLOW,
+            "en_uso": pool.checkedout(),
+            "libres": pool.checkedin(),
+            "desborde": max(pool.overflow(), 0),
+            "pedidos": pedidos,
+            "espera_promedio_ms": round(_estadisticas["espera_total"] / pedidos * 1000, 2) if pedidos else 0.0,
+            "espera_maxima_ms": round(_estadisticas["espera_maxima"] * 1000, 2),
+            "agotados": _estadisticas["agotados"],
+        }
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -145,6 +145,7 @@ def reenviar_recibo_cobranza(
         db_cobranza.email_enviado = True
         db_cobranza.fecha_envio_email = datetime.now()
         db_cobranza.email_destinatario = recipient_email
+        crud.incrementar_version(db, "cobranzas")
         db.commit()
         return {"success": True, "message": "Recibo enviado exitosamente"}
     else:
@@ -300,6 +301,7 @@ def reenviar_orden_pago_endpoint(
         db_pago.email_enviado = True
         db_pago.fecha_envio_email = datetime.now()
         db_pago.email_destinatario = recipient_email
+        crud.incrementar_version(db, "pagos")
         db.commit()
         return {"success": True, "message": "Orden de pago enviada exitosamente"}
     else:
@@ -369,6 +371,7 @@ def reenviar_recibo_cuota_endpoint(
         db_cuota.email_enviado = True
         db_cuota.fecha_envio_email = datetime.now()
         db_cuota.email_destinatario = recipient_email
+        crud.incrementar_version(db, "cuotas")
         db.commit()
         return {"success": True, "message": "Recibo de cuota enviado exitosamente"}
     else:
@@ -14,6 +14,7 @@ from reportlab.lib import colors
 from reportlab.lib.units import inch
 from io import BytesIO
 from num2words import num2words
+from config import settings
 
 
 def monto_a_letras(monto: float) -> str:
@@ -80,7 +81,7 @@ class EmailService:
                     }
                 ]
             
-            response = requests.post(url, headers=headers, json=payload)
+            response = requests.post(url, headers=headers, json=payload, timeout=settings.EMAIL_TIMEOUT_SEGUNDOS)
             
             if response.status_code in [200, 201, 202]:
                 print(f"✅ Email enviado exitosamente a {recipient_email}")
@@ -108,7 +109,7 @@ class EmailService:
             pdf_attachment.add_header('Content-Disposition', 'attachment', filename=filename)
             msg.attach(pdf_attachment)
             
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
+            with smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=settings.EMAIL_TIMEOUT_SEGUNDOS) as server:
                 server.starttls()
                 server.login(self.username, self.password)
                 server.send_message(msg)
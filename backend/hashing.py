@@ -0,0 +1,126 @@
+"""
+Hash y verificación de contraseñas con bcrypt en un pool de procesos aparte.
+
+bcrypt consume decenas de milisegundos de CPU por contraseña a propósito.
+Hacerlo en los procesos de HASH_PROCESOS deja libre la CPU de la API cuando
+llegan muchos inicios de sesión juntos. Como mucho hay HASH_MAXIMO_EN_CURSO
+pedidos en curso o esperando un proceso; por encima de eso (o si el pool no
+responde) se lanza HashNoDisponible, que la API convierte en un 503.
+"""
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturoVencido
+from concurrent.futures.process import BrokenProcessPool
+
+from passlib.context import CryptContext
+
+from config import settings
+
+class HashNoDisponible(Exception):
+    """El pool de hash está saturado o no respondió a tiempo"""
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# Funciones que corren en los procesos del pool; devuelven también cuándo
+# empezaron, para medir cuánto esperó el pedido
+def _hashear(password):
+    return time.time(), pwd_context.hash(password)
+
+def _verificar(password, password_hash):
+    return time.time(), pwd_context.verify_and_update(password, password_hash)
+
+_pool = None
+_bloqueo = threading.Lock()
+_estadisticas = {
+    "en_curso": 0,
+    "completadas": 0,
+    "rechazadas": 0,
+    "espera_total": 0.0,
+    "espera_maxima": 0.0,
+}
+
+def _obtener_pool():
+    global _pool
+    if _pool is None:
+        # spawn: los procesos no heredan conexiones ni hilos de la API
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.HASH_PROCESOS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+def _reemplazar_pool(roto):
+    """Descarta un pool que quedó roto (murió un proceso) para crear otro"""
+    global _pool
+    with _bloqueo:
+        if _pool is roto:
+            _pool = None
+    roto.shutdown(wait=False, cancel_futures=True)
+
+def _enviar(funcion, *args):
+    with _bloqueo:
+        pool = _obtener_pool()
+    try:
+        return pool.submit(funcion, *args).result(timeout=settings.HASH_TIMEOUT_SEGUNDOS)
+    except BrokenProcessPool:
+        # Un proceso murió (falta de memoria, kill): el pool ya no acepta
+        # trabajos. Se crea uno nuevo y se reintenta una vez.
+        _reemplazar_pool(pool)
+        with _bloqueo:
+            pool = _obtener_pool()
+        return pool.submit(funcion, *args).result(timeout=settings.HASH_TIMEOUT_SEGUNDOS)
+
+def _ejecutar(funcion, *args):
+    with _bloqueo:
+        if _estadisticas["en_curso"] >= settings.HASH_MAXIMO_EN_CURSO:
+            _estadisticas["rechazadas"] += 1
+            raise HashNoDisponible("Demasiados pedidos de hash en curso")
+        _estadisticas["en_curso"] += 1
+    enviado = time.time()
+    try:
+        inicio, resultado = _enviar(funcion, *args)
+    except (FuturoVencido, BrokenProcessPool) as e:
+        with _bloqueo:
+            _estadisticas["rechazadas"] += 1
+        raise HashNoDisponible(f"El pool de hash no respondió: {type(e).__name__}") from e
+    finally:
+        with _bloqueo:
+            _estadisticas["en_curso"] -= 1
+    espera = max(inicio - enviado, 0.0)
+    with _bloqueo:
+        _estadisticas["completadas"] += 1
+        _estadisticas["espera_total"] += espera
+        _estadisticas["espera_maxima"] = max(_estadisticas["espera_maxima"], espera)
+    return resultado
+
+def hashear(password: str) -> str:
+    return _ejecutar(_hashear, password)
+
+def verificar(password: str, password_hash: str):
+    """
+    (válida, hash_nuevo). hash_nuevo no es None cuando la contraseña es
+    válida pero el hash guardado usa otro costo o esquema y hay que
+    reemplazarlo.
+    """
+    return _ejecutar(_verificar, password, password_hash)
+
+def detener_pool():
+    global _pool
+    with _bloqueo:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+def metricas():
+    with _bloqueo:
+        completadas = _estadisticas["completadas"]
+        return {
+            "procesos": settings.HASH_PROCESOS,
+            "maximo_en_curso": settings.HASH_MAXIMO_EN_CURSO,
+            "en_curso": _estadisticas["en_curso"],
+            "completadas": completadas,
+            "rechazadas": _estadisticas["rechazadas"],
+            "espera_promedio_ms": round(_estadisticas["espera_total"] / completadas * 1000, 1) if completadas else 0.0,
+            "espera_maxima_ms": round(_estadisticas["espera_maxima"] * 1000, 1),
+        }
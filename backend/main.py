@@ -1,33 +1,36 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Depends, HTTPException, Query, status, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordRequestForm
+import anyio
 
 from sqlalchemy.orm import Session
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, date
+from functools import partial
 from typing import List, Optional
 
-from jose import JWTError, jwt
-
 
 import models
 import schemas
 import crud
-from database import SessionLocal, engine, get_db
+import audit_middleware
+import hashing
+from database import SessionLocal, get_db, metricas_pool
 from auth import (
     get_current_user,
     authenticate_user,
     create_access_token,
     get_current_active_user,
     is_admin,
-    is_tesorero
+    is_tesorero,
+    metricas_principales
 )
 from config import settings 
 
 
-# Crear tablas en la base de datos
-models.Base.metadata.create_all(bind=engine)
+# El esquema de la base se crea y actualiza con `python migrar.py`,
+# que se ejecuta antes de levantar la aplicación (ver render.yaml)
 
 # Crear la aplicación FastAPI
 app = FastAPI(
@@ -45,13 +48,54 @@ app.add_middleware(
     allow_headers=settings.CORS_HEADERS,
 )
 
+@app.on_event("startup")
+def configurar_hilos():
+    # Los endpoints sincrónicos corren en el pool de hilos de anyio. Puede
+    # haber más hilos que conexiones: los que sobran esperan conexión en el
+    # pool (DB_POOL_SIZE + DB_MAX_OVERFLOW) en vez de abrir otra
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.API_HILOS
+
+@app.on_event("startup")
+def iniciar_auditoria():
+    if settings.AUDITORIA_ASINCRONA:
+        audit_middleware.iniciar_escritor(
+            SessionLocal,
+            maximo=settings.AUDITORIA_COLA_MAXIMA,
+            tamano_lote=settings.AUDITORIA_TAMANO_LOTE,
+            archivo_respaldo=settings.AUDITORIA_ARCHIVO_RESPALDO,
+        )
+
+@app.on_event("shutdown")
+def detener_auditoria():
+    # Vacía la cola; lo que no llegue a la base queda en el archivo de respaldo
+    audit_middleware.detener_escritor()
+
+@app.on_event("shutdown")
+def detener_hashing():
+    hashing.detener_pool()
+
+def verificar_version(*tablas):
+    """
+    Dependencia para listados y reportes: calcula el ETag según la versión de
+    las tablas que lee el endpoint y responde 304 si el cliente ya lo tiene,
+    antes de ejecutar ninguna consulta del listado.
+    """
+    def dependencia(request: Request, response: Response, db: Session = Depends(get_db)) -> str:
+        etag = crud.get_etag(db, tablas)
+        recibidos = [e.strip() for e in request.headers.get("if-none-match", "").split(",")]
+        if etag in recibidos:
+            raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        return etag
+    return dependencia
+
 # Endpoint raíz
 @app.get("/")
 def read_root():
     return {"message": "Bienvenido a la API de Tesorería"}
 
 # Endpoint de autenticación
-@app.post(f"{settings.API_PREFIX}/auth/login", response_model=schemas.Token, tags=["Auth"])
+@app.post(f"{settings.API_PREFIX}/auth/login", response_model=schemas.Sesion, tags=["Auth"])
 def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = authenticate_user(db, form_data.username, form_data.password)
     if not user:
@@ -61,12 +105,39 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    refresh_token = crud.crear_refresh_token(db, user.id)
+    db.commit()
+    return _emitir_tokens(user, refresh_token)
+
+def _emitir_tokens(usuario: models.Usuario, refresh_token: str):
+    """
+    Respuesta de login y refresh: los tokens y el perfil del usuario con su
+    rol, que también va en el token para autorizar sin ir a la base
+    """
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.id)}, expires_delta=access_token_expires
+        data={"sub": str(usuario.id), "rol": usuario.rol.nombre}, expires_delta=access_token_expires
     )
     
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": int(access_token_expires.total_seconds()),
+        "usuario": usuario,
+    }
+
+# Renueva el access token sin volver a verificar la contraseña; el rol se
+# vuelve a leer, así un cambio de rol llega al token en la próxima renovación
+@app.post(f"{settings.API_PREFIX}/auth/refresh", response_model=schemas.Sesion, tags=["Auth"])
+def refresh_access_token(datos: schemas.RefreshTokenRequest, db: Session = Depends(get_db)):
+    usuario_id, refresh_token = crud.rotar_refresh_token(db, datos.refresh_token)
+    return _emitir_tokens(crud.get_usuario(db, usuario_id=usuario_id), refresh_token)
+
+@app.post(f"{settings.API_PREFIX}/auth/logout", tags=["Auth"])
+def logout(datos: schemas.RefreshTokenRequest, db: Session = Depends(get_db)):
+    crud.revocar_refresh_token(db, datos.refresh_token)
+    return {"message": "Sesión cerrada"}
 
 # Rutas de Usuarios
 @app.post(f"{settings.API_PREFIX}/usuarios", response_model=schemas.Usuario, tags=["Usuarios"])
@@ -85,7 +156,8 @@ def create_usuario(
     )
 
 @app.get(f"{settings.API_PREFIX}/usuarios", response_model=List[schemas.UsuarioDetalle], tags=["Usuarios"])
-def read_usuarios(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: models.Usuario = Depends(get_current_active_user)):
+def read_usuarios(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: models.Usuario = Depends(get_current_active_user),
+                  etag: str = Depends(verificar_version("usuarios"))):
     usuarios = crud.get_usuarios(db, skip=skip, limit=limit)
     return usuarios
 
@@ -131,7 +203,7 @@ def delete_usuario(
 def create_rol(
     rol: schemas.RolCreate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_admin)
+    current_user: schemas.TokenData = Depends(is_admin)
 ):
     return crud.create_rol(
         db=db, 
@@ -156,7 +228,7 @@ def update_rol(
     rol_id: int, 
     rol: schemas.RolCreate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_admin)
+    current_user: schemas.TokenData = Depends(is_admin)
 ):
     return crud.update_rol(
         db=db, 
@@ -169,7 +241,7 @@ def update_rol(
 def delete_rol(
     rol_id: int, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_admin)
+    current_user: schemas.TokenData = Depends(is_admin)
 ):
     return crud.delete_rol(
         db=db, 
@@ -223,7 +295,7 @@ def update_retencion(
 def create_pago(
     pago: schemas.PagoCreate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     # Validar que el usuario exista
     usuario = crud.get_usuario(db, usuario_id=pago.usuario_id)
@@ -243,36 +315,22 @@ def create_pago(
 
 @app.get(f"{settings.API_PREFIX}/pagos", response_model=List[schemas.PagoDetalle], tags=["Pagos"])
 def read_pagos(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
+    after: Optional[str] = None,
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(get_current_active_user)
+    current_user: models.Usuario = Depends(get_current_active_user),
+    etag: str = Depends(verificar_version("pagos", "usuarios"))
 ):
     # Obtener pagos - MODIFICADO: quitado el parámetro current_user_id
-    pagos = crud.get_pagos(db, skip=skip, limit=limit)
+    pagos = crud.get_pagos(db, skip=skip, limit=limit, after=after)
+    cursor = crud.siguiente_cursor(pagos, limit)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
     
-    # Obtener registros de auditoría para estos pagos
-    pago_ids = [pago.id for pago in pagos]
-    auditorias = db.query(models.Auditoria)\
-        .filter(
-            models.Auditoria.tabla_afectada == 'pagos', 
-            models.Auditoria.registro_id.in_(pago_ids)
-        )\
-        .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-        .order_by(models.Auditoria.fecha.desc())\
-        .all()
-    
-    # Crear un diccionario de mapeo de auditorías (última acción por registro)
-    auditoria_map = {}
-    for a in auditorias:
-        if str(a.registro_id) not in auditoria_map:
-            auditoria_map[str(a.registro_id)] = a.usuario.nombre if a.usuario else 'Sin usuario'
-    
-    # Añadir información de auditoría a cada pago
-    for pago in pagos:
-        pago.usuario_auditoria = auditoria_map.get(str(pago.id), 'Sin registro')
-    
-    return pagos
+    # Añadir el último usuario de auditoría a cada pago
+    return crud.agregar_usuario_auditoria(db, 'pagos', pagos)
 
 @app.get(f"{settings.API_PREFIX}/pagos/{{pago_id}}", response_model=schemas.PagoDetalle, tags=["Pagos"])
 def read_pago(pago_id: int, db: Session = Depends(get_db), current_user: models.Usuario = Depends(get_current_active_user)):
@@ -286,7 +344,7 @@ def update_pago(
     pago_id: int, 
     pago: schemas.PagoUpdate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     return crud.update_pago(
         db=db, 
@@ -299,7 +357,7 @@ def update_pago(
 def delete_pago(
     pago_id: int, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     return crud.delete_pago(
         db=db, 
@@ -312,7 +370,7 @@ def delete_pago(
 def create_cobranza(
     cobranza: schemas.CobranzaCreate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     # Validar que el usuario exista
     usuario = crud.get_usuario(db, usuario_id=cobranza.usuario_id)
@@ -327,36 +385,22 @@ def create_cobranza(
 
 @app.get(f"{settings.API_PREFIX}/cobranzas", response_model=List[schemas.CobranzaDetalle], tags=["Cobranzas"])
 def read_cobranzas(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
+    after: Optional[str] = None,
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(get_current_active_user)
+    current_user: models.Usuario = Depends(get_current_active_user),
+    etag: str = Depends(verificar_version("cobranzas", "usuarios"))
 ):
     # Obtener cobranzas
-    cobranzas = crud.get_cobranzas(db, skip=skip, limit=limit)
-    
-    # Obtener registros de auditoría para estas cobranzas
-    cobranza_ids = [cobranza.id for cobranza in cobranzas]
-    auditorias = db.query(models.Auditoria)\
-        .filter(
-            models.Auditoria.tabla_afectada == 'cobranza', 
-            models.Auditoria.registro_id.in_(cobranza_ids)
-        )\
-        .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-        .order_by(models.Auditoria.fecha.desc())\
-        .all()
-    
-    # Crear un diccionario de mapeo de auditorías (última acción por registro)
-    auditoria_map = {}
-    for a in auditorias:
-        if str(a.registro_id) not in auditoria_map:
-            auditoria_map[str(a.registro_id)] = a.usuario.nombre if a.usuario else 'Sin usuario'
-    
-    # Añadir información de auditoría a cada cobranza
-    for cobranza in cobranzas:
-        cobranza.usuario_auditoria = auditoria_map.get(str(cobranza.id), 'Sin registro')
+    cobranzas = crud.get_cobranzas(db, skip=skip, limit=limit, after=after)
+    cursor = crud.siguiente_cursor(cobranzas, limit)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
     
-    return cobranzas
+    # Añadir el último usuario de auditoría a cada cobranza
+    return crud.agregar_usuario_auditoria(db, 'cobranza', cobranzas)
 
 @app.get(f"{settings.API_PREFIX}/cobranzas/{{cobranza_id}}", response_model=schemas.CobranzaDetalle, tags=["Cobranzas"])
 def read_cobranza(
@@ -369,18 +413,8 @@ def read_cobranza(
     if db_cobranza is None:
         raise HTTPException(status_code=404, detail="Cobranza no encontrada")
     
-    # Obtener registro de auditoría para esta cobranza
-    auditoria = db.query(models.Auditoria)\
-        .filter(
-            models.Auditoria.tabla_afectada == 'cobranza', 
-            models.Auditoria.registro_id == cobranza_id
-        )\
-        .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-        .order_by(models.Auditoria.fecha.desc())\
-        .first()
-    
-    # Añadir información de auditoría a la cobranza
-    db_cobranza.usuario_auditoria = auditoria.usuario.nombre if auditoria and auditoria.usuario else 'Sin registro'
+    # Añadir el último usuario de auditoría a la cobranza
+    crud.agregar_usuario_auditoria(db, 'cobranza', [db_cobranza])
     
     return db_cobranza
 
@@ -389,7 +423,7 @@ def update_cobranza(
     cobranza_id: int, 
     cobranza: schemas.CobranzaUpdate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     return crud.update_cobranza(
         db=db, 
@@ -402,7 +436,7 @@ def update_cobranza(
 def delete_cobranza(
     cobranza_id: int, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     return crud.delete_cobranza(
         db=db, 
@@ -423,7 +457,7 @@ def create_cuota(
     cuota: schemas.CuotaCreate,
     no_generar_movimiento: bool = False,
     db: Session = Depends(get_db),
-    current_user: models.Usuario = Depends(is_tesorero),
+    current_user: schemas.TokenData = Depends(is_tesorero),
 ):
     if cuota.usuario_id:
         if not crud.get_usuario(db, usuario_id=cuota.usuario_id):
@@ -437,15 +471,60 @@ def create_cuota(
     )
 
 
+@app.post(f"{settings.API_PREFIX}/cuotas/lote", response_model=List[schemas.Cuota], tags=["Cuotas"])
+def create_cuotas_lote(
+    cuotas: List[schemas.CuotaCreate],
+    no_generar_movimiento: bool = False,
+    reserva_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenData = Depends(is_tesorero),
+):
+    ids_usuarios = {c.usuario_id for c in cuotas if c.usuario_id}
+    if ids_usuarios:
+        existentes = {u for (u,) in db.query(models.Usuario.id).filter(models.Usuario.id.in_(ids_usuarios))}
+        if ids_usuarios - existentes:
+            raise HTTPException(status_code=404, detail="Usuario no encontrado")
+
+    return crud.create_cuotas_lote(
+        db=db,
+        cuotas=cuotas,
+        current_user_id=current_user.id,
+        no_generar_movimiento=no_generar_movimiento,
+        reserva_id=reserva_id,
+    )
+
+
+@app.post(f"{settings.API_PREFIX}/secuencias/{{serie}}/reservas", response_model=schemas.ReservaComprobantes, tags=["Comprobantes"])
+def reservar_comprobantes(
+    serie: str,
+    cantidad: int = Query(..., ge=1, le=crud.MAXIMO_RESERVA),
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenData = Depends(is_tesorero),
+):
+    return crud.reservar_comprobantes(db, serie=serie, cantidad=cantidad, current_user_id=current_user.id)
+
+
+@app.post(f"{settings.API_PREFIX}/secuencias/reservas/{{reserva_id}}/liberar", tags=["Comprobantes"])
+def liberar_reserva(
+    reserva_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenData = Depends(is_tesorero),
+):
+    return crud.liberar_reserva(db, reserva_id=reserva_id)
+
+
 @app.get(f"{settings.API_PREFIX}/cuotas", tags=["Cuotas"])
 def read_cuotas(
     skip: int = 0,
     limit: int = 100,
     pagado: Optional[bool] = None,
+    after: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: models.Usuario = Depends(get_current_active_user),
+    etag: str = Depends(verificar_version("cuotas", "usuarios")),
 ):
-    cuotas = crud.get_cuotas(db, skip=skip, limit=limit, pagado=pagado)
+    cuotas = crud.get_cuotas(db, skip=skip, limit=limit, pagado=pagado, after=after)
+    cursor = crud.siguiente_cursor(cuotas, limit)
 
     for cuota in cuotas:
         if not cuota["pagado"]:
@@ -455,26 +534,12 @@ def read_cuotas(
                 meses_atraso -= 1
             cuota["meses_atraso"] = max(0, meses_atraso)
 
-    cuota_ids = [c["id"] for c in cuotas]
-
-    auditorias = db.query(models.Auditoria)\
-        .filter(
-            models.Auditoria.tabla_afectada == 'cuota',
-            models.Auditoria.registro_id.in_(cuota_ids)
-        )\
-        .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-        .order_by(models.Auditoria.fecha.desc())\
-        .all()
-
-    auditoria_map = {}
-    for a in auditorias:
-        if str(a.registro_id) not in auditoria_map:
-            auditoria_map[str(a.registro_id)] = a.usuario.nombre if a.usuario else 'Sin usuario'
-
-    for cuota in cuotas:
-        cuota["usuario_auditoria"] = auditoria_map.get(str(cuota["id"]), "Sin registro")
+    crud.agregar_usuario_auditoria(db, 'cuota', cuotas)
 
-    return JSONResponse(content=jsonable_encoder(cuotas))
+    headers = {"ETag": etag}
+    if cursor:
+        headers["X-Next-Cursor"] = cursor
+    return JSONResponse(content=jsonable_encoder(cuotas), headers=headers)
 
 
 @app.get(f"{settings.API_PREFIX}/cuotas/usuario/{{usuario_id}}", response_model=List[schemas.CuotaDetalle], tags=["Cuotas"])
@@ -483,6 +548,7 @@ def read_cuotas_by_usuario(
     pagado: Optional[bool] = None,
     db: Session = Depends(get_db),
     current_user: models.Usuario = Depends(get_current_active_user),
+    etag: str = Depends(verificar_version("cuotas", "usuarios")),
 ):
     if not crud.get_usuario(db, usuario_id=usuario_id):
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
@@ -496,26 +562,7 @@ def read_cuotas_by_usuario(
                 meses_atraso -= 1
             cuota.meses_atraso = max(0, meses_atraso)
 
-    cuota_ids = [c.id for c in cuotas]
-
-    auditorias = db.query(models.Auditoria)\
-        .filter(
-            models.Auditoria.tabla_afectada == 'cuota',
-            models.Auditoria.registro_id.in_(cuota_ids)
-        )\
-        .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-        .order_by(models.Auditoria.fecha.desc())\
-        .all()
-
-    auditoria_map = {}
-    for a in auditorias:
-        if str(a.registro_id) not in auditoria_map:
-            auditoria_map[str(a.registro_id)] = a.usuario.nombre if a.usuario else 'Sin usuario'
-
-    for cuota in cuotas:
-        cuota.usuario_auditoria = auditoria_map.get(str(cuota.id), "Sin registro")
-
-    return cuotas
+    return crud.agregar_usuario_auditoria(db, 'cuota', cuotas)
 
 
 @app.get(f"{settings.API_PREFIX}/cuotas/{{cuota_id}}", response_model=schemas.CuotaDetalle, tags=["Cuotas"])
@@ -528,16 +575,7 @@ def read_cuota(
     if not db_cuota:
         raise HTTPException(status_code=404, detail="Cuota no encontrada")
 
-    auditoria = db.query(models.Auditoria)\
-        .filter(
-            models.Auditoria.tabla_afectada == 'cuota',
-            models.Auditoria.registro_id == cuota_id
-        )\
-        .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-        .order_by(models.Auditoria.fecha.desc())\
-        .first()
-
-    db_cuota.usuario_auditoria = auditoria.usuario.nombre if auditoria and auditoria.usuario else 'Sin registro'
+    crud.agregar_usuario_auditoria(db, 'cuota', [db_cuota])
 
     return db_cuota
 
@@ -547,7 +585,7 @@ def update_cuota(
     cuota_id: int,
     cuota: schemas.CuotaUpdate,
     db: Session = Depends(get_db),
-    current_user: models.Usuario = Depends(is_tesorero),
+    current_user: schemas.TokenData = Depends(is_tesorero),
 ):
     return crud.update_cuota(
         db=db,
@@ -563,7 +601,7 @@ def pagar_cuota(
     monto_pagado: float,
     generar_movimiento: bool = True,
     db: Session = Depends(get_db),
-    current_user: models.Usuario = Depends(is_tesorero),
+    current_user: schemas.TokenData = Depends(is_tesorero),
 ):
     return crud.pagar_cuota(
         db=db,
@@ -578,7 +616,7 @@ def pagar_cuota(
 def delete_cuota(
     cuota_id: int,
     db: Session = Depends(get_db),
-    current_user: models.Usuario = Depends(is_tesorero),
+    current_user: schemas.TokenData = Depends(is_tesorero),
 ):
     return crud.delete_cuota(db=db, cuota_id=cuota_id)
 # Rutas de Partidas
@@ -586,7 +624,7 @@ def delete_cuota(
 def create_partida(
     partida: schemas.PartidaCreate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     # Validaciones
     usuario = crud.get_usuario(db, usuario_id=partida.usuario_id)
@@ -612,14 +650,17 @@ from fastapi.encoders import jsonable_encoder
 
 @app.get(f"{settings.API_PREFIX}/partidas", response_model=List[schemas.PartidaDetalle], tags=["Partidas"])
 def read_partidas(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
+    after: Optional[str] = None,
     fecha_desde: Optional[str] = None,
     fecha_hasta: Optional[str] = None,
     tipo: Optional[str] = None,
     cuenta: Optional[str] = None,
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(get_current_active_user)
+    current_user: models.Usuario = Depends(get_current_active_user),
+    etag: str = Depends(verificar_version("partidas", "pagos", "cobranzas", "usuarios"))
 ):
     partidas = crud.get_partida(
         db, 
@@ -628,52 +669,20 @@ def read_partidas(
         fecha_desde=fecha_desde,
         fecha_hasta=fecha_hasta,
         tipo=tipo,
-        cuenta=cuenta
+        cuenta=cuenta,
+        after=after
     )
+    cursor = crud.siguiente_cursor(partidas, limit)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
 
-    partida_ids = [p.id for p in partidas]
-
-    # Map auditoría
-    auditorias = db.query(models.Auditoria)\
-        .filter(
-            models.Auditoria.tabla_afectada == 'partidas', 
-            models.Auditoria.registro_id.in_(partida_ids)
-        )\
-        .join(models.Usuario, models.Auditoria.usuario_id == models.Usuario.id, isouter=True)\
-        .order_by(models.Auditoria.fecha.desc())\
-        .all()
-
-    auditoria_map = {
-        str(a.registro_id): a.usuario.nombre if a.usuario else 'Sin usuario'
-        for a in auditorias
-    }
-
-    # Map de descripciones desde pagos y cobranzas
-    pagos = db.query(models.Pago).filter(models.Pago.id.in_(
-        [p.pago_id for p in partidas if p.pago_id is not None]
-    )).all()
-    pagos_map = {p.id: p.descripcion for p in pagos if p.descripcion}
-
-    cobranzas = db.query(models.Cobranza).filter(models.Cobranza.id.in_(
-        [p.cobranza_id for p in partidas if p.cobranza_id is not None]
-    )).all()
-    cobranzas_map = {c.id: c.descripcion for c in cobranzas if c.descripcion}
-
-    # Agregar campos auxiliares
-    for p in partidas:
-        p.usuario_auditoria = auditoria_map.get(str(p.id), 'Sin registro')
-
-        # Campo adicional para mostrar en el frontend
-        descripcion = pagos_map.get(p.pago_id) or cobranzas_map.get(p.cobranza_id) or ""
-        p.descripcion = descripcion  # Esto es solo en memoria, no afecta la DB
-
-
+    # Las partidas ya traen usuario_auditoria y descripcion
     return partidas
 
 @app.post(f"{settings.API_PREFIX}/partidas/recalcular-saldos", tags=["Partidas"])
 def recalcular_saldos(
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     """Recalcula los saldos de todas las partidas"""
     return crud.recalcular_saldos_partidas(db)
@@ -681,7 +690,7 @@ def recalcular_saldos(
 
 @app.get(f"{settings.API_PREFIX}/partidas/{{partida_id}}", response_model=schemas.PartidaDetalle, tags=["Partidas"])
 def read_partida(partida_id: int, db: Session = Depends(get_db), current_user: models.Usuario = Depends(get_current_active_user)):
-    db_partida = crud.get_partida(db, partida_id=partida_id, current_user_id=current_user.id)
+    db_partida = crud.get_partida(db, partida_id=partida_id)
     if db_partida is None:
         raise HTTPException(status_code=404, detail="Partida no encontrada")
     return db_partida
@@ -691,7 +700,7 @@ def update_partida(
     partida_id: int, 
     partida: schemas.PartidaUpdate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     return crud.update_partida(
         db=db, 
@@ -704,7 +713,7 @@ def update_partida(
 def delete_partida(
     partida_id: int, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_tesorero)
+    current_user: schemas.TokenData = Depends(is_tesorero)
 ):
     return crud.delete_partida(
         db=db, 
@@ -742,7 +751,7 @@ def update_categoria(
     categoria_id: int, 
     categoria: schemas.CategoriaUpdate, 
     db: Session = Depends(get_db), 
-    current_user: models.Usuario = Depends(is_admin)
+    current_user: schemas.TokenData = Depends(is_admin)
 ):
     return crud.update_categoria(
         db=db, 
@@ -768,7 +777,7 @@ def delete_categoria(
 # def create_transaccion(
 #     transaccion: schemas.TransaccionCreate, 
 #     db: Session = Depends(get_db), 
-#     current_user: models.Usuario = Depends(is_tesorero)
+#     current_user: schemas.TokenData = Depends(is_tesorero)
 # ):
 #     return crud.create_transaccion(
 #         db=db, 
@@ -780,7 +789,7 @@ def delete_categoria(
 # def create_transaccion(
 #     transaccion: schemas.TransaccionCreate, 
 #     db: Session = Depends(get_db), 
-#     current_user: models.Usuario = Depends(is_tesorero)
+#     current_user: schemas.TokenData = Depends(is_tesorero)
 # ):
 #     return crud.create_transaccion(
 #         db=db, 
@@ -819,7 +828,7 @@ def delete_categoria(
 #     transaccion_id: int, 
 #     transaccion: schemas.TransaccionUpdate, 
 #     db: Session = Depends(get_db), 
-#     current_user: models.Usuario = Depends(is_tesorero)
+#     current_user: schemas.TokenData = Depends(is_tesorero)
 # ):
 #     return crud.update_transaccion(
 #         db=db, 
@@ -832,7 +841,7 @@ def delete_categoria(
 # def delete_transaccion(
 #     transaccion_id: int, 
 #     db: Session = Depends(get_db), 
-#     current_user: models.Usuario = Depends(is_tesorero)
+#     current_user: schemas.TokenData = Depends(is_tesorero)
 # ):
 #     return crud.delete_transaccion(
 #         db=db, 
@@ -844,35 +853,82 @@ def delete_categoria(
 # @app.post(f"{settings.API_PREFIX}/transacciones/recalcular-saldos", tags=["Transacciones"])
 # def recalcular_saldos(
 #     db: Session = Depends(get_db), 
-#     current_user: models.Usuario = Depends(is_tesorero)
+#     current_user: schemas.TokenData = Depends(is_tesorero)
 # ):
 #     """
 #     Recalcula los saldos de todas las transacciones
 #     """
 #     return crud.recalcular_saldos_transacciones(db)
-# # Rutas de Auditoría
-# @app.get(f"{settings.API_PREFIX}/auditoria", response_model=List[schemas.AuditoriaDetalle], tags=["Auditoría"])
-# def read_auditoria(
-#     skip: int = 0, 
-#     limit: int = 100, 
-#     tabla_afectada: Optional[str] = None,
-#     usuario_id: Optional[int] = None,
-#     fecha_desde: Optional[str] = None,
-#     fecha_hasta: Optional[str] = None,
-#     db: Session = Depends(get_db), 
-#     current_user: models.Usuario = Depends(is_tesorero)
-# ):
-#     auditoria = crud.get_auditoria(
-#         db, 
-#         skip=skip, 
-#         limit=limit, 
-#         tabla_afectada=tabla_afectada,
-#         usuario_id=usuario_id,
-#         fecha_desde=fecha_desde,
-#         fecha_hasta=fecha_hasta,
-#         create_usuario=current_user.id
-#     )
-#     return auditoria
+# ---------------------------------------------------------------------------
+# Rutas de Auditoría
+# ---------------------------------------------------------------------------
+
+@app.get(f"{settings.API_PREFIX}/auditoria", response_model=List[schemas.AuditoriaListado], tags=["Auditoría"])
+def read_auditoria(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after: Optional[str] = None,
+    tabla_afectada: Optional[str] = None,
+    usuario_id: Optional[int] = None,
+    registro_id: Optional[int] = None,
+    fecha_desde: Optional[date] = None,
+    fecha_hasta: Optional[date] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenData = Depends(is_tesorero)
+):
+    auditoria = crud.get_auditoria(
+        db,
+        skip=skip,
+        limit=limit,
+        after=after,
+        tabla_afectada=tabla_afectada,
+        usuario_id=usuario_id,
+        registro_id=registro_id,
+        fecha_desde=fecha_desde,
+        fecha_hasta=fecha_hasta
+    )
+    cursor = crud.siguiente_cursor(auditoria, limit)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+    return auditoria
+
+@app.get(f"{settings.API_PREFIX}/auditoria/exportar", tags=["Auditoría"])
+def exportar_auditoria(
+    formato: str = "csv",
+    tabla_afectada: Optional[str] = None,
+    usuario_id: Optional[int] = None,
+    registro_id: Optional[int] = None,
+    fecha_desde: Optional[date] = None,
+    fecha_hasta: Optional[date] = None,
+    current_user: schemas.TokenData = Depends(is_tesorero)
+):
+    """Descarga la auditoría filtrada como CSV o NDJSON, sin armarla entera en memoria"""
+    if formato not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Formato inválido: usar csv o ndjson")
+
+    def contenido():
+        # Sesión propia: tiene que seguir abierta mientras se envía la respuesta
+        db = SessionLocal()
+        try:
+            yield from crud.exportar_auditoria(
+                db,
+                formato=formato,
+                tabla_afectada=tabla_afectada,
+                usuario_id=usuario_id,
+                registro_id=registro_id,
+                fecha_desde=fecha_desde,
+                fecha_hasta=fecha_hasta
+            )
+        finally:
+            db.close()
+
+    nombre_archivo = f"auditoria_{fecha_desde or 'inicio'}_{fecha_hasta or date.today()}.{formato}"
+    return StreamingResponse(
+        contenido(),
+        media_type="text/csv" if formato == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={nombre_archivo}"},
+    )
 
 # Endpoints para reportes y estadísticas
 @app.get(f"{settings.API_PREFIX}/reportes/balance", tags=["Reportes"])
@@ -880,29 +936,47 @@ def get_balance(
     fecha_desde: Optional[str] = None,
     fecha_hasta: Optional[str] =  None,
     db: Session = Depends(get_db), 
-    
+    etag: str = Depends(verificar_version("partidas")),
 ):
     return crud.get_balance(db, fecha_desde=fecha_desde, fecha_hasta=fecha_hasta )
 
+# Años aceptados por los reportes; fuera de este rango la consulta recorrería
+# cientos de años de meses vacíos o fallaría al armar las fechas
+ANIO_MINIMO, ANIO_MAXIMO = 1900, 2100
+
 @app.get(f"{settings.API_PREFIX}/reportes/ingresos_egresos_mensuales", tags=["Reportes"])
 def get_ingresos_egresos_mensuales(
-    anio: Optional[int] = None,
+    anio: Optional[int] = Query(None, ge=ANIO_MINIMO, le=ANIO_MAXIMO),
+    anio_desde: Optional[int] = Query(None, ge=ANIO_MINIMO, le=ANIO_MAXIMO),
+    anio_hasta: Optional[int] = Query(None, ge=ANIO_MINIMO, le=ANIO_MAXIMO),
+    cuenta: Optional[str] = None,
     db: Session = Depends(get_db), 
-    
+    etag: str = Depends(verificar_version("partidas")),
+):
+    return crud.get_ingresos_egresos_mensuales(
+        db, anio=anio, anio_desde=anio_desde, anio_hasta=anio_hasta, cuenta=cuenta
+    )
+
+@app.get(f"{settings.API_PREFIX}/reportes/cuentas", tags=["Reportes"])
+def get_saldos_cuentas(
+    db: Session = Depends(get_db),
+    current_user: models.Usuario = Depends(get_current_active_user),
+    etag: str = Depends(verificar_version("partidas"))
 ):
-    return crud.get_ingresos_egresos_mensuales(db, anio=anio)
+    return crud.get_saldos_cuentas(db)
 
 @app.get(f"{settings.API_PREFIX}/reportes/cuotas_pendientes", tags=["Reportes"])
 def get_cuotas_pendientes(
     db: Session = Depends(get_db), 
-    
+    etag: str = Depends(verificar_version("cuotas", "usuarios")),
 ):
     return crud.get_cuotas_pendientes(db,)
 
 @app.get(f"{settings.API_PREFIX}/reportes/libro-diario-pdf", tags=["Reportes"])
 def generar_libro_diario_pdf(
-    mes: int,
-    anio: int,
+    mes: int = Query(..., ge=1, le=12),
+    anio: int = Query(..., ge=ANIO_MINIMO, le=ANIO_MAXIMO),
+    cuenta: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: models.Usuario = Depends(get_current_active_user),
 ):
@@ -919,7 +993,11 @@ def generar_libro_diario_pdf(
         9: "Septiembre", 10: "Octubre", 11: "Noviembre", 12: "Diciembre",
     }
 
-    partidas = crud.get_partidas_por_mes(db, mes=mes, anio=anio)
+    partidas = crud.get_partidas_por_mes(db, mes=mes, anio=anio, cuenta=cuenta)
+
+    # Con cuenta se muestra el saldo propio de esa cuenta en lugar del saldo del libro
+    def saldo_de(partida):
+        return partida.saldo_cuenta if cuenta else partida.saldo
 
     buffer = BytesIO()
     p = canvas.Canvas(buffer, pagesize=A4)
@@ -933,7 +1011,10 @@ def generar_libro_diario_pdf(
     p.setFont("Helvetica-Bold", 18)
     p.drawString(40, alto - 40, "Unión de Árbitros de Río Cuarto")
     p.setFont("Helvetica", 11)
-    p.drawString(40, alto - 60, f"Libro Diario — {MESES.get(mes, mes)} {anio}")
+    titulo = f"Libro Diario — {MESES.get(mes, mes)} {anio}"
+    if cuenta:
+        titulo += f" — Cuenta {cuenta}"
+    p.drawString(40, alto - 60, titulo)
 
     # Fecha de generación
     p.setFont("Helvetica", 9)
@@ -943,7 +1024,12 @@ def generar_libro_diario_pdf(
     total_ingresos = sum(float(p2.monto) for p2 in partidas if p2.tipo == "ingreso")
     total_egresos = sum(float(p2.monto) for p2 in partidas if p2.tipo == "egreso")
     balance = total_ingresos - total_egresos
-    saldo_final = float(partidas[-1].saldo) if partidas else 0
+    saldo_inicial = float(crud.get_saldo_inicial_mes(db, anio=anio, mes=mes, cuenta=cuenta or crud.CUENTA_LIBRO))
+    saldo_final = saldo_inicial + balance
+    # El saldo de la última partida tiene que coincidir con la apertura más el movimiento del mes
+    saldo_verificado = not partidas or (
+        saldo_de(partidas[-1]) is not None and abs(float(saldo_de(partidas[-1])) - saldo_final) < 0.005
+    )
 
     y = alto - 110
     p.setFillColor(colors.HexColor("#f0f9ff"))
@@ -956,8 +1042,13 @@ def generar_libro_diario_pdf(
     p.setFillColor(colors.HexColor("#1e40af") if balance >= 0 else colors.HexColor("#991b1b"))
     p.drawString(350, y + 25, f"Balance: ${balance:,.2f}")
     p.setFillColor(colors.HexColor("#374151"))
-    p.drawString(50, y + 8, f"Saldo al cierre del mes: ${saldo_final:,.2f}")
+    p.drawString(50, y + 8, f"Saldo al inicio: ${saldo_inicial:,.2f}")
+    p.drawString(200, y + 8, f"Saldo al cierre: ${saldo_final:,.2f}")
     p.drawString(350, y + 8, f"Total movimientos: {len(partidas)}")
+    if not saldo_verificado:
+        p.setFillColor(colors.HexColor("#991b1b"))
+        p.setFont("Helvetica", 8)
+        p.drawString(50, y - 5, "Los saldos de las partidas no coinciden con la apertura del mes: recalcular saldos.")
 
     # --- Tabla de partidas ---
     y_tabla = y - 25
@@ -969,7 +1060,7 @@ def generar_libro_diario_pdf(
         fecha_str = pt.fecha.strftime("%d/%m/%Y") if hasattr(pt.fecha, "strftime") else str(pt.fecha)
         ingreso_str = f"${float(pt.ingreso):,.2f}" if pt.tipo == "ingreso" else "-"
         egreso_str = f"${float(pt.egreso):,.2f}" if pt.tipo == "egreso" else "-"
-        saldo_str = f"${float(pt.saldo):,.2f}" if pt.saldo is not None else "-"
+        saldo_str = f"${float(saldo_de(pt)):,.2f}" if saldo_de(pt) is not None else "-"
         detalle = (pt.detalle or "")[:35]
         comprobante = (pt.recibo_factura or "-")[:18]
         filas.append([fecha_str, detalle, comprobante, ingreso_str, egreso_str, saldo_str])
@@ -1017,7 +1108,7 @@ def generar_libro_diario_pdf(
     p.save()
     buffer.seek(0)
 
-    nombre_archivo = f"libro_diario_{MESES.get(mes, mes)}_{anio}.pdf"
+    nombre_archivo = f"libro_diario_{MESES.get(mes, mes)}_{anio}{'_' + cuenta if cuenta else ''}.pdf"
     return Response(
         content=buffer.getvalue(),
         media_type="application/pdf",
@@ -1025,325 +1116,176 @@ def generar_libro_diario_pdf(
     )
 
 
+# ---------------------------------------------------------------------------
+# Métricas
+# ---------------------------------------------------------------------------
+
+@app.get(f"{settings.API_PREFIX}/metricas", tags=["Métricas"])
+def read_metricas(current_user: schemas.TokenData = Depends(is_admin)):
+    escritor = audit_middleware.escritor
+    return {
+        "auditoria": escritor.metricas() if escritor else {"activa": False, "en_cola": 0},
+        "principales": metricas_principales(),
+        "hash": hashing.metricas(),
+        "pool": metricas_pool(),
+    }
+
 
 # email endpoints
+# Armar PDFs y enviar emails bloquea (reportlab, requests, smtplib): se hace
+# en un pool de hilos propio de EMAIL_TRABAJADORES, así un servidor de correo
+# lento no ocupa el event loop ni los hilos del resto de los endpoints
+limitador_email = None
+
+@app.on_event("startup")
+def iniciar_limitador_email():
+    global limitador_email
+    limitador_email = anyio.CapacityLimiter(settings.EMAIL_TRABAJADORES)
+
+async def en_pool_email(funcion, *args, **kwargs):
+    """Ejecuta funcion en el pool de email y espera el resultado"""
+    return await anyio.to_thread.run_sync(partial(funcion, *args, **kwargs), limiter=limitador_email)
+
+def _datos_email_config(config):
+    return {
+        "id": config.id,
+        "smtp_server": config.smtp_server,
+        "smtp_port": config.smtp_port,
+        "smtp_username": config.smtp_username,
+        "email_from": config.email_from,
+        "is_active": config.is_active
+    }
+
 @app.get(f"{settings.API_PREFIX}/email-config/active", response_model=None)
-async def get_active_email_config(request: Request):
-    db = SessionLocal()
-    try:
-        # Extraer token manualmente
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        
-        # Verificar token manualmente
-        try:
-            # Decodificar token sin usar dependencias
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="No se pudieron validar las credenciales",
-                )
-                
-            # Obtener usuario directamente con la sesión
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Usuario no encontrado",
-                )
-                
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido",
-            )
-        
-        config = crud.get_active_email_config(db=db)
-        if not config:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="No hay configuración de email activa",
-            )
-        
-        return {
-            "id": config.id,
-            "smtp_server": config.smtp_server,
-            "smtp_port": config.smtp_port,
-            "smtp_username": config.smtp_username,
-            "email_from": config.email_from,
-            "is_active": config.is_active
-        }
-    finally:
-        db.close()
-        
+def get_active_email_config(db: Session = Depends(get_db), current_user: models.Usuario = Depends(get_current_active_user)):
+    config = crud.get_active_email_config(db=db)
+    if not config:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No hay configuración de email activa",
+        )
+    return _datos_email_config(config)
+
 @app.post(f"{settings.API_PREFIX}/email-config/", response_model=None)
-async def create_email_config(request: Request, config: schemas.EmailConfigUpdate):
-    db = SessionLocal()
-    try:
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        try:
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No se pudieron validar las credenciales")
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Usuario no encontrado")
-        except JWTError:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido")
-
-        if current_user.rol_id != 1 and current_user.rol_id != 2:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tiene permisos para esta acción")
-
-        new_config = crud.create_email_config(db=db, config_data=config.dict())
-        return {
-            "id": new_config.id,
-            "smtp_server": new_config.smtp_server,
-            "smtp_port": new_config.smtp_port,
-            "smtp_username": new_config.smtp_username,
-            "email_from": new_config.email_from,
-            "is_active": new_config.is_active
-        }
-    finally:
-        db.close()
+def create_email_config(
+    config: schemas.EmailConfigUpdate,
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenData = Depends(is_tesorero)
+):
+    new_config = crud.create_email_config(db=db, config_data=config.dict())
+    return _datos_email_config(new_config)
+
 @app.put(f"{settings.API_PREFIX}/email-config/{{config_id}}", response_model=None)
-async def update_email_config(request: Request, config_id: int, config: schemas.EmailConfigUpdate):
-    db = SessionLocal()
-    try:
-        # Extraer token manualmente
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        
-        # Verificar token manualmente
-        try:
-            # Decodificar token sin usar dependencias
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="No se pudieron validar las credenciales",
-                )
-                
-            # Obtener usuario directamente con la sesión
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Usuario no encontrado",
-                )
-                
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido",
-            )
-        
-        # Verificar permisos
-        if current_user.rol_id != 1 and current_user.rol_id != 2:  # Permitir admin (1) y tesorero (2)
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="No tiene permisos para esta acción",
-            )
-        
-        updated_config = crud.update_email_config(
-            db=db, 
-            config_id=config_id, 
-            config_data=config.dict(exclude_unset=True)
+def update_email_config(
+    config_id: int,
+    config: schemas.EmailConfigUpdate,
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenData = Depends(is_tesorero)
+):
+    updated_config = crud.update_email_config(
+        db=db, 
+        config_id=config_id, 
+        config_data=config.dict(exclude_unset=True)
+    )
+    if not updated_config:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Configuración de email no encontrada",
         )
-        if not updated_config:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Configuración de email no encontrada",
-            )
-        
-        return { 
-            "id": updated_config.id,
-            "smtp_server": updated_config.smtp_server,
-            "smtp_port": updated_config.smtp_port,
-            "smtp_username": updated_config.smtp_username,
-            "email_from": updated_config.email_from,
-            "is_active": updated_config.is_active
-        }
-    finally:
-        db.close()
+    return _datos_email_config(updated_config)
 
 # Endpoint para reenviar recibo
 @app.post(f"{settings.API_PREFIX}/cobranzas/{{cobranza_id}}/reenviar-recibo", response_model=None)
-async def reenviar_recibo_cobranza(request: Request, cobranza_id: int, email: Optional[str] = None):
-    db = SessionLocal()
-    try:
-        # Extraer token manualmente
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        
-        # Verificar token manualmente
-        try:
-            # Decodificar token sin usar dependencias
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="No se pudieron validar las credenciales",
-                )
-                
-            # Obtener usuario directamente con la sesión
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Usuario no encontrado",
-                )
-                
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido",
-            )
-        
-        result = crud.reenviar_recibo(
-            db=db, 
-            cobranza_id=cobranza_id, 
-            email=email,
-            
+async def reenviar_recibo_cobranza(
+    cobranza_id: int,
+    email: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Usuario = Depends(get_current_active_user)
+):
+    result = await en_pool_email(
+        crud.reenviar_recibo,
+        db=db, 
+        cobranza_id=cobranza_id, 
+        email=email,
+        current_user_id=current_user.id
+    )
+    if not result["success"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=result["message"],
         )
-        if not result["success"]:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=result["message"],
-            )
-        return {"message": "Recibo enviado exitosamente", "success": True}
-    finally:
-        db.close()
+    return {"message": "Recibo enviado exitosamente", "success": True}
 
 # Endpoint para reenviar orden de pago
 @app.post(f"{settings.API_PREFIX}/pagos/{{pago_id}}/reenviar-orden", response_model=None)
-async def reenviar_orden_pago(request: Request, pago_id: int, email: Optional[str] = None):
-    db = SessionLocal()
-    try:
-        # Extraer token manualmente
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        
-        # Verificar token manualmente
-        try:
-            # Decodificar token sin usar dependencias
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="No se pudieron validar las credenciales",
-                )
-                
-            # Obtener usuario directamente con la sesión
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Usuario no encontrado",
-                )
-                
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido",
-            )
-        
-        result = crud.reenviar_orden_pago(
-            db=db, 
-            pago_id=pago_id, 
-            email=email,
-            current_user_id=current_user.id
+async def reenviar_orden_pago(
+    pago_id: int,
+    email: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Usuario = Depends(get_current_active_user)
+):
+    result = await en_pool_email(
+        crud.reenviar_orden_pago,
+        db=db, 
+        pago_id=pago_id, 
+        email=email,
+        current_user_id=current_user.id
+    )
+    if not result["success"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=result["message"],
         )
-        if not result["success"]:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=result["message"],
-            )
-        return {"message": "Orden de pago enviada exitosamente", "success": True}
-    finally:
-        db.close()
+    return {"message": "Orden de pago enviada exitosamente", "success": True}
+
+def _pdf_de_pago(db: Session, pago_id: int):
+    """(pdf, nombre de archivo) de la orden de pago o factura de un pago"""
+    db_pago = db.query(models.Pago).filter(models.Pago.id == pago_id).first()
+    if not db_pago:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Pago no encontrado"
+        )
+    
+    # Importar EmailService para generar el PDF
+    from email_service import EmailService
+    
+    # Obtener configuración de email (para usar el sender)
+    email_config = crud.get_active_email_config(db=db)
+    sender_email = email_config.email_from if email_config else "sistema@uarc.com"
+    
+    # Crear servicio de email (solo para generar PDF)
+    email_service = EmailService(
+        smtp_server="",
+        smtp_port=0,
+        username="",
+        password="",
+        sender_email=sender_email
+    )
+    
+    # Obtener número de documento desde la partida
+    partida = db.query(models.Partida).filter(models.Partida.pago_id == pago_id).first()
+    
+    if db_pago.tipo_documento == "factura":
+        numero_documento = db_pago.numero_factura or "S/N"
+        tipo_doc_texto = "Factura/Recibo"
+    else:
+        numero_documento = partida.recibo_factura if partida else f"O.P-{pago_id}"
+        tipo_doc_texto = "Orden de Pago"
+    
+    pdf_data = email_service.generate_payment_receipt_pdf(db, db_pago, numero_documento, tipo_doc_texto)
+    filename = f"{tipo_doc_texto.replace('/', '_')}_{numero_documento.replace('/', '_')}.pdf"
+    return pdf_data, filename
 
 # Endpoint para generar PDF de orden de pago
 @app.get(f"{settings.API_PREFIX}/pagos/{{pago_id}}/generar-pdf", response_model=None)
-async def generar_pdf_pago(request: Request, pago_id: int):
-    from fastapi.responses import Response
-    db = SessionLocal()
+async def generar_pdf_pago(
+    pago_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.Usuario = Depends(get_current_active_user)
+):
     try:
-        # Extraer token manualmente
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        
-        # Verificar token manualmente
-        try:
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="No se pudieron validar las credenciales",
-                )
-                
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Usuario no encontrado",
-                )
-                
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido",
-            )
-        
-        # Obtener el pago
-        db_pago = db.query(models.Pago).filter(models.Pago.id == pago_id).first()
-        if not db_pago:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Pago no encontrado"
-            )
-        
-        # Importar EmailService para generar el PDF
-        from email_service import EmailService
-        
-        # Obtener configuración de email (para usar el sender)
-        email_config = crud.get_active_email_config(db=db)
-        sender_email = email_config.email_from if email_config else "sistema@uarc.com"
-        
-        # Crear servicio de email (solo para generar PDF)
-        email_service = EmailService(
-            smtp_server="",
-            smtp_port=0,
-            username="",
-            password="",
-            sender_email=sender_email
-        )
-        
-        # Obtener número de documento desde la partida
-        partida = db.query(models.Partida).filter(models.Partida.pago_id == pago_id).first()
-        
-        if db_pago.tipo_documento == "factura":
-            numero_documento = db_pago.numero_factura or "S/N"
-            tipo_doc_texto = "Factura/Recibo"
-        else:
-            numero_documento = partida.recibo_factura if partida else f"O.P-{pago_id}"
-            tipo_doc_texto = "Orden de Pago"
-        
-        # Generar el PDF
-        pdf_data = email_service.generate_payment_receipt_pdf(db, db_pago, numero_documento, tipo_doc_texto)
-        
-        # Devolver el PDF como respuesta
-        filename = f"{tipo_doc_texto.replace('/', '_')}_{numero_documento.replace('/', '_')}.pdf"
-        
-        return Response(
-            content=pdf_data,
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}"
-            }
-        )
-        
+        pdf_data, filename = await en_pool_email(_pdf_de_pago, db, pago_id)
     except HTTPException:
         raise
     except Exception as e:
@@ -1352,161 +1294,108 @@ async def generar_pdf_pago(request: Request, pago_id: int):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error al generar PDF: {str(e)}"
         )
-    finally:
-        db.close()
+    
+    return Response(
+        content=pdf_data,
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}"
+        }
+    )
 
 # Endpoint para reenviar recibo de cuota
 @app.post(f"{settings.API_PREFIX}/cuotas/{{cuota_id}}/reenviar-recibo", response_model=None)
-async def reenviar_recibo_cuota(request: Request, cuota_id: int, email: Optional[str] = None):
-    db = SessionLocal()
-    try:
-        # Extraer token manualmente
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        
-        # Verificar token manualmente
-        try:
-            # Decodificar token sin usar dependencias
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="No se pudieron validar las credenciales",
-                )
-                
-            # Obtener usuario directamente con la sesión
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Usuario no encontrado",
-                )
-                
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido",
-            )
-        
-        result = crud.reenviar_recibo_cuota(
-            db=db, 
-            cuota_id=cuota_id, 
-            email=email,
-            current_user_id=current_user.id
+async def reenviar_recibo_cuota(
+    cuota_id: int,
+    email: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Usuario = Depends(get_current_active_user)
+):
+    result = await en_pool_email(
+        crud.reenviar_recibo_cuota,
+        db=db, 
+        cuota_id=cuota_id, 
+        email=email,
+        current_user_id=current_user.id
+    )
+    if not result["success"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=result["message"],
         )
-        if not result["success"]:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=result["message"],
-            )
-        return {"message": "Recibo de cuota enviado exitosamente", "success": True}
-    finally:
-        db.close()
+    return {"message": "Recibo de cuota enviado exitosamente", "success": True}
 
-# Endpoint para probar email
-# Endpoint para probar email - ACTUALIZADO PARA BREVO
-@app.post(f"{settings.API_PREFIX}/email-test", response_model=None)
-async def test_email(request: Request, email: str):
-    db = SessionLocal()
-    try:
-        # Extraer token manualmente
-        token = request.headers.get("Authorization", "").replace("Bearer ", "")
-        
-        # Verificar token manualmente
-        try:
-            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="No se pudieron validar las credenciales",
-                )
-                
-            current_user = db.query(models.Usuario).filter(models.Usuario.id == user_id).first()
-            if current_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Usuario no encontrado",
-                )
-                
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido",
-            )
-        
-        # Obtener configuración activa
-        email_config = crud.get_active_email_config(db=db)
-        if not email_config:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="No hay configuración de email activa",
-            )
-        
-        try:
-            # Importar EmailService
-            from email_service import EmailService
-            
-            # Crear servicio de email
-            email_service = EmailService(
-                smtp_server=email_config.smtp_server,
-                smtp_port=email_config.smtp_port,
-                username=email_config.smtp_username,
-                password=email_config.smtp_password,
-                sender_email=email_config.email_from
-            )
-            
-            # Crear un PDF de prueba simple
-            from io import BytesIO
-            from reportlab.pdfgen import canvas
-            from reportlab.lib.pagesizes import letter
-            
-            buffer = BytesIO()
-            p = canvas.Canvas(buffer, pagesize=letter)
-            p.setFont("Helvetica-Bold", 16)
-            p.drawString(100, 750, "Email de Prueba - UARC")
-            p.setFont("Helvetica", 12)
-            p.drawString(100, 720, "Si recibe este mensaje, la configuración es correcta.")
-            p.drawString(100, 700, "Unidad de Árbitros de Río Cuarto")
-            p.save()
-            buffer.seek(0)
-            pdf_data = buffer.getvalue()
-            
-            subject = "Prueba de Configuración de Email - UARC"
-            body = """Este es un mensaje de prueba para verificar la configuración de email.
-            
+def _enviar_email_prueba(email_config, email: str):
+    # Importar EmailService
+    from email_service import EmailService
+    
+    # Crear servicio de email
+    email_service = EmailService(
+        smtp_server=email_config.smtp_server,
+        smtp_port=email_config.smtp_port,
+        username=email_config.smtp_username,
+        password=email_config.smtp_password,
+        sender_email=email_config.email_from
+    )
+    
+    # Crear un PDF de prueba simple
+    from io import BytesIO
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+    
+    buffer = BytesIO()
+    p = canvas.Canvas(buffer, pagesize=letter)
+    p.setFont("Helvetica-Bold", 16)
+    p.drawString(100, 750, "Email de Prueba - UARC")
+    p.setFont("Helvetica", 12)
+    p.drawString(100, 720, "Si recibe este mensaje, la configuración es correcta.")
+    p.drawString(100, 700, "Unidad de Árbitros de Río Cuarto")
+    p.save()
+    buffer.seek(0)
+    pdf_data = buffer.getvalue()
+    
+    subject = "Prueba de Configuración de Email - UARC"
+    body = """Este es un mensaje de prueba para verificar la configuración de email.
+    
 Si está recibiendo este mensaje, la configuración es correcta.
 
 Unidad de Árbitros de Río Cuarto"""
+    
+    # Usar el método apropiado (Brevo o SMTP)
+    enviar = email_service._send_email_brevo if email_service.use_brevo else email_service._send_email_smtp
+    return enviar(
+        recipient_email=email,
+        subject=subject,
+        body=body,
+        pdf_data=pdf_data,
+        filename="prueba_email.pdf"
+    )
+
+# Endpoint para probar email - ACTUALIZADO PARA BREVO
+@app.post(f"{settings.API_PREFIX}/email-test", response_model=None)
+async def test_email(
+    email: str,
+    db: Session = Depends(get_db),
+    current_user: models.Usuario = Depends(get_current_active_user)
+):
+    # Obtener configuración activa
+    email_config = await en_pool_email(crud.get_active_email_config, db=db)
+    if not email_config:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No hay configuración de email activa",
+        )
+    
+    try:
+        success, message = await en_pool_email(_enviar_email_prueba, email_config, email)
+        if success:
+            return {"success": True, "message": "Email de prueba enviado exitosamente"}
+        else:
+            return {"success": False, "message": message}
             
-            # Usar el método apropiado (Brevo o SMTP)
-            if email_service.use_brevo:
-                success, message = email_service._send_email_brevo(
-                    recipient_email=email,
-                    subject=subject,
-                    body=body,
-                    pdf_data=pdf_data,
-                    filename="prueba_email.pdf"
-                )
-            else:
-                success, message = email_service._send_email_smtp(
-                    recipient_email=email,
-                    subject=subject,
-                    body=body,
-                    pdf_data=pdf_data,
-                    filename="prueba_email.pdf"
-                )
-            
-            if success:
-                return {"success": True, "message": "Email de prueba enviado exitosamente"}
-            else:
-                return {"success": False, "message": message}
-                
-        except Exception as e:
-            print(f"Error en test_email: {str(e)}")
-            return {"success": False, "message": str(e)}
-    finally:
-        db.close()
+    except Exception as e:
+        print(f"Error en test_email: {str(e)}")
+        return {"success": False, "message": str(e)}
 
 if __name__ == "__main__":
     import uvicorn
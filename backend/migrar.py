@@ -0,0 +1,461 @@
+"""
+Migraciones versionadas del esquema de la base de datos.
+
+Uso:
+    python migrar.py              aplica las migraciones pendientes
+    python migrar.py --estado     muestra qué versiones están aplicadas
+    python migrar.py --verificar  corre EXPLAIN sobre las consultas frecuentes
+                                  y comprueba que cada una use su índice
+
+Cada migración se aplica en su propia transacción y queda registrada en
+schema_migrations. La 1 es el esquema de la primera versión escrito a
+mano; no depende de models.py, así que cada tabla o columna nueva necesita
+su propia migración. Todas son idempotentes (IF NOT EXISTS) porque hay
+bases creadas antes de que existiera este archivo.
+"""
+import sys
+from datetime import date
+
+from sqlalchemy import text, tuple_, literal
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import engine
+import models
+import archivo_auditoria
+
+# Clave del advisory lock: dos deploys simultáneos no migran a la vez
+CLAVE_BLOQUEO = 7310501
+
+# Esquema de la primera versión, congelado: lo que se agregó después entra
+# solo por su propia migración, aunque el modelo actual ya lo tenga
+ESQUEMA_BASE = [
+    """
+    CREATE TABLE IF NOT EXISTS categorias (
+        id SERIAL PRIMARY KEY,
+        nombre VARCHAR(100) NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_categorias_id ON categorias (id)",
+    """
+    CREATE TABLE IF NOT EXISTS email_config (
+        id SERIAL PRIMARY KEY,
+        smtp_server VARCHAR(100) NOT NULL,
+        smtp_port INTEGER NOT NULL,
+        smtp_username VARCHAR(100) NOT NULL,
+        smtp_password VARCHAR(100) NOT NULL,
+        email_from VARCHAR(100) NOT NULL,
+        is_active BOOLEAN
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_email_config_id ON email_config (id)",
+    """
+    CREATE TABLE IF NOT EXISTS retenciones (
+        id SERIAL PRIMARY KEY,
+        nombre VARCHAR(100) NOT NULL,
+        monto NUMERIC(10, 2) NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_retenciones_id ON retenciones (id)",
+    """
+    CREATE TABLE IF NOT EXISTS roles (
+        id SERIAL PRIMARY KEY,
+        nombre VARCHAR(50) NOT NULL UNIQUE
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_roles_id ON roles (id)",
+    """
+    CREATE TABLE IF NOT EXISTS retenciones_division (
+        id SERIAL PRIMARY KEY,
+        retencion_id INTEGER NOT NULL REFERENCES retenciones (id) ON DELETE CASCADE,
+        categoria_id INTEGER REFERENCES categorias (id) ON DELETE CASCADE
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_retenciones_division_id ON retenciones_division (id)",
+    """
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id SERIAL PRIMARY KEY,
+        nombre VARCHAR(100) NOT NULL UNIQUE,
+        email VARCHAR(100) NOT NULL UNIQUE,
+        password_hash TEXT,
+        rol_id INTEGER NOT NULL REFERENCES roles (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_usuarios_id ON usuarios (id)",
+    """
+    CREATE TABLE IF NOT EXISTS cuota (
+        id SERIAL PRIMARY KEY,
+        usuario_id INTEGER REFERENCES usuarios (id) ON DELETE SET NULL,
+        fecha DATE NOT NULL,
+        monto NUMERIC(10, 2) NOT NULL,
+        pagado BOOLEAN,
+        monto_pagado NUMERIC(10, 2),
+        nro_comprobante INTEGER NOT NULL UNIQUE,
+        email_enviado BOOLEAN,
+        fecha_envio_email TIMESTAMP,
+        email_destinatario VARCHAR(100),
+        meses_atraso INTEGER,
+        monto_total_pendiente NUMERIC(10, 2),
+        cuotas_pendientes INTEGER,
+        fecha_primera_deuda DATE,
+        creado_por_usuario_id INTEGER REFERENCES usuarios (id),
+        pagado_por_usuario_id INTEGER REFERENCES usuarios (id),
+        fecha_pago TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_cuota_id ON cuota (id)",
+    """
+    CREATE TABLE IF NOT EXISTS transacciones (
+        id SERIAL PRIMARY KEY,
+        tipo VARCHAR(10) NOT NULL,
+        monto NUMERIC(10, 2) NOT NULL,
+        fecha DATE NOT NULL,
+        usuario_id INTEGER REFERENCES usuarios (id) ON DELETE SET NULL,
+        referencia TEXT,
+        created_at TIMESTAMP,
+        saldo NUMERIC(10, 2),
+        CONSTRAINT transacciones_tipo_check CHECK (tipo IN ('ingreso', 'egreso'))
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_transacciones_id ON transacciones (id)",
+    """
+    CREATE TABLE IF NOT EXISTS cobranzas (
+        id SERIAL PRIMARY KEY,
+        usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+        fecha DATE NOT NULL,
+        monto NUMERIC(10, 2) NOT NULL,
+        transaccion_id INTEGER REFERENCES transacciones (id),
+        retencion_id INTEGER REFERENCES retenciones (id),
+        descripcion TEXT,
+        email_enviado BOOLEAN,
+        fecha_envio_email TIMESTAMP,
+        email_destinatario VARCHAR(100),
+        tipo_documento VARCHAR(20) NOT NULL,
+        numero_factura VARCHAR(50),
+        razon_social VARCHAR(100)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_cobranzas_id ON cobranzas (id)",
+    """
+    CREATE TABLE IF NOT EXISTS pagos (
+        id SERIAL PRIMARY KEY,
+        usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+        fecha DATE NOT NULL,
+        monto NUMERIC(10, 2) NOT NULL,
+        transaccion_id INTEGER REFERENCES transacciones (id),
+        descripcion TEXT,
+        tipo_documento VARCHAR(20) NOT NULL,
+        numero_factura VARCHAR(50),
+        razon_social VARCHAR(100),
+        email_enviado BOOLEAN,
+        fecha_envio_email TIMESTAMP,
+        email_destinatario VARCHAR(100)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_pagos_id ON pagos (id)",
+    """
+    CREATE TABLE IF NOT EXISTS auditoria (
+        id SERIAL PRIMARY KEY,
+        usuario_id INTEGER REFERENCES usuarios (id) ON DELETE SET NULL,
+        accion TEXT NOT NULL,
+        tabla_afectada TEXT NOT NULL,
+        registro_id INTEGER NOT NULL,
+        fecha TIMESTAMP,
+        detalles TEXT,
+        pago_id INTEGER REFERENCES pagos (id),
+        cobranza_id INTEGER REFERENCES cobranzas (id),
+        cuota_id INTEGER REFERENCES cuota (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_auditoria_id ON auditoria (id)",
+    """
+    CREATE TABLE IF NOT EXISTS partidas (
+        id SERIAL PRIMARY KEY,
+        fecha DATE NOT NULL,
+        cuenta VARCHAR(50) NOT NULL,
+        detalle VARCHAR(255),
+        descripcion VARCHAR,
+        recibo_factura VARCHAR(50),
+        ingreso NUMERIC(10, 2) NOT NULL,
+        egreso NUMERIC(10, 2) NOT NULL,
+        saldo NUMERIC(10, 2) NOT NULL,
+        usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+        cobranza_id INTEGER REFERENCES cobranzas (id) ON DELETE SET NULL,
+        pago_id INTEGER REFERENCES pagos (id) ON DELETE SET NULL,
+        monto NUMERIC(10, 2) NOT NULL,
+        tipo VARCHAR(10) NOT NULL,
+        CONSTRAINT partidas_tipo_check CHECK (tipo IN ('ingreso', 'egreso'))
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_partidas_id ON partidas (id)",
+]
+
+MIGRACIONES = [
+    (1, "Esquema base", ESQUEMA_BASE),
+    (2, "Saldo por cuenta e índices (fecha, id) de los listados", [
+        "ALTER TABLE partidas ADD COLUMN IF NOT EXISTS saldo_cuenta NUMERIC(10, 2)",
+        "CREATE INDEX IF NOT EXISTS ix_partidas_fecha_id ON partidas (fecha, id)",
+        "CREATE INDEX IF NOT EXISTS ix_pagos_fecha_id ON pagos (fecha, id)",
+        "CREATE INDEX IF NOT EXISTS ix_cobranzas_fecha_id ON cobranzas (fecha, id)",
+        "CREATE INDEX IF NOT EXISTS ix_cuota_fecha_id ON cuota (fecha, id)",
+    ]),
+    (3, "Índices de las consultas frecuentes", [
+        "CREATE INDEX IF NOT EXISTS ix_partidas_pago_id ON partidas (pago_id)",
+        "CREATE INDEX IF NOT EXISTS ix_partidas_cobranza_id ON partidas (cobranza_id)",
+        "CREATE INDEX IF NOT EXISTS ix_partidas_recibo_factura ON partidas (recibo_factura)",
+        "CREATE INDEX IF NOT EXISTS ix_auditoria_tabla_registro_fecha ON auditoria (tabla_afectada, registro_id, fecha)",
+        "CREATE INDEX IF NOT EXISTS ix_cuota_usuario_pagado_fecha ON cuota (usuario_id, pagado, fecha)",
+    ]),
+    (4, "Completar saldo_cuenta en las partidas existentes", [
+        """
+        UPDATE partidas p SET saldo_cuenta = a.saldo_cuenta
+        FROM (
+            SELECT id, SUM(CASE WHEN tipo = 'ingreso' THEN monto
+                                WHEN tipo = 'egreso' THEN -monto
+                                ELSE 0 END) OVER (PARTITION BY cuenta ORDER BY fecha, id) AS saldo_cuenta
+            FROM partidas
+        ) a
+        WHERE p.id = a.id AND p.saldo_cuenta IS DISTINCT FROM a.saldo_cuenta
+        """,
+    ]),
+    # Las filas de cada serie se crean al emitir el primer comprobante,
+    # partiendo del último número que ya figura en partidas / cuota
+    (5, "Secuencias de comprobantes", [
+        """
+        CREATE TABLE IF NOT EXISTS secuencias (
+            serie VARCHAR(20) PRIMARY KEY,
+            ultimo INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+    (6, "Reservas de números de comprobante", [
+        """
+        CREATE TABLE IF NOT EXISTS reservas_comprobantes (
+            id SERIAL PRIMARY KEY,
+            serie VARCHAR(20) NOT NULL REFERENCES secuencias (serie),
+            desde INTEGER NOT NULL,
+            hasta INTEGER NOT NULL,
+            siguiente INTEGER NOT NULL,
+            usuario_id INTEGER REFERENCES usuarios (id) ON DELETE SET NULL,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            cerrada BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_reservas_comprobantes_id ON reservas_comprobantes (id)",
+        """
+        CREATE TABLE IF NOT EXISTS comprobantes_anulados (
+            serie VARCHAR(20) NOT NULL,
+            numero INTEGER NOT NULL,
+            reserva_id INTEGER REFERENCES reservas_comprobantes (id),
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (serie, numero)
+        )
+        """,
+    ]),
+    (7, "Índice para el último usuario de cada registro auditado", [
+        """
+        CREATE INDEX IF NOT EXISTS ix_auditoria_ultimo_actor
+        ON auditoria (tabla_afectada, registro_id, fecha DESC) INCLUDE (usuario_id)
+        """,
+        "DROP INDEX IF EXISTS ix_auditoria_tabla_registro_fecha",
+    ]),
+    (8, "Auditoría particionada por mes", [
+        archivo_auditoria.particionar,
+    ]),
+    (9, "Índices del explorador de auditoría", [
+        "CREATE INDEX IF NOT EXISTS ix_auditoria_usuario_fecha ON auditoria (usuario_id, fecha, id)",
+        "CREATE INDEX IF NOT EXISTS ix_auditoria_fecha_id ON auditoria (fecha, id)",
+    ]),
+    (10, "Refresh tokens", [
+        """
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            id SERIAL PRIMARY KEY,
+            usuario_id INTEGER NOT NULL REFERENCES usuarios (id) ON DELETE CASCADE,
+            token_hash VARCHAR(64) NOT NULL UNIQUE,
+            familia VARCHAR(32) NOT NULL,
+            creado TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            vence TIMESTAMP NOT NULL,
+            revocado BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_refresh_tokens_id ON refresh_tokens (id)",
+        "CREATE INDEX IF NOT EXISTS ix_refresh_tokens_usuario_id ON refresh_tokens (usuario_id)",
+        "CREATE INDEX IF NOT EXISTS ix_refresh_tokens_familia ON refresh_tokens (familia)",
+    ]),
+    # Una fila por número anulado crecía con el tamaño de la reserva
+    (11, "Números anulados como rango de la reserva", [
+        "ALTER TABLE reservas_comprobantes ADD COLUMN IF NOT EXISTS anulado_desde INTEGER",
+        "ALTER TABLE reservas_comprobantes ADD COLUMN IF NOT EXISTS anulado_hasta INTEGER",
+        """
+        UPDATE reservas_comprobantes r SET anulado_desde = a.desde, anulado_hasta = a.hasta
+        FROM (
+            SELECT reserva_id, MIN(numero) AS desde, MAX(numero) AS hasta
+            FROM comprobantes_anulados WHERE reserva_id IS NOT NULL GROUP BY reserva_id
+        ) a
+        WHERE r.id = a.reserva_id
+        """,
+        "DROP TABLE IF EXISTS comprobantes_anulados",
+    ]),
+    (12, "Clave de las filas de auditoría escritas en segundo plano", [
+        "ALTER TABLE auditoria ADD COLUMN IF NOT EXISTS clave VARCHAR(32)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_auditoria_clave ON auditoria (clave, fecha)",
+    ]),
+    # Existían solo por el create_all de la migración 1; en bases que ya
+    # las tienen no cambia nada
+    (13, "Cabeceras del libro, puntos de control mensuales y versiones", [
+        """
+        CREATE TABLE IF NOT EXISTS saldos_cuenta (
+            cuenta VARCHAR(50) PRIMARY KEY,
+            saldo NUMERIC(10, 2) NOT NULL DEFAULT 0,
+            actualizado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS saldos_mensuales (
+            cuenta VARCHAR(50) NOT NULL,
+            anio INTEGER NOT NULL,
+            mes INTEGER NOT NULL,
+            saldo_inicial NUMERIC(10, 2) NOT NULL DEFAULT 0,
+            ingresos NUMERIC(10, 2) NOT NULL DEFAULT 0,
+            egresos NUMERIC(10, 2) NOT NULL DEFAULT 0,
+            saldo_final NUMERIC(10, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (cuenta, anio, mes)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS versiones (
+            tabla VARCHAR(50) PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+]
+
+def _versiones_aplicadas(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT NOT NULL,
+            aplicada TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    aplicadas = set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+    conn.commit()
+    return aplicadas
+
+def migrar():
+    """Aplica en orden las migraciones que la base todavía no tiene"""
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:clave)"), {"clave": CLAVE_BLOQUEO})
+        conn.commit()
+        try:
+            aplicadas = _versiones_aplicadas(conn)
+            pendientes = [m for m in MIGRACIONES if m[0] not in aplicadas]
+            if not pendientes:
+                print(f"Base de datos al día (versión {max(aplicadas, default=0)})")
+
+            for version, descripcion, pasos in pendientes:
+                print(f"Aplicando migración {version}: {descripcion}")
+                with conn.begin():
+                    for paso in pasos:
+                        if callable(paso):
+                            paso(conn)
+                        else:
+                            conn.execute(text(paso))
+                    conn.execute(
+                        text("INSERT INTO schema_migrations (version, descripcion) VALUES (:version, :descripcion)"),
+                        {"version": version, "descripcion": descripcion}
+                    )
+            if pendientes:
+                print(f"Base de datos en la versión {pendientes[-1][0]}")
+
+            # En cada deploy: particiones de auditoría para los próximos meses
+            with conn.begin():
+                archivo_auditoria.asegurar_particiones(conn)
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:clave)"), {"clave": CLAVE_BLOQUEO})
+            conn.commit()
+
+def estado():
+    with engine.connect() as conn:
+        aplicadas = _versiones_aplicadas(conn)
+    for version, descripcion, _ in MIGRACIONES:
+        marca = "x" if version in aplicadas else " "
+        print(f"[{marca}] {version}: {descripcion}")
+
+# Consultas de crud.py y el índice que deberían usar
+CONSULTAS = [
+    ("Página de partidas por cursor", "ix_partidas_fecha_id",
+     lambda db: db.query(models.Partida)
+        .filter(tuple_(models.Partida.fecha, models.Partida.id) < tuple_(literal(date.today()), literal(1)))
+        .order_by(models.Partida.fecha.desc(), models.Partida.id.desc()).limit(100)),
+    ("Partidas posteriores a una edición", "ix_partidas_fecha_id",
+     lambda db: db.query(models.Partida.id)
+        .filter(tuple_(models.Partida.fecha, models.Partida.id) > tuple_(literal(date.today()), literal(1)))),
+    ("Partida de un pago", "ix_partidas_pago_id",
+     lambda db: db.query(models.Partida).filter(models.Partida.pago_id == 1)),
+    ("Partida de una cobranza", "ix_partidas_cobranza_id",
+     lambda db: db.query(models.Partida).filter(models.Partida.cobranza_id == 1)),
+    ("Partida por comprobante", "ix_partidas_recibo_factura",
+     lambda db: db.query(models.Partida).filter(models.Partida.recibo_factura == "REC-1")),
+    ("Página de pagos", "ix_pagos_fecha_id",
+     lambda db: db.query(models.Pago).order_by(models.Pago.fecha.desc(), models.Pago.id.desc()).limit(100)),
+    ("Página de cobranzas", "ix_cobranzas_fecha_id",
+     lambda db: db.query(models.Cobranza).order_by(models.Cobranza.fecha.desc(), models.Cobranza.id.desc()).limit(100)),
+    ("Página de cuotas", "ix_cuota_fecha_id",
+     lambda db: db.query(models.Cuota).order_by(models.Cuota.fecha.desc(), models.Cuota.id.desc()).limit(100)),
+    ("Cuotas pendientes de un socio", "ix_cuota_usuario_pagado_fecha",
+     lambda db: db.query(models.Cuota)
+        .filter(models.Cuota.usuario_id == 1, models.Cuota.pagado == False)
+        .order_by(models.Cuota.fecha)),
+    # En cada partición el índice se llama <partición>_tabla_afectada_registro_id_fecha_usuario_idx
+    ("Último usuario que tocó cada registro", "_tabla_afectada_registro_id_fecha_usuario",
+     lambda db: db.query(models.Auditoria.registro_id, models.Auditoria.usuario_id)
+        .filter(models.Auditoria.tabla_afectada == "partidas", models.Auditoria.registro_id.in_([1, 2, 3]),
+                models.Auditoria.fecha >= settings.inicio_meses_activos())
+        .distinct(models.Auditoria.registro_id)
+        .order_by(models.Auditoria.registro_id, models.Auditoria.fecha.desc())),
+    ("Auditoría de un usuario", "_usuario_id_fecha_id_idx",
+     lambda db: db.query(models.Auditoria)
+        .filter(models.Auditoria.usuario_id == 1)
+        .order_by(models.Auditoria.fecha.desc(), models.Auditoria.id.desc()).limit(100)),
+    ("Página de auditoría por fecha", "_fecha_id_idx",
+     lambda db: db.query(models.Auditoria)
+        .filter(tuple_(models.Auditoria.fecha, models.Auditoria.id) < tuple_(literal(date.today()), literal(1)))
+        .order_by(models.Auditoria.fecha.desc(), models.Auditoria.id.desc()).limit(100)),
+    ("Ingresos y egresos mensuales", "saldos_mensuales_pkey",
+     lambda db: db.query(models.SaldoMensual)
+        .filter(models.SaldoMensual.cuenta == "LIBRO_DIARIO", models.SaldoMensual.anio.between(2020, 2030))),
+]
+
+def verificar() -> bool:
+    """
+    Corre EXPLAIN sobre cada consulta y revisa que el plan use el índice
+    esperado. Se desactiva el seq scan para que el resultado no dependa
+    del tamaño de las tablas (en una base chica Postgres prefiere recorrerlas).
+    """
+    ok = True
+    with Session(engine) as db:
+        db.execute(text("SET LOCAL enable_seqscan = off"))
+        for descripcion, indice, consulta in CONSULTAS:
+            compilada = consulta(db).statement.compile(
+                dialect=engine.dialect, compile_kwargs={"render_postcompile": True}
+            )
+            plan = "\n".join(
+                db.connection().exec_driver_sql("EXPLAIN " + str(compilada), compilada.params).scalars()
+            )
+            usa_indice = indice in plan
+            ok = ok and usa_indice
+            print(f"[{'OK' if usa_indice else 'FALLA'}] {descripcion} ({indice})")
+            if not usa_indice:
+                print("    " + plan.replace("\n", "\n    "))
+        db.rollback()
+    return ok
+
+if __name__ == "__main__":
+    if "--estado" in sys.argv:
+        estado()
+    elif "--verificar" in sys.argv:
+        sys.exit(0 if verificar() else 1)
+    else:
+        migrar()
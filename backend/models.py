@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Date, Boolean, ForeignKey, Text, DateTime, Numeric, CheckConstraint
+from sqlalchemy import Column, Integer, String, Float, Date, Boolean, ForeignKey, Text, DateTime, Numeric, CheckConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -91,6 +91,11 @@ class Pago(Base):
     email_enviado = Column(Boolean, default=False)
     fecha_envio_email = Column(DateTime, nullable=True)
     email_destinatario = Column(String(100), nullable=True)
+    
+    # Índice para listar y paginar por (fecha, id)
+    __table_args__ = (
+        Index("ix_pagos_fecha_id", "fecha", "id"),
+    )
 
 class Cobranza(Base):
     __tablename__ = "cobranzas"
@@ -118,6 +123,11 @@ class Cobranza(Base):
     transaccion = relationship("Transaccion", back_populates="cobranzas")
     partidas = relationship("Partida", back_populates="cobranza")
     retencion = relationship("Retencion", back_populates="cobranzas")
+    
+    # Índice para listar y paginar por (fecha, id)
+    __table_args__ = (
+        Index("ix_cobranzas_fecha_id", "fecha", "id"),
+    )
 class Partida(Base):
     __tablename__ = "partidas"
     
@@ -126,18 +136,22 @@ class Partida(Base):
     cuenta = Column(String(50), nullable=False)
     detalle = Column(String(255), nullable=True)
     descripcion = Column(String, nullable=True)
-    recibo_factura = Column(String(50), nullable=True)
+    recibo_factura = Column(String(50), nullable=True, index=True)
     ingreso = Column(Numeric(10, 2), nullable=False, default=0)
     egreso = Column(Numeric(10, 2), nullable=False, default=0)
     saldo = Column(Numeric(10, 2), nullable=False)
+    # Saldo acumulado dentro de su propia cuenta (CAJA, CUOTAS, INGRESOS...)
+    saldo_cuenta = Column(Numeric(10, 2), nullable=True)
     usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False)
-    cobranza_id = Column(Integer, ForeignKey("cobranzas.id", ondelete="SET NULL"), nullable=True)
-    pago_id = Column(Integer, ForeignKey("pagos.id", ondelete="SET NULL"), nullable=True)
+    cobranza_id = Column(Integer, ForeignKey("cobranzas.id", ondelete="SET NULL"), nullable=True, index=True)
+    pago_id = Column(Integer, ForeignKey("pagos.id", ondelete="SET NULL"), nullable=True, index=True)
     monto = Column(Numeric(10, 2), nullable=False)
     tipo = Column(String(10), nullable=False)
     
     __table_args__ = (
         CheckConstraint("tipo IN ('ingreso', 'egreso')", name="partidas_tipo_check"),
+        # El libro diario y los saldos se recorren siempre en orden (fecha, id)
+        Index("ix_partidas_fecha_id", "fecha", "id"),
     )
     
     # Relaciones
@@ -145,6 +159,75 @@ class Partida(Base):
     cobranza = relationship("Cobranza", back_populates="partidas")
     pago = relationship("Pago", back_populates="partidas")
 
+class SaldoCuenta(Base):
+    __tablename__ = "saldos_cuenta"
+    
+    # Cabecera del libro diario: una fila por cuenta más la fila del libro completo.
+    # Se bloquea (SELECT ... FOR UPDATE) en la misma transacción que inserta la partida.
+    cuenta = Column(String(50), primary_key=True)
+    saldo = Column(Numeric(10, 2), nullable=False, default=0)
+    actualizado = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())
+
+class SaldoMensual(Base):
+    __tablename__ = "saldos_mensuales"
+    
+    # Punto de control por cuenta y mes; se mantiene al registrar cada partida.
+    # La cuenta del libro completo usa la misma clave que en saldos_cuenta.
+    cuenta = Column(String(50), primary_key=True)
+    anio = Column(Integer, primary_key=True)
+    mes = Column(Integer, primary_key=True)
+    saldo_inicial = Column(Numeric(10, 2), nullable=False, default=0)
+    ingresos = Column(Numeric(10, 2), nullable=False, default=0)
+    egresos = Column(Numeric(10, 2), nullable=False, default=0)
+    saldo_final = Column(Numeric(10, 2), nullable=False, default=0)
+
+class Version(Base):
+    __tablename__ = "versiones"
+    
+    # Contador por tabla que se incrementa en la misma transacción que la
+    # modifica; sirve de clave para los resultados guardados en memoria.
+    tabla = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class Secuencia(Base):
+    __tablename__ = "secuencias"
+    
+    # Último número emitido de cada serie de comprobantes (O.P, REC, C.S.)
+    serie = Column(String(20), primary_key=True)
+    ultimo = Column(Integer, nullable=False, default=0)
+
+class ReservaComprobantes(Base):
+    __tablename__ = "reservas_comprobantes"
+    
+    # Bloque de números [desde, hasta] tomado de una serie de una sola vez;
+    # siguiente es el primer número del bloque que todavía no se usó.
+    # Al cerrarla, los números sin usar que no pudieron volver a la serie
+    # quedan anulados: [anulado_desde, anulado_hasta].
+    id = Column(Integer, primary_key=True, index=True)
+    serie = Column(String(20), ForeignKey("secuencias.serie"), nullable=False)
+    desde = Column(Integer, nullable=False)
+    hasta = Column(Integer, nullable=False)
+    siguiente = Column(Integer, nullable=False)
+    usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="SET NULL"), nullable=True)
+    fecha = Column(DateTime, default=func.current_timestamp())
+    cerrada = Column(Boolean, nullable=False, default=False)
+    anulado_desde = Column(Integer, nullable=True)
+    anulado_hasta = Column(Integer, nullable=True)
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    
+    # Solo se guarda el sha256 del token. Los tokens que salen de un mismo
+    # login forman una familia que vence junta; cada renovación revoca el
+    # token usado y emite otro de la misma familia.
+    id = Column(Integer, primary_key=True, index=True)
+    usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False, index=True)
+    token_hash = Column(String(64), nullable=False, unique=True)
+    familia = Column(String(32), nullable=False, index=True)
+    creado = Column(DateTime, default=func.current_timestamp())
+    vence = Column(DateTime, nullable=False)
+    revocado = Column(Boolean, nullable=False, default=False)
+
 class EmailConfig(Base):
     __tablename__ = "email_config"
     
@@ -187,6 +270,13 @@ class Cuota(Base):
     pagado_por = relationship("Usuario", foreign_keys=[pagado_por_usuario_id])
     auditorias = relationship("Auditoria", back_populates="cuota")
     
+    # Índice para listar y paginar por (fecha, id)
+    __table_args__ = (
+        Index("ix_cuota_fecha_id", "fecha", "id"),
+        # Cuotas pendientes de un socio
+        Index("ix_cuota_usuario_pagado_fecha", "usuario_id", "pagado", "fecha"),
+    )
+    
     @classmethod
     def calcular_meses_atraso(cls, fecha_cuota):
         """
@@ -228,13 +318,18 @@ class Transaccion(Base):
 class Auditoria(Base):
     __tablename__ = "auditoria"
     
-    id = Column(Integer, primary_key=True, index=True)
+    # La tabla está particionada por mes según fecha (ver archivo_auditoria.py),
+    # por eso fecha es parte de la clave primaria
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="SET NULL"), nullable=True)
     accion = Column(Text, nullable=False)
     tabla_afectada = Column(Text, nullable=False)
     registro_id = Column(Integer, nullable=False)
-    fecha = Column(DateTime, default=func.current_timestamp())
+    fecha = Column(DateTime, primary_key=True, default=func.current_timestamp())
     detalles = Column(Text, nullable=True)
+    # Identifica la fila al escribirla desde el escritor asincrónico, para
+    # no duplicarla si se vuelve a cargar el archivo de respaldo
+    clave = Column(String(32), nullable=True)
     
     # Relaciones con otros modelos
     usuario = relationship("Usuario", back_populates="auditorias")
@@ -246,4 +341,16 @@ class Auditoria(Base):
     
     pago = relationship("Pago", back_populates="auditorias")
     cobranza = relationship("Cobranza", back_populates="auditorias")
-    cuota = relationship("Cuota", back_populates="auditorias")
\ No newline at end of file
+    cuota = relationship("Cuota", back_populates="auditorias")
+    
+    # Última acción sobre un registro: DISTINCT ON (registro_id) lee el índice
+    # en orden y usuario_id sale del índice mismo, sin ir a la tabla
+    __table_args__ = (
+        Index("ix_auditoria_ultimo_actor", tabla_afectada, registro_id, fecha.desc(),
+              postgresql_include=["usuario_id"]),
+        # Filtros y orden del explorador de auditoría
+        Index("ix_auditoria_usuario_fecha", usuario_id, fecha, id),
+        Index("ix_auditoria_fecha_id", fecha, id),
+        Index("ix_auditoria_clave", clave, fecha, unique=True),
+        {"postgresql_partition_by": "RANGE (fecha)"},
+    )
\ No newline at end of file
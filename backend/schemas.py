@@ -8,12 +8,19 @@ from typing import Optional, Union
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    # Segundos de validez del access_token
+    expires_in: Optional[int] = None
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     id: Optional[int] = None
     nombre: Optional[str] = None
     email: Optional[str] = None
     rol: Optional[str] = None
+    emitido: Optional[int] = None
 
 # Rol Schemas
 class RolBase(BaseModel):
@@ -57,6 +64,10 @@ class UsuarioDetalle(Usuario):
     class Config:
         orm_mode = True
 
+# Respuesta de login y refresh
+class Sesion(Token):
+    usuario: UsuarioDetalle
+
 # Retencion Schemas
 class RetencionBase(BaseModel):
     nombre: str
@@ -254,6 +265,7 @@ class PartidaUpdate(BaseModel):
 
 class Partida(PartidaBase):
     id: int
+    saldo_cuenta: Optional[float] = None
     
     class Config:
         orm_mode = True
@@ -278,6 +290,7 @@ class PartidaDetalle(BaseModel):
     ingreso: float
     egreso: float
     saldo: float
+    saldo_cuenta: Optional[float] = None
     usuario_id: int
     usuario: Optional[UsuarioOut]
     cobranza_id: Optional[int]
@@ -307,6 +320,21 @@ class CuotaBase(BaseModel):
 class CuotaCreate(CuotaBase):
     pass
 
+class ReservaComprobantes(BaseModel):
+    id: int
+    serie: str
+    desde: int
+    hasta: int
+    siguiente: int
+    usuario_id: Optional[int] = None
+    fecha: Optional[datetime] = None
+    cerrada: bool = False
+    anulado_desde: Optional[int] = None
+    anulado_hasta: Optional[int] = None
+
+    class Config:
+        orm_mode = True
+
 class CuotaUpdate(BaseModel):
     usuario_id: Optional[int] = None
     fecha: Optional[date] = None
@@ -391,6 +419,19 @@ class Auditoria(AuditoriaBase):
     class Config:
         orm_mode = True
 
+class AuditoriaListado(BaseModel):
+    id: int
+    fecha: datetime
+    usuario_id: Optional[int] = None
+    usuario_nombre: Optional[str] = None
+    accion: str
+    tabla_afectada: str
+    registro_id: int
+    detalles: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
 class AuditoriaDetalle(Auditoria):
     usuario: Optional[Usuario] = None
     pago: Optional[Pago] = None
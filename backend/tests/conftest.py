@@ -0,0 +1,77 @@
+"""
+Pruebas de los invariantes del libro, la numeración y las sesiones.
+
+Corren contra una base de Postgres propia, que se migra al empezar y se
+vacía antes de cada prueba. Se indica con TESORERIA_BD_PRUEBAS (nombre de la
+base en el servidor de POSTGRES_HOST); sin ella las pruebas se saltean:
+
+    TESORERIA_BD_PRUEBAS=tesoreria_pruebas python -m pytest backend/tests
+"""
+import os
+import sys
+
+import pytest
+
+BD_PRUEBAS = os.getenv("TESORERIA_BD_PRUEBAS")
+if BD_PRUEBAS:
+    # Antes de importar config, que lee POSTGRES_DB al cargarse
+    os.environ["POSTGRES_DB"] = BD_PRUEBAS
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope="session")
+def base():
+    if not BD_PRUEBAS:
+        pytest.skip("TESORERIA_BD_PRUEBAS no está definida")
+    from sqlalchemy.exc import OperationalError
+    from database import engine
+    import migrar
+    import hashing
+
+    try:
+        engine.connect().close()
+    except OperationalError as e:
+        pytest.skip(f"No se pudo conectar a {BD_PRUEBAS}: {e}")
+    migrar.migrar()
+    yield engine
+    hashing.detener_pool()
+
+@pytest.fixture(autouse=True)
+def base_vacia(base):
+    from sqlalchemy import text
+    import auth
+    import crud
+
+    with base.begin() as conn:
+        tablas = conn.execute(text("""
+            SELECT relname FROM pg_class
+            WHERE relnamespace = 'public'::regnamespace AND relkind IN ('r', 'p')
+              AND NOT relispartition AND relname <> 'schema_migrations'
+        """)).scalars().all()
+        conn.execute(text(f"TRUNCATE {', '.join(tablas)} RESTART IDENTITY CASCADE"))
+    # Estado en memoria que depende de lo que había en la base
+    auth._principales.clear()
+    auth._revocados.clear()
+    crud._cache_balance.clear()
+
+@pytest.fixture
+def db():
+    from database import SessionLocal
+
+    sesion = SessionLocal()
+    yield sesion
+    sesion.close()
+
+@pytest.fixture
+def tesorero(db):
+    """Roles admin y tesorero y un usuario tesorero; devuelve su id"""
+    import auth
+    import models
+
+    db.add_all([models.Rol(id=1, nombre="admin"), models.Rol(id=2, nombre="tesorero")])
+    db.flush()
+    usuario = models.Usuario(nombre="Tesorero", email="tesorero@uarc.com",
+                             password_hash=auth.get_password_hash("clave"), rol_id=2)
+    db.add(usuario)
+    db.commit()
+    return usuario.id
@@ -0,0 +1,74 @@
+from datetime import date
+
+import pytest
+from fastapi import HTTPException
+
+import crud
+import models
+import schemas
+
+def _cuotas(usuario_id, cantidad):
+    return [schemas.CuotaCreate(usuario_id=usuario_id, fecha=date(2025, 6, 1), monto=1000) for _ in range(cantidad)]
+
+def _numeros_emitidos(db):
+    return sorted(n for (n,) in db.query(models.Cuota.nro_comprobante))
+
+def test_la_numeracion_no_repite_ni_saltea(db, tesorero):
+    primero = crud.siguiente_numero(db, crud.SERIE_CUOTA)
+    db.commit()
+    crud.create_cuotas_lote(db, _cuotas(tesorero, 3), tesorero, no_generar_movimiento=True)
+    assert crud.siguiente_numero(db, crud.SERIE_CUOTA) == primero + 4
+    db.rollback()
+    # El número de una transacción que falló vuelve a quedar libre
+    assert crud.siguiente_numero(db, crud.SERIE_CUOTA) == primero + 4
+
+def test_liberar_la_ultima_reserva_no_deja_huecos(db, tesorero):
+    crud.create_cuotas_lote(db, _cuotas(tesorero, 2), tesorero, no_generar_movimiento=True)
+    reserva = crud.reservar_comprobantes(db, crud.SERIE_CUOTA, 10, tesorero)
+    crud.create_cuotas_lote(db, _cuotas(tesorero, 3), tesorero, no_generar_movimiento=True, reserva_id=reserva.id)
+
+    resultado = crud.liberar_reserva(db, reserva.id)
+
+    assert resultado["devueltos"] == {"desde": reserva.desde + 3, "hasta": reserva.hasta}
+    assert resultado["anulados"] is None
+    crud.create_cuotas_lote(db, _cuotas(tesorero, 1), tesorero, no_generar_movimiento=True)
+    emitidos = _numeros_emitidos(db)
+    assert emitidos == list(range(emitidos[0], emitidos[0] + 6))
+
+def test_liberar_una_reserva_superada_anula_el_rango(db, tesorero):
+    reserva = crud.reservar_comprobantes(db, crud.SERIE_CUOTA, 5, tesorero)
+    crud.create_cuotas_lote(db, _cuotas(tesorero, 1), tesorero, no_generar_movimiento=True)
+    crud.create_cuotas_lote(db, _cuotas(tesorero, 2), tesorero, no_generar_movimiento=True, reserva_id=reserva.id)
+
+    resultado = crud.liberar_reserva(db, reserva.id)
+
+    rango = {"desde": reserva.desde + 2, "hasta": reserva.hasta}
+    assert resultado["devueltos"] is None
+    assert resultado["anulados"] == rango
+    db.refresh(reserva)
+    assert (reserva.cerrada, reserva.anulado_desde, reserva.anulado_hasta) == (True, rango["desde"], rango["hasta"])
+    # Emitidos más anulados cubren la serie entera
+    cubiertos = set(_numeros_emitidos(db)) | set(range(reserva.anulado_desde, reserva.anulado_hasta + 1))
+    assert cubiertos == set(range(min(cubiertos), max(cubiertos) + 1))
+
+def test_reserva_cerrada_o_insuficiente(db, tesorero):
+    reserva = crud.reservar_comprobantes(db, crud.SERIE_CUOTA, 2, tesorero)
+    with pytest.raises(HTTPException) as error:
+        crud.create_cuotas_lote(db, _cuotas(tesorero, 3), tesorero, no_generar_movimiento=True, reserva_id=reserva.id)
+    assert error.value.status_code == 400
+    db.rollback()
+
+    crud.liberar_reserva(db, reserva.id)
+    with pytest.raises(HTTPException) as error:
+        crud.create_cuotas_lote(db, _cuotas(tesorero, 1), tesorero, no_generar_movimiento=True, reserva_id=reserva.id)
+    assert error.value.status_code == 400
+
+@pytest.mark.parametrize("serie, cantidad", [
+    (crud.SERIE_ORDEN_PAGO, 5),
+    (crud.SERIE_CUOTA, 0),
+    (crud.SERIE_CUOTA, crud.MAXIMO_RESERVA + 1),
+])
+def test_reservas_invalidas(db, tesorero, serie, cantidad):
+    with pytest.raises(HTTPException) as error:
+        crud.reservar_comprobantes(db, serie, cantidad, tesorero)
+    assert error.value.status_code == 400
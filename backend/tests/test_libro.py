@@ -0,0 +1,142 @@
+import threading
+from datetime import date
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import crud
+import models
+import schemas
+from database import SessionLocal
+
+def _partida(db, usuario_id, fecha, monto, tipo="ingreso", cuenta="CAJA"):
+    return crud.create_partida(db, schemas.PartidaCreate(
+        fecha=fecha, cuenta=cuenta, monto=monto, tipo=tipo, saldo=0, usuario_id=usuario_id,
+        ingreso=monto if tipo == "ingreso" else 0, egreso=monto if tipo == "egreso" else 0
+    ))
+
+def _saldos_esperados(db):
+    """Recalcula desde cero el saldo global y el de cada cuenta, por (fecha, id)"""
+    total, por_cuenta, esperados = Decimal("0"), {}, {}
+    for p in db.query(models.Partida).order_by(models.Partida.fecha, models.Partida.id):
+        efecto = crud.efecto_partida(p.tipo, p.monto)
+        total += efecto
+        por_cuenta[p.cuenta] = por_cuenta.get(p.cuenta, Decimal("0")) + efecto
+        esperados[p.id] = (total, por_cuenta[p.cuenta])
+    return esperados, total, por_cuenta
+
+def _verificar_libro(db):
+    db.expire_all()
+    esperados, total, por_cuenta = _saldos_esperados(db)
+    for p in db.query(models.Partida):
+        assert (p.saldo, p.saldo_cuenta) == esperados[p.id], f"partida {p.id}"
+    cabeceras = {c.cuenta: c.saldo for c in db.query(models.SaldoCuenta)}
+    assert cabeceras.pop(crud.CUENTA_LIBRO) == total
+    assert cabeceras == por_cuenta
+
+def test_partida_con_fecha_anterior_corre_los_saldos_siguientes(db, tesorero):
+    marzo = _partida(db, tesorero, date(2025, 3, 10), 100)
+    abril = _partida(db, tesorero, date(2025, 4, 1), 50, cuenta="CUOTAS")
+    mayo = _partida(db, tesorero, date(2025, 5, 1), 30, tipo="egreso")
+    assert mayo.saldo_cuenta == Decimal("70")
+
+    _partida(db, tesorero, date(2025, 1, 5), 20, tipo="egreso")
+
+    for partida in (marzo, abril, mayo):
+        db.refresh(partida)
+    assert (marzo.saldo, marzo.saldo_cuenta) == (Decimal("80"), Decimal("80"))
+    assert (abril.saldo, abril.saldo_cuenta) == (Decimal("130"), Decimal("50"))
+    assert (mayo.saldo, mayo.saldo_cuenta) == (Decimal("100"), Decimal("50"))
+    _verificar_libro(db)
+
+def test_mover_una_partida_de_fecha_recalcula_ambos_tramos(db, tesorero):
+    primera = _partida(db, tesorero, date(2025, 1, 10), 100)
+    _partida(db, tesorero, date(2025, 2, 10), 40, tipo="egreso")
+    _partida(db, tesorero, date(2025, 3, 10), 10)
+
+    crud.update_partida(db, primera.id, schemas.PartidaUpdate(fecha=date(2025, 3, 20), tipo="ingreso"),
+                        current_user_id=tesorero)
+    _verificar_libro(db)
+
+def test_mover_una_partida_mas_adelante_sin_nada_en_el_medio(db, tesorero):
+    _partida(db, tesorero, date(2025, 1, 1), 100)
+    movida = _partida(db, tesorero, date(2025, 1, 5), 50)
+    _partida(db, tesorero, date(2025, 1, 20), 10)
+
+    crud.update_partida(db, movida.id, schemas.PartidaUpdate(fecha=date(2025, 1, 10), tipo="ingreso"),
+                        current_user_id=tesorero)
+
+    db.refresh(movida)
+    assert (movida.saldo, movida.saldo_cuenta) == (Decimal("150"), Decimal("150"))
+    _verificar_libro(db)
+
+def test_puntos_de_control_mensuales(db, tesorero):
+    _partida(db, tesorero, date(2025, 1, 15), 100)
+    _partida(db, tesorero, date(2025, 3, 2), 40, tipo="egreso")
+    _partida(db, tesorero, date(2025, 3, 20), 5, cuenta="CUOTAS")
+    # Con fecha anterior: cambia el arrastre de febrero y marzo
+    _partida(db, tesorero, date(2025, 1, 2), 7, tipo="egreso")
+
+    puntos = {(p.cuenta, p.mes): p for p in db.query(models.SaldoMensual).filter(models.SaldoMensual.anio == 2025)}
+    enero, marzo = puntos[(crud.CUENTA_LIBRO, 1)], puntos[(crud.CUENTA_LIBRO, 3)]
+    assert (enero.saldo_inicial, enero.ingresos, enero.egresos, enero.saldo_final) == (0, 100, 7, 93)
+    assert (marzo.saldo_inicial, marzo.ingresos, marzo.egresos, marzo.saldo_final) == (93, 5, 40, 58)
+    assert puntos[("CAJA", 3)].saldo_final == Decimal("53")
+
+    assert crud.get_saldo_inicial_mes(db, 2025, 2) == Decimal("93")
+    assert crud.get_saldo_inicial_mes(db, 2025, 4) == Decimal("58")
+    assert crud.get_saldo_inicial_mes(db, 2025, 3, cuenta="CUOTAS") == Decimal("0")
+    datos = crud.get_ingresos_egresos_mensuales(db, anio=2025)["datos"]
+    assert (datos[2]["ingresos"], datos[2]["egresos"]) == (5.0, 40.0)
+
+def test_la_cabecera_queda_bloqueada_hasta_el_commit(db, tesorero):
+    _partida(db, tesorero, date(2025, 1, 1), 10)
+
+    crud.registrar_partida(db, models.Partida(
+        fecha=date(2025, 1, 2), cuenta="CAJA", monto=5, tipo="ingreso",
+        ingreso=5, egreso=0, usuario_id=tesorero
+    ))
+    db.flush()
+
+    otra = SessionLocal()
+    try:
+        otra.execute(text("SET lock_timeout = '200ms'"))
+        with pytest.raises(OperationalError, match="lock"):
+            crud.registrar_partida(otra, models.Partida(
+                fecha=date(2025, 1, 3), cuenta="CAJA", monto=1, tipo="ingreso",
+                ingreso=1, egreso=0, usuario_id=tesorero
+            ))
+    finally:
+        otra.rollback()
+        otra.close()
+    db.commit()
+    _verificar_libro(db)
+
+def test_partidas_concurrentes_no_pierden_saldo(db, tesorero):
+    _partida(db, tesorero, date(2025, 1, 1), 1)
+    errores = []
+
+    def registrar(cuenta, dia):
+        sesion = SessionLocal()
+        try:
+            for i in range(10):
+                _partida(sesion, tesorero, date(2025, 2, dia), i + 1, cuenta=cuenta)
+        except Exception as e:
+            errores.append(e)
+        finally:
+            sesion.close()
+
+    hilos = [threading.Thread(target=registrar, args=(cuenta, dia))
+             for cuenta, dia in (("CAJA", 1), ("CUOTAS", 1), ("CAJA", 2), ("INGRESOS", 3))]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert not errores
+    _verificar_libro(db)
+    assert db.query(models.SaldoCuenta.saldo).filter(
+        models.SaldoCuenta.cuenta == crud.CUENTA_LIBRO
+    ).scalar() == Decimal("221")
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import auth
+import crud
+import main
+import models
+from config import settings
+
+@pytest.fixture
+def cliente():
+    return TestClient(main.app)
+
+def _login(cliente, email, password="clave"):
+    respuesta = cliente.post(f"{settings.API_PREFIX}/auth/login", data={"username": email, "password": password})
+    assert respuesta.status_code == 200
+    return respuesta.json()
+
+def _bearer(sesion):
+    return {"Authorization": f"Bearer {sesion['access_token']}"}
+
+def test_rotar_refresh_token(db, tesorero):
+    token = crud.crear_refresh_token(db, tesorero)
+    db.commit()
+    usuario_id, nuevo = crud.rotar_refresh_token(db, token)
+    assert usuario_id == tesorero
+    assert nuevo != token
+
+    familia = {t.familia for t in db.query(models.RefreshToken)}
+    assert len(familia) == 1
+
+def test_reusar_un_refresh_token_revoca_la_familia(db, tesorero):
+    original = crud.crear_refresh_token(db, tesorero)
+    otra_sesion = crud.crear_refresh_token(db, tesorero)
+    db.commit()
+    _, renovado = crud.rotar_refresh_token(db, original)
+
+    with pytest.raises(HTTPException) as error:
+        crud.rotar_refresh_token(db, original)
+    assert error.value.status_code == 401
+    # El que recibió el cliente legítimo tampoco sirve más
+    with pytest.raises(HTTPException) as error:
+        crud.rotar_refresh_token(db, renovado)
+    assert error.value.status_code == 401
+    # Las demás sesiones del usuario siguen
+    assert crud.rotar_refresh_token(db, otra_sesion)[0] == tesorero
+
+def test_refresh_y_logout(cliente, tesorero):
+    sesion = _login(cliente, "tesorero@uarc.com")
+    assert sesion["usuario"]["rol"]["nombre"] == "tesorero"
+
+    renovada = cliente.post(f"{settings.API_PREFIX}/auth/refresh", json={"refresh_token": sesion["refresh_token"]})
+    assert renovada.status_code == 200
+    reuso = cliente.post(f"{settings.API_PREFIX}/auth/refresh", json={"refresh_token": sesion["refresh_token"]})
+    assert reuso.status_code == 401
+    despues = cliente.post(f"{settings.API_PREFIX}/auth/refresh", json={"refresh_token": renovada.json()["refresh_token"]})
+    assert despues.status_code == 401
+
+def test_admin_degradado_o_borrado_pierde_permisos(cliente, db, tesorero):
+    db.add_all([
+        models.Usuario(id=10, nombre="Admin", email="admin@uarc.com",
+                       password_hash=auth.get_password_hash("clave"), rol_id=1),
+        models.Usuario(id=11, nombre="Otro admin", email="otro@uarc.com",
+                       password_hash=auth.get_password_hash("clave"), rol_id=1),
+    ])
+    db.commit()
+    admin, otro = _login(cliente, "admin@uarc.com"), _login(cliente, "otro@uarc.com")
+    assert cliente.get(f"{settings.API_PREFIX}/metricas", headers=_bearer(otro)).status_code == 200
+    # iat tiene resolución de segundos
+    time.sleep(1.1)
+
+    assert cliente.put(f"{settings.API_PREFIX}/usuarios/11", headers=_bearer(admin), json={"rol_id": 2}).status_code == 200
+    assert cliente.get(f"{settings.API_PREFIX}/metricas", headers=_bearer(otro)).status_code == 403
+    assert cliente.get(f"{settings.API_PREFIX}/metricas", headers=_bearer(admin)).status_code == 200
+
+    assert cliente.delete(f"{settings.API_PREFIX}/usuarios/11", headers=_bearer(admin)).status_code == 200
+    assert cliente.get(f"{settings.API_PREFIX}/metricas", headers=_bearer(otro)).status_code == 401
@@ -1,6 +1,10 @@
 import requests
 import json
-from PySide6.QtCore import QObject, Signal
+import time
+from PySide6.QtCore import QObject, Signal, QTimer
+
+# Segundos antes del vencimiento del token en que se pide uno nuevo
+MARGEN_RENOVACION = 120
 
 class Session(QObject):
     # Señales para notificar cambios en la sesión
@@ -11,17 +15,84 @@ class Session(QObject):
     def __init__(self):
         super().__init__()
         self.token = None
+        self.refresh_token = None
+        # time.monotonic() en que vence el token actual
+        self._vence = None
         self.user_info = None
         self.api_url = "https://uarc-tesoreria.onrender.com/api"
+        # Últimas respuestas con ETag, por URL y parámetros
+        self._respuestas = {}
+        # Renueva el token en segundo plano antes de que venza, así las
+        # sesiones largas no vuelven a pedir usuario y contraseña
+        self._timer_renovacion = QTimer(self)
+        self._timer_renovacion.setSingleShot(True)
+        self._timer_renovacion.timeout.connect(self.renovar_token)
 
     def set_token(self, token):
         self.token = token
 
+    def _guardar_tokens(self, data):
+        self.token = data["access_token"]
+        self.refresh_token = data.get("refresh_token")
+        expires_in = data.get("expires_in")
+        self._timer_renovacion.stop()
+        if expires_in and self.refresh_token:
+            self._vence = time.monotonic() + expires_in
+            espera = max(expires_in - MARGEN_RENOVACION, expires_in // 2)
+            self._timer_renovacion.start(espera * 1000)
+        else:
+            self._vence = None
+
+    def renovar_token(self):
+        """Pide un token nuevo con el refresh token; si la sesión venció, la cierra"""
+        if not self.refresh_token:
+            return False
+        try:
+            response = requests.post(
+                f"{self.api_url}/auth/refresh",
+                json={"refresh_token": self.refresh_token}
+            )
+        except Exception as e:
+            # Sin conexión: se reintenta en el próximo pedido
+            print(f"Error al renovar el token: {e}")
+            return False
+        if response.status_code == 200:
+            data = response.json()
+            self._guardar_tokens(data)
+            # El rol pudo haber cambiado desde el login
+            if "usuario" in data:
+                self.user_info = self._user_info_de(data["usuario"])
+            return True
+        if response.status_code == 401:
+            self.logout()
+        return False
+
     def get_headers(self):
+        # Si el timer no llegó a correr (por ejemplo, la PC estuvo suspendida)
+        if self.refresh_token and self._vence is not None and time.monotonic() > self._vence - MARGEN_RENOVACION:
+            self.renovar_token()
         if self.token:
             return {"Authorization": f"Bearer {self.token}"}
         return {}
 
+    def get(self, url, params=None):
+        """
+        GET condicional: envía el ETag de la respuesta anterior y, si el
+        servidor contesta 304, devuelve esa misma respuesta sin volver a bajarla.
+        """
+        clave = (url, tuple(sorted((params or {}).items())))
+        headers = self.get_headers()
+        anterior = self._respuestas.get(clave)
+        if anterior is not None:
+            headers["If-None-Match"] = anterior.headers["ETag"]
+
+        response = requests.get(url, headers=headers, params=params)
+        if response.status_code == 304 and anterior is not None:
+            return anterior
+        if response.status_code == 200 and "ETag" in response.headers:
+            self._respuestas[clave] = response
+        return response
+
     def login(self, email, password):
         """Función para iniciar sesión y obtener token"""
         try:
@@ -33,10 +104,13 @@ class Session(QObject):
             
             if response.status_code == 200:
                 data = response.json()
-                self.token = data["access_token"]
+                self._guardar_tokens(data)
                 
-                # Obtener información del usuario
-                user_info = self.get_user_info()
+                # El login ya trae el perfil; con un servidor anterior se pide aparte
+                if "usuario" in data:
+                    user_info = self._user_info_de(data["usuario"])
+                else:
+                    user_info = self.get_user_info()
                 if user_info:
                     self.user_info = user_info
                     self.login_success.emit(user_info)
@@ -58,6 +132,12 @@ class Session(QObject):
             self.login_failed.emit(f"Error de conexión: {str(e)}")
             return False
 
+    def _user_info_de(self, usuario):
+        """user_info con el nombre del rol en 'rol', como lo usan las vistas"""
+        user_info = dict(usuario)
+        user_info['rol'] = usuario['rol']['nombre']
+        return user_info
+
     def get_user_info(self):
         """Obtiene la información del usuario usando el token"""
         if not self.token:
@@ -86,22 +166,33 @@ class Session(QObject):
             return None
 
     def check_token_validity(self):
-        """Verifica si el token actual es válido"""
+        """Verifica si el token actual es válido, sin consultar al servidor"""
         if not self.token:
             return False
-        
-        headers = self.get_headers()
-        
-        try:
-            response = requests.get(f"{self.api_url}/usuarios/me", headers=headers)
-            return response.status_code == 200
-        except:
-            return False
+        if self._vence is None:
+            # Token sin vencimiento informado: hay que preguntarle al servidor
+            try:
+                response = requests.get(f"{self.api_url}/usuarios/me", headers=self.get_headers())
+                return response.status_code == 200
+            except:
+                return False
+        if time.monotonic() < self._vence - MARGEN_RENOVACION:
+            return True
+        return self.renovar_token()
 
     def logout(self):
         """Cierra la sesión del usuario"""
+        self._timer_renovacion.stop()
+        if self.refresh_token:
+            try:
+                requests.post(f"{self.api_url}/auth/logout", json={"refresh_token": self.refresh_token})
+            except Exception as e:
+                print(f"Error al cerrar la sesión en el servidor: {e}")
+        self.refresh_token = None
+        self._vence = None
         self.token = None
         self.user_info = None
+        self._respuestas.clear()
         self.logout_signal.emit()
 
 # Instancia global
@@ -54,6 +54,8 @@ class MainWindow(QMainWindow):
         
         # Conectar señales
         session.login_success.connect(lambda user_info: self.show_system())
+        # La sesión se cierra sola si ya no se puede renovar el token
+        session.logout_signal.connect(lambda: self.stacked_widget.setCurrentWidget(self.login_view))
         
         # Mostrar la vista de login por defecto
         self.stacked_widget.setCurrentWidget(self.login_view)
@@ -640,11 +640,10 @@ class CobranzasView(QWidget):
     def cargar_usuarios(self):
         """Carga la lista de usuarios desde la API y los ordena alfabéticamente"""
         try:
-            headers = session.get_headers()
             url = f"{session.api_url}/usuarios"
             print(f"Realizando petición GET a: {url}")
             
-            response = requests.get(url, headers=headers)
+            response = session.get(url)
             
             if response.status_code == 200:
                 # Obtener usuarios de la API
@@ -866,12 +865,11 @@ class CobranzasView(QWidget):
             }
             
             # Obtener cobranzas
-            headers = session.get_headers()
             url = f"{session.api_url}/cobranzas"
             print(f"Realizando petición GET a: {url}")
             print(f"Parámetros: {params}")
             
-            response = requests.get(url, headers=headers, params=params)
+            response = session.get(url, params=params)
             
             if response.status_code == 200:
                 # La respuesta puede ser directamente una lista o un diccionario con una lista
@@ -1008,11 +1006,9 @@ class CobranzasView(QWidget):
             
             print(f"Buscando cobranzas para: {usuario_nombre} (ID: {usuario_id})")
             
-            headers = session.get_headers()
-            
             # Buscar todas las cobranzas
             all_url = f"{session.api_url}/cobranzas"
-            all_response = requests.get(all_url, headers=headers)
+            all_response = session.get(all_url)
             
             if all_response.status_code == 200:
                 todas_cobranzas = all_response.json()
@@ -1036,7 +1032,7 @@ class CobranzasView(QWidget):
                     url = f"{session.api_url}/cobranzas"
                     params = {"usuario_id": usuario_id}
                     
-                    response = requests.get(url, headers=headers, params=params)
+                    response = session.get(url, params=params)
                     print(f"URL: {url}, Parámetros: {params}, Código de respuesta: {response.status_code}")
                     
                     if response.status_code == 200:
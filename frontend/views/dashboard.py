@@ -305,22 +305,18 @@ class DashboardView(QWidget):
         """Carga los datos del balance"""
         try:
             # Obtener balance
-            headers = session.get_headers()
-            balance_response = requests.get(
-                f"{session.api_url}/reportes/balance",
-                headers=headers
+            balance_response = session.get(
+                f"{session.api_url}/reportes/balance"
             )
             
             # Obtener ingresos/egresos mensuales
-            ingresos_egresos_response = requests.get(
-                f"{session.api_url}/reportes/ingresos_egresos_mensuales", 
-                headers=headers
+            ingresos_egresos_response = session.get(
+                f"{session.api_url}/reportes/ingresos_egresos_mensuales"
             )
             
             # Obtener cuotas pendientes
-            cuotas_pendientes_response = requests.get(
-                f"{session.api_url}/reportes/cuotas_pendientes",
-                headers=headers
+            cuotas_pendientes_response = session.get(
+                f"{session.api_url}/reportes/cuotas_pendientes"
             )
             
             if (balance_response.status_code == 200 and 
@@ -384,17 +380,19 @@ class DashboardView(QWidget):
     def load_partidas_data(self):
         """Carga todas las partidas disponibles con scroll automático"""
         try:
-            headers = session.get_headers()
-            
-            # Cargar todas las partidas sin límite
-            partidas_response = requests.get(
-                f"{session.api_url}/partidas",
-                headers=headers
-            )
+            # La API pagina: seguir el cursor hasta traer todas las partidas
+            params = {"limit": 1000}
+            partidas_response = session.get(f"{session.api_url}/partidas", params=params)
             
             # Procesar las partidas
             if partidas_response.status_code == 200:
                 partidas_data = partidas_response.json()
+                siguiente = partidas_response
+                while siguiente.status_code == 200 and siguiente.headers.get("X-Next-Cursor"):
+                    params = {**params, "after": siguiente.headers["X-Next-Cursor"]}
+                    siguiente = session.get(f"{session.api_url}/partidas", params=params)
+                    if siguiente.status_code == 200:
+                        partidas_data.extend(siguiente.json())
                 
                 # Actualizar título con la cantidad de registros
                 self.partidas_label.setText(f"Todos los movimientos ({len(partidas_data)} registros)")
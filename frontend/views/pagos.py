@@ -422,11 +422,9 @@ class PagosView(QWidget):
             
             print(f"Buscando pagos para: {usuario_nombre} (ID: {usuario_id})")
             
-            headers = session.get_headers()
-            
             # Buscar todos los pagos
             all_url = f"{session.api_url}/pagos"
-            all_response = requests.get(all_url, headers=headers)
+            all_response = session.get(all_url)
             
             if all_response.status_code == 200:
                 todos_pagos = all_response.json()
@@ -450,7 +448,7 @@ class PagosView(QWidget):
                     url = f"{session.api_url}/pagos"
                     params = {"usuario_id": usuario_id}
                     
-                    response = requests.get(url, headers=headers, params=params)
+                    response = session.get(url, params=params)
                     print(f"URL: {url}, Parámetros: {params}, Código de respuesta: {response.status_code}")
                     
                     if response.status_code == 200:
@@ -881,11 +879,10 @@ class PagosView(QWidget):
     def cargar_usuarios(self):
         """Carga la lista de usuarios desde la API y los ordena alfabéticamente"""
         try:
-            headers = session.get_headers()
             url = f"{session.api_url}/usuarios"  # Sin barra al final
             print(f"Realizando petición GET a: {url}")
             
-            response = requests.get(url, headers=headers)
+            response = session.get(url)
             
             if response.status_code == 200:
                 self.usuarios = response.json()
@@ -1247,12 +1244,11 @@ class PagosView(QWidget):
             }
             
             # Obtener pagos
-            headers = session.get_headers()
             url = f"{session.api_url}/pagos"
             print(f"Realizando petición GET a: {url}")
             print(f"Parámetros: {params}")
             
-            response = requests.get(url, headers=headers, params=params)
+            response = session.get(url, params=params)
             
             if response.status_code == 200:
                 # La respuesta puede ser directamente una lista o un diccionario con una lista
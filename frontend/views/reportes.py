@@ -2,7 +2,6 @@ import os
 import sys
 from datetime import datetime, timedelta
 import pandas as pd
-import requests
 import json
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
@@ -363,6 +362,13 @@ class ReportesView(QWidget):
         self.tipo_combo.setFixedWidth(120)
         self.tipo_combo.addItems(["Todos", "Ingreso", "Egreso"])
         
+        # Cuenta: con una cuenta elegida el saldo mostrado es el de esa cuenta
+        cuenta_label = QLabel("Cuenta:")
+        cuenta_label.setStyleSheet("font-weight: bold;")
+        self.libro_cuenta_combo = QComboBox()
+        self.libro_cuenta_combo.setFixedWidth(120)
+        self.libro_cuenta_combo.addItem("Todas")
+        
         # Botón de búsqueda mejorado
         self.libro_buscar_btn = QPushButton("Buscar")
         self.libro_buscar_btn.setStyleSheet(BUTTON_STYLE)
@@ -377,6 +383,9 @@ class ReportesView(QWidget):
         filtros_layout.addSpacing(10)
         filtros_layout.addWidget(tipo_label)
         filtros_layout.addWidget(self.tipo_combo)
+        filtros_layout.addSpacing(10)
+        filtros_layout.addWidget(cuenta_label)
+        filtros_layout.addWidget(self.libro_cuenta_combo)
         filtros_layout.addStretch()
         filtros_layout.addWidget(self.libro_buscar_btn)
         
@@ -458,6 +467,7 @@ class ReportesView(QWidget):
     def refresh_data(self):
         """Carga los datos iniciales"""
         self.on_generar_ingresos_egresos()
+        self.cargar_cuentas_libro()
         self.on_buscar_libro()
     
     # Métodos para Ingresos y Egresos
@@ -468,10 +478,8 @@ class ReportesView(QWidget):
             anio = self.anio_combo.currentData()
             
             # Llamada a la API
-            headers = session.get_headers()
-            response = requests.get(
+            response = session.get(
                 f"{session.api_url}/reportes/ingresos_egresos_mensuales",
-                headers=headers,
                 params={"anio": anio}
             )
             
@@ -805,12 +813,33 @@ class ReportesView(QWidget):
 
     
     # Métodos para Libro Diario
+    def cargar_cuentas_libro(self):
+        """Llena el filtro de cuentas con las que existen en el libro"""
+        try:
+            response = session.get(f"{session.api_url}/reportes/cuentas")
+            if response.status_code != 200:
+                return
+            cuentas = [item["cuenta"] for item in response.json().get("cuentas", [])]
+        except Exception as e:
+            print(f"Error al cargar las cuentas: {str(e)}")
+            return
+
+        seleccion = self.libro_cuenta_combo.currentText()
+        self.libro_cuenta_combo.blockSignals(True)
+        self.libro_cuenta_combo.clear()
+        self.libro_cuenta_combo.addItem("Todas")
+        self.libro_cuenta_combo.addItems(cuentas)
+        indice = self.libro_cuenta_combo.findText(seleccion)
+        self.libro_cuenta_combo.setCurrentIndex(max(indice, 0))
+        self.libro_cuenta_combo.blockSignals(False)
+
     def on_buscar_libro(self):
         """Busca partidas para el libro diario ordenadas por ID"""
         try:
             desde = self.libro_desde_date.date().toString("yyyy-MM-dd")
             hasta = self.libro_hasta_date.date().toString("yyyy-MM-dd")
             tipo = self.tipo_combo.currentText().lower()
+            cuenta_filtro = self.libro_cuenta_combo.currentText()
 
             QMessageBox.information(self, "Procesando", "Obteniendo datos del libro diario, espere un momento...")
 
@@ -822,13 +851,21 @@ class ReportesView(QWidget):
             }
             if tipo != "todos":
                 params["tipo"] = tipo
+            if cuenta_filtro != "Todas":
+                params["cuenta"] = cuenta_filtro
 
-            headers = session.get_headers()
-            response = requests.get(f"{session.api_url}/partidas", headers=headers, params=params)
+            response = session.get(f"{session.api_url}/partidas", params=params)
 
             if response.status_code == 200:
                 partidas = response.json()
 
+                # Seguir el cursor hasta traer todo el rango
+                while response.status_code == 200 and response.headers.get("X-Next-Cursor"):
+                    params = {**params, "after": response.headers["X-Next-Cursor"]}
+                    response = session.get(f"{session.api_url}/partidas", params=params)
+                    if response.status_code == 200:
+                        partidas.extend(response.json())
+
                 for partida in partidas:
                     partida['id_numeric'] = int(partida.get('id', 0))
                 partidas = sorted(partidas, key=lambda x: (x.get('fecha', ''), x.get('id_numeric', 0)), reverse=True)
@@ -889,7 +926,10 @@ class ReportesView(QWidget):
                     egreso_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
                     self.libro_table.setItem(row, 6, egreso_item)
 
-                    saldo = partida.get('saldo', 0)
+                    if cuenta_filtro != "Todas" and partida.get('saldo_cuenta') is not None:
+                        saldo = partida.get('saldo_cuenta')
+                    else:
+                        saldo = partida.get('saldo', 0)
                     saldo_item = QTableWidgetItem(f"${saldo:,.2f}")
                     saldo_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
                     self.libro_table.setItem(row, 7, saldo_item)
@@ -267,8 +267,7 @@ class SocioCuotaView(QWidget):
                 url = f"{session.api_url}/cuotas"
             
             # Obtener cuotas
-            headers = session.get_headers()
-            response = requests.get(url, headers=headers, params=params)
+            response = session.get(url, params=params)
             
             if response.status_code == 200:
                 cuotas_data = response.json()
@@ -850,8 +849,8 @@ class SocioCuotaView(QWidget):
             # Monto de cuota predeterminado
             monto_cuota_base = 10000.00  # Ajusta según tus necesidades
             
-            # Contador de cuotas generadas
-            cuotas_generadas = 0
+            # Cuotas a generar; se envían todas juntas al final
+            cuotas_a_generar = []
             
             # Buscar usuarios con cuotas pendientes
             for usuario in self.usuarios:
@@ -859,7 +858,7 @@ class SocioCuotaView(QWidget):
                     # Obtener cuotas del usuario
                     headers = session.get_headers()
                     url = f"{session.api_url}/cuotas/usuario/{usuario['id']}"
-                    response = requests.get(url, headers=headers)
+                    response = session.get(url)
                     
                     if response.status_code == 200:
                         cuotas_usuario = response.json()
@@ -905,23 +904,29 @@ class SocioCuotaView(QWidget):
                                 "generada_automaticamente": True
                             }
                             
-                            # Enviar solicitud para crear cuota
-                            headers["Content-Type"] = "application/json"
-                            crear_cuota_url = f"{session.api_url}/cuotas"
-                            
-                            crear_response = requests.post(
-                                crear_cuota_url,
-                                headers=headers,
-                                json=cuota_data
-                            )
-                            
-                            if crear_response.status_code in [200, 201]:
-                                cuotas_generadas += 1
-                                print(f"Cuota generada para {usuario['nombre']} - Meses de deuda: {meses_deuda}, Monto total: ${monto_total:,.2f}")
+                            cuotas_a_generar.append(cuota_data)
+                            print(f"Cuota a generar para {usuario['nombre']} - Meses de deuda: {meses_deuda}, Monto total: ${monto_total:,.2f}")
                 
                 except Exception as e:
                     print(f"Error al procesar cuotas para {usuario['nombre']}: {str(e)}")
             
+            # Crear todas las cuotas en una sola solicitud: el servidor reserva
+            # un bloque de comprobantes y las registra en una transacción
+            cuotas_generadas = 0
+            if cuotas_a_generar:
+                headers = session.get_headers()
+                headers["Content-Type"] = "application/json"
+                crear_response = requests.post(
+                    f"{session.api_url}/cuotas/lote",
+                    headers=headers,
+                    json=cuotas_a_generar
+                )
+                
+                if crear_response.status_code in [200, 201]:
+                    cuotas_generadas = len(crear_response.json())
+                else:
+                    print(f"Error al generar cuotas: {crear_response.status_code} - {crear_response.text}")
+            
             # Mostrar resumen
             print(f"Generación de cuotas completada. Cuotas generadas: {cuotas_generadas}")
             
@@ -940,10 +945,9 @@ class SocioCuotaView(QWidget):
                 print("No hay token de sesión para cargar usuarios")
                 return
                 
-            headers = session.get_headers()
             url = f"{session.api_url}/usuarios"
             
-            response = requests.get(url, headers=headers)
+            response = session.get(url)
             
             if response.status_code == 200:
                 self.usuarios = response.json()
@@ -991,12 +995,11 @@ class SocioCuotaView(QWidget):
         try:
             # Construir la URL
             url = f"{session.api_url}/cuotas/usuario/{usuario_id}"
-            headers = session.get_headers()
             
             print(f"Buscando cuotas para usuario {usuario_id}: {usuario_nombre}")
             
             # Realizar la petición
-            response = requests.get(url, headers=headers)
+            response = session.get(url)
             
             if response.status_code == 200:
                 # Procesar los resultados